@@ -0,0 +1,90 @@
+"""
+Микробенчмарк заливки: заливает области холста 2048x2048 (4 мегапикселя) через DrawingApp.region_click.
+
+Холст делится линиями на области; заливка пустого холста закрашивает все 4 мегапикселя, заливка
+разделенного холста - одну из областей. Выводит время заливки и выделения похожего цвета
+и число обновлений картинки холста (заливка показывается одним прямоугольником).
+
+Запуск: python benchmarks/bench_fill.py [--size 2048] [--repeat 5] [--tolerance 32]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Корень репозитория
+
+import tk_stub  # noqa: E402
+
+tk_stub.install()  # Бенчмарк работает без дисплея
+
+import tkinter as tk  # noqa: E402
+import drawing_app  # noqa: E402
+
+
+class Event:
+    """Событие мыши с координатами."""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def measure(app, tool, point, repeat):
+    """Выполняет щелчок инструментом tool в точке point repeat раз и возвращает время щелчков (с)."""
+    times = []
+    for i in range(repeat):
+        app.pen_color = "#%02x0000" % (100 + i * 20)  # Новый цвет, чтобы каждая заливка меняла пиксели
+        app.region_tool = None
+        app.set_region_tool(tool)
+        start = time.perf_counter()
+        app.region_click(Event(*point))
+        times.append(time.perf_counter() - start)
+        app.drop_selection()
+        app.render_frame()  # Показываем заливку (вне замера)
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="ширина и высота холста")
+    parser.add_argument("--repeat", type=int, default=5, help="число заливок каждого вида")
+    parser.add_argument("--tolerance", type=int, default=32, help="допуск цвета")
+    args = parser.parse_args()
+
+    drawing_app.DrawingApp.VIEW_MAX_SIZE = (args.size, args.size)  # Заливка охватывает весь холст
+    app = drawing_app.DrawingApp(tk.Tk(), display_mode="raster")
+    app.apply_resize(args.size, args.size)
+    app.tolerance_var.set(args.tolerance)
+    app.render_frame()
+
+    flushes = []  # Обновления картинки холста
+    flush_display = app.flush_display
+
+    def counting_flush():
+        if app.dirty_box is not None:
+            flushes.append(app.dirty_box)
+        flush_display()
+
+    app.flush_display = counting_flush
+    results = [("пустой холст", "fill", measure(app, "fill", (10, 10), args.repeat))]
+    results.append(("обновлений картинки на заливку", None, len(flushes) / args.repeat))
+
+    half = args.size // 2
+    for points in ([half, 0, half, args.size], [0, half, half, half]):  # Линии делят холст на три области
+        app.begin_step()
+        app.mark_dirty(app.execute({"op": "line", "points": points, "color": "black", "width": 5}))
+        app.commit_step()
+    results.append(("область из разделенного холста", "fill", measure(app, "fill", (10, 10), args.repeat)))
+    results.append(("выделение похожего цвета", "select", measure(app, "select", (10, 10), args.repeat)))
+
+    print("холст: %dx%d, допуск %d" % (args.size, args.size, args.tolerance))
+    for name, tool, times in results:
+        if tool is None:
+            print("%s: %.1f" % (name, times))
+        else:
+            print("%s: p50 %.1f мс, max %.1f мс" % (name, times[len(times) // 2] * 1e3, times[-1] * 1e3))
+
+
+if __name__ == "__main__":
+    main()
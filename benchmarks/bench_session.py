@@ -0,0 +1,228 @@
+"""
+Бенчмарк общего холста: задержка доставки и объём трафика в зависимости от числа участников и длины журнала.
+
+Сервер сеанса запускается отдельным процессом на 127.0.0.1, участники - соединения SessionConnection в одном
+цикле asyncio. Каждый участник рисует свои штрихи: пачка из нескольких отрезков раз в кадр (~60 в секунду),
+как SessionClient при непрерывном рисовании. Задержка - время от отправки пачки до её получения каждым из
+остальных участников, подтверждение - до возвращения пачки отправителю эхом; трафик - байт на команду
+от участника к серверу и от сервера к участнику (вместе с эхом).
+Для каждого числа участников замер повторяется после заполнения журнала длинной историей: задержка, трафик,
+время подключения участника и размер его снимка не должны расти вместе с журналом.
+
+Запуск: python benchmarks/bench_session.py [--participants 2 4 8 16] [--seconds 3] [--history 20000]
+        [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Корень репозитория
+
+from drawing_session import MSG_OPS, SessionConnection, pack_message, serve  # noqa: E402
+
+FRAME_SECONDS = 1 / 60  # Интервал между пачками участника
+SEGMENTS_PER_BATCH = 2  # Отрезков штриха в пачке (8 событий мыши за кадр)
+POINTS_PER_SEGMENT = 5  # Точек в отрезке
+STROKE_SEGMENTS = 40  # Отрезков в штрихе до отпускания кнопки
+HISTORY_BATCH = 64  # Команд в пачке при заполнении журнала
+
+
+def percentile(values, fraction):
+    """Возвращает значение, меньше которого доля fraction значений values (None для пустого списка)."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+
+
+class Painter:
+    """Участник, рисующий случайные штрихи: выдает пачки команд line, как при рисовании мышью."""
+
+    def __init__(self, seed, size=(850, 500)):
+        self.random = random.Random(seed)
+        self.size = size
+        self.segments = 0  # Отрезков в текущем штрихе
+        self.x, self.y = self.random.randrange(size[0]), self.random.randrange(size[1])
+        self.color = self.random.choice(("black", "red", "#3050c0"))
+
+    def batch(self, count=SEGMENTS_PER_BATCH):
+        """Возвращает следующие count команд."""
+        commands = []
+        for _ in range(count):
+            if self.segments == STROKE_SEGMENTS:  # Новый штрих в другом месте
+                self.segments = 0
+                self.x, self.y = self.random.randrange(self.size[0]), self.random.randrange(self.size[1])
+            points = [self.x, self.y]
+            for _ in range(POINTS_PER_SEGMENT - 1):
+                self.x = max(0, min(self.size[0] - 1, self.x + self.random.randint(-6, 6)))
+                self.y = max(0, min(self.size[1] - 1, self.y + self.random.randint(-6, 6)))
+                points += [self.x, self.y]
+            commands.append({"op": "line", "points": points, "color": self.color, "width": 3, "layer": 0})
+            self.segments += 1
+        return commands
+
+
+def count_received(connection, counter):
+    """Считает в counter["bytes"] байты, прочитанные из соединения connection."""
+    readexactly = connection.reader.readexactly
+
+    async def counting(n):
+        data = await readexactly(n)
+        counter["bytes"] += len(data)
+        return data
+    connection.reader.readexactly = counting
+
+
+async def fill_history(port, commands):
+    """Добавляет в журнал сервера commands команд одного участника и ждет, пока сервер их примет."""
+    connection = await SessionConnection.connect("127.0.0.1", port, "история")
+    painter = Painter(-1)
+    for _ in range(0, commands, HISTORY_BATCH):
+        connection.send(painter.batch(HISTORY_BATCH))
+        await connection.writer.drain()
+    probe = await SessionConnection.connect("127.0.0.1", port, "проверка")  # Снимок после всей истории
+    probe.close()
+    connection.close()
+
+
+async def run_round(port, participants, seconds):
+    """
+    Подключает participants участников, которые рисуют seconds секунд.
+    Возвращает задержки доставки (мс), байты и команды в обе стороны, время подключения и размер снимка.
+    """
+    connections = []
+    join_ms = []
+    snapshot_bytes = []
+    counter = {"bytes": 0}
+    for _ in range(participants):
+        start = time.perf_counter()
+        connection = await SessionConnection.connect("127.0.0.1", port, "бот")
+        join_ms.append((time.perf_counter() - start) * 1000)
+        snapshot_bytes.append(sum(len(tile) for tile in connection.tiles.values() if tile is not None))
+        count_received(connection, counter)
+        connections.append(connection)
+    sent = {connection.client: [] for connection in connections}  # Время отправки пачек каждого участника
+    received = {connection.client: 0 for connection in connections}  # Получено пачек каждым участником
+    result = {"latencies": [], "echo_latencies": [], "sent_bytes": 0, "sent_commands": 0, "received_commands": 0}
+
+    async def paint(connection):
+        painter = Painter(connection.client)
+        stop = time.perf_counter() + seconds
+        while time.perf_counter() < stop:
+            batch = painter.batch()
+            data = pack_message(MSG_OPS, connection.encoder.encode(batch))  # Как SessionConnection.send
+            sent[connection.client].append(time.perf_counter())
+            connection.writer.write(data)
+            result["sent_bytes"] += len(data)
+            result["sent_commands"] += len(batch)
+            await connection.writer.drain()
+            await asyncio.sleep(FRAME_SECONDS)
+
+    async def listen(connection):
+        counts = {}  # Получено пачек от каждого участника
+        while True:
+            _, sender, _, commands = await connection.receive()
+            now = time.perf_counter()
+            index = counts.get(sender, 0)
+            counts[sender] = index + 1
+            latency = (now - sent[sender][index]) * 1000  # k-я полученная - k-я отправленная
+            result["received_commands"] += len(commands)
+            if sender == connection.client:  # Эхо своей пачки
+                result["echo_latencies"].append(latency)
+            else:
+                result["latencies"].append(latency)
+            received[connection.client] += 1
+
+    listeners = [asyncio.ensure_future(listen(connection)) for connection in connections]
+    await asyncio.gather(*(paint(connection) for connection in connections))
+    total = sum(len(times) for times in sent.values())
+    deadline = time.perf_counter() + 30
+    while any(received[client] < total for client in sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)  # Ждем доставки последних пачек
+    for listener in listeners:
+        listener.cancel()
+    for connection in connections:
+        connection.close()
+    result.update(received_bytes=counter["bytes"], join_ms=join_ms, snapshot_bytes=snapshot_bytes)
+    return result
+
+
+def start_server():
+    """Запускает сервер сеанса отдельным процессом; возвращает процесс и его порт."""
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--server"], stdout=subprocess.PIPE,
+                               env=env, encoding="utf-8")
+    line = process.stdout.readline()  # "Сервер сеанса: 127.0.0.1:порт"
+    return process, int(line.rsplit(":", 1)[1])
+
+
+def measure(participants, seconds, history):
+    """Замер одного числа участников на новом сервере с журналом из history команд."""
+    process, port = start_server()
+    try:
+        if history:
+            asyncio.run(fill_history(port, history))
+        round_result = asyncio.run(run_round(port, participants, seconds))
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = round_result["latencies"]
+    return {
+        "participants": participants,
+        "history": history,
+        "batches_delivered": len(latencies),
+        "latency_ms": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                       "max": percentile(latencies, 1.0)},
+        "echo_ms_p50": percentile(round_result["echo_latencies"], 0.5),
+        "bytes_per_command_up": round(round_result["sent_bytes"] / max(1, round_result["sent_commands"]), 2),
+        "bytes_per_command_down": round(round_result["received_bytes"] / max(1, round_result["received_commands"]),
+                                        2),
+        "join_ms_p50": percentile(round_result["join_ms"], 0.5),
+        "snapshot_bytes": max(round_result["snapshot_bytes"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--participants", type=int, nargs="+", default=[2, 4, 8, 16], help="числа участников")
+    parser.add_argument("--seconds", type=float, default=3, help="время рисования в каждом замере, секунд")
+    parser.add_argument("--history", type=int, default=20000, help="команд в журнале для замеров с историей")
+    parser.add_argument("--output", help="файл результатов JSON (по умолчанию - стандартный вывод)")
+    parser.add_argument("--server", action="store_true", help=argparse.SUPPRESS)  # Процесс сервера
+    args = parser.parse_args()
+
+    if args.server:
+        try:
+            asyncio.run(serve("127.0.0.1", 0))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    results = []
+    for history in sorted({0, args.history}):
+        for participants in args.participants:
+            result = measure(participants, args.seconds, history)
+            results.append(result)
+            print("участников %2d  журнал %6d  задержка p50 %7.2f мс  p99 %7.2f мс  байт/команду %5.1f/%5.1f  "
+                  "подключение %7.1f мс  снимок %7d байт" % (
+                      participants, history, result["latency_ms"]["p50"], result["latency_ms"]["p99"],
+                      result["bytes_per_command_up"], result["bytes_per_command_down"], result["join_ms_p50"],
+                      result["snapshot_bytes"]), file=sys.stderr)
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as stream:
+            json.dump(report, stream, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
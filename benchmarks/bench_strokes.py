@@ -0,0 +1,104 @@
+"""
+Бенчмарк штрихов: воспроизводит журнал точек одного длинного штриха через DrawingApp.paint.
+
+Журнал - текстовый файл с парами координат "x y" в каждой строке; без него генерируется
+спираль из 100 000 точек. Между кадрами приходит --events-per-frame событий движения мыши.
+Выводит число элементов на холсте Tk, задержку обработчиков paint и flush_stroke и пропускную способность
+(событий движения в секунду). Размер холста, толщину, непрозрачность и нажим кисти можно задать, например,
+для штриха на холсте 4K: --canvas 3840x2160 --width 10 --step 8 --opacity 50 --pressure.
+
+Запуск: python benchmarks/bench_strokes.py [--log stroke.txt] [--events-per-frame 8] [--canvas 850x500]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Корень репозитория
+
+import tk_stub  # noqa: E402
+
+tk_stub.install()  # Бенчмарк работает без дисплея
+
+import tkinter as tk  # noqa: E402
+from drawing_app import DrawingApp  # noqa: E402
+
+
+class Event:
+    """Событие мыши с координатами."""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def load_points(path, count, size=(850, 500), step=1.0):
+    """
+    Читает журнал точек или генерирует спираль из count точек в центре холста размера size,
+    соседние точки которой отстоят примерно на step пикселей.
+    """
+    if path:
+        with open(path) as log:
+            return [tuple(int(v) for v in line.split()[:2]) for line in log if line.strip()]
+    points = []
+    angle = 0.0
+    for i in range(count):
+        radius = 20 + (i % 20000) / 20000.0 * (min(size) / 2 - 30)  # Медленно раскручивающаяся спираль
+        angle += step / radius
+        points.append((int(size[0] / 2 + radius * math.cos(angle)), int(size[1] / 2 + radius * math.sin(angle))))
+    return points
+
+
+def percentile(samples, fraction):
+    """Возвращает перцентиль отсортированного списка."""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--log", help="журнал точек штриха (x y в строке)")
+    parser.add_argument("--points", type=int, default=100000, help="число точек синтетического штриха")
+    parser.add_argument("--events-per-frame", type=int, default=8, help="событий движения между кадрами")
+    parser.add_argument("--canvas", default="850x500", help="размер холста ШxВ")
+    parser.add_argument("--step", type=float, default=1.0, help="расстояние между точками спирали (пикселей)")
+    parser.add_argument("--width", type=int, default=5, help="толщина кисти")
+    parser.add_argument("--opacity", type=int, default=100, help="непрозрачность кисти, %%")
+    parser.add_argument("--pressure", action="store_true", help="нажим по скорости движения мыши")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.canvas.split("x"))
+    points = load_points(args.log, args.points, size, args.step)
+    app = DrawingApp(tk.Tk())
+    if size != app.image.size:
+        app.apply_resize(*size)
+    app.brush_size_var.set(args.width)
+    app.opacity_var.set(args.opacity)
+    app.pressure_var.set(args.pressure)
+
+    paint_times, flush_times = [], []
+    for i, (x, y) in enumerate(points):
+        start = time.perf_counter()
+        app.paint(Event(x, y))
+        paint_times.append(time.perf_counter() - start)
+        if (i + 1) % args.events_per_frame == 0:  # Наступил кадр: выполняем запланированную отрисовку
+            start = time.perf_counter()
+            tk_stub.run_pending()
+            flush_times.append(time.perf_counter() - start)
+    app.reset(Event(*points[-1]))
+    total = sum(paint_times) + sum(flush_times)  # Время обработки всех событий
+
+    paint_times.sort()
+    flush_times.sort()
+    print("точек: %d" % len(points))
+    print("элементов на холсте Tk: %d" % len(app.canvas.find_all()))
+    print("paint: p50 %.1f мкс, p99 %.1f мкс" % (percentile(paint_times, 0.5) * 1e6,
+                                                  percentile(paint_times, 0.99) * 1e6))
+    print("flush_stroke: p50 %.1f мкс, p99 %.1f мкс, кадров %d" % (percentile(flush_times, 0.5) * 1e6,
+                                                                   percentile(flush_times, 0.99) * 1e6,
+                                                                   len(flush_times)))
+    print("пропускная способность: %.0f событий/с" % (len(points) / total))
+
+
+if __name__ == "__main__":
+    main()
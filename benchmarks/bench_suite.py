@@ -0,0 +1,337 @@
+"""
+Набор бенчмарков: воспроизводит трассы событий через DrawingApp на заглушке Tk и пишет результаты в JSON.
+
+Трасса - список событий (в файле - JSON Lines, одно событие в строке):
+    {"type": "motion", "x": 10, "y": 20}     движение мыши с нажатой кнопкой (paint)
+    {"type": "frame"}                        срабатывание таймеров: отрисовка кадра и другие вызовы after()
+    {"type": "release", "x": 10, "y": 20}    отпускание кнопки мыши (reset)
+    {"type": "text", "x": 10, "y": 20, "text": "Метка", "size": 14}
+    {"type": "clear"}, {"type": "undo"}, {"type": "redo"}
+    {"type": "resize", "width": 1000, "height": 800}
+    {"type": "save", "format": "png"}        сохранение в файл (ожидается его окончание)
+
+Встроенные сценарии: длинный штрих, каракули из коротких штрихов, много надписей, циклы очистки и изменения
+размера и сохранение холстов нескольких размеров. Каждый сценарий выполняется в отдельном процессе, чтобы
+пиковая память (RSS) относилась только к нему. Для сценария записываются число событий ввода, событий
+в секунду, задержка обработчиков (p50/p99 по типам событий), пиковый RSS и число элементов на холсте Tk.
+Результаты двух запусков сравнивает --baseline; --profile DIR записывает трассу каждого сценария (Chrome Trace Event)
+и добавляет в результаты гистограммы профилировщика.
+
+Запуск: python benchmarks/bench_suite.py [--output results.json] [--scenario long_stroke ...]
+        [--trace trace.jsonl ...] [--raster] [--baseline old.json]
+        [--profile каталог] [--dump-traces каталог]
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource  # Пиковая память процесса (только Unix)
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Корень репозитория
+
+EVENTS_PER_FRAME = 8  # Событий движения мыши между кадрами (~500 событий/с при 60 кадрах/с)
+SAVE_SIZES = ((850, 500), (2048, 2048), (4096, 4096))  # Размеры холста для сценариев сохранения
+
+
+class Event:
+    """Событие мыши с координатами."""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def stroke_events(points):
+    """Возвращает события штриха по точкам points: движения с кадрами между ними и отпускание кнопки."""
+    events = []
+    for i, (x, y) in enumerate(points):
+        events.append({"type": "motion", "x": x, "y": y})
+        if (i + 1) % EVENTS_PER_FRAME == 0:
+            events.append({"type": "frame"})
+    events.append({"type": "release", "x": points[-1][0], "y": points[-1][1]})
+    events.append({"type": "frame"})
+    return events
+
+
+def spiral(count, size, step=2.0):
+    """Точки раскручивающейся спирали в центре холста size, соседние точки примерно в step пикселях."""
+    points = []
+    angle = 0.0
+    for i in range(count):
+        radius = 20 + i / count * (min(size) / 2 - 30)
+        angle += step / radius
+        points.append((int(size[0] / 2 + radius * math.cos(angle)), int(size[1] / 2 + radius * math.sin(angle))))
+    return points
+
+
+def scribble(rng, count, size, step=6):
+    """Точки случайного блуждания (каракули) из count точек внутри холста size."""
+    x, y = rng.randrange(size[0]), rng.randrange(size[1])
+    points = []
+    for _ in range(count):
+        x = min(size[0] - 1, max(0, x + rng.randint(-step, step)))
+        y = min(size[1] - 1, max(0, y + rng.randint(-step, step)))
+        points.append((x, y))
+    return points
+
+
+def long_stroke_trace():
+    """Один штрих из 50 000 точек."""
+    return stroke_events(spiral(50000, (850, 500)))
+
+
+def scribbles_trace():
+    """400 коротких штрихов по 50 точек в случайных местах."""
+    rng = random.Random(1)
+    events = []
+    for _ in range(400):
+        events.extend(stroke_events(scribble(rng, 50, (850, 500))))
+    return events
+
+
+def texts_trace():
+    """1000 надписей из 20 разных подписей; между щелчками интерфейс простаивает (кадр)."""
+    rng = random.Random(2)
+    events = []
+    for i in range(1000):
+        events.append({"type": "text", "x": rng.randrange(770), "y": rng.randrange(480),
+                       "text": "Метка %d" % (i % 20), "size": 14})
+        events.append({"type": "frame"})
+    return events
+
+
+def clear_resize_trace():
+    """40 циклов: штрих, изменение размера холста (по очереди больше и меньше) и очистка."""
+    rng = random.Random(3)
+    events = []
+    for cycle in range(40):
+        size = (1600, 1000) if cycle % 2 == 0 else (850, 500)
+        events.extend(stroke_events(scribble(rng, 100, (850, 500))))
+        events.append({"type": "resize", "width": size[0], "height": size[1]})
+        events.append({"type": "frame"})
+        events.append({"type": "clear"})
+        events.append({"type": "frame"})
+    return events
+
+
+def save_trace(size):
+    """Холст size с каракулями и его сохранение в PNG."""
+    rng = random.Random(4)
+    events = [{"type": "resize", "width": size[0], "height": size[1]}, {"type": "frame"}]
+    for _ in range(20):
+        events.extend(stroke_events(scribble(rng, 200, size, step=20)))
+    events.append({"type": "save", "format": "png"})
+    return events
+
+
+SCENARIOS = collections.OrderedDict([
+    ("long_stroke", long_stroke_trace),
+    ("scribbles", scribbles_trace),
+    ("texts", texts_trace),
+    ("clear_resize", clear_resize_trace),
+] + [("save_%dx%d" % size, lambda size=size: save_trace(size)) for size in SAVE_SIZES])  # Встроенные сценарии
+
+
+def load_trace(path):
+    """Читает трассу событий из файла JSON Lines."""
+    with open(path, encoding="utf-8") as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def dump_trace(events, path):
+    """Записывает трассу событий в файл JSON Lines."""
+    with open(path, "w", encoding="utf-8") as stream:
+        for event in events:
+            stream.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def peak_rss_kb():
+    """Возвращает пиковую память процесса в килобайтах (None, если модуль resource недоступен)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # В macOS - байты, в Linux - килобайты
+
+
+def latency_stats(samples):
+    """Возвращает число замеров и p50/p99/максимум задержки в микросекундах."""
+    samples = sorted(samples)
+    return {"count": len(samples),
+            "p50_us": round(samples[len(samples) // 2] * 1e6, 1),
+            "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1),
+            "max_us": round(samples[-1] * 1e6, 1)}
+
+
+def replay(name, events, display_mode, profile_dir=None):
+    """
+    Воспроизводит трассу events на новом DrawingApp и возвращает результаты сценария name.
+    Если задан каталог profile_dir, приложение работает с профилировщиком, и его трасса записывается туда.
+    """
+    import tk_stub
+    tk_stub.install()  # Бенчмарк работает без дисплея
+    import tkinter as tk
+    import drawing_app
+    from drawing_profiler import Profiler
+
+    profiler = Profiler() if profile_dir else None
+    app = drawing_app.DrawingApp(tk.Tk(), display_mode=display_mode, profiler=profiler)
+    if profiler is not None:  # Панель показателей обновляется таймером бесконечно; показатели снимаются в конце
+        app.root.after_cancel(app.profile_job)
+    workdir = tempfile.mkdtemp(prefix="bench_suite_")  # Каталог для сохраняемых файлов
+
+    def place_text(event):
+        app.text_mode = True  # Каждая надпись - отдельный вход в режим текста, как в интерфейсе
+        app.entered_text = event["text"]
+        app.text_size = event["size"]
+        app.place_text(Event(event["x"], event["y"]))
+
+    def save(event):
+        path = os.path.join(workdir, "save%d.%s" % (len(saves), event.get("format", "png")))
+        app.start_save(path)  # Время обработчика - задержка интерфейса; само сохранение идет в фоне
+        start = time.perf_counter()
+        app.save_future.result()
+        saves.append({"seconds": round(time.perf_counter() - start, 3), "bytes": os.path.getsize(path)})
+        os.remove(path)
+
+    handlers = {
+        "motion": lambda event: app.paint(Event(event["x"], event["y"])),
+        "frame": lambda event: tk_stub.run_pending(),
+        "release": lambda event: app.reset(Event(event["x"], event["y"])),
+        "text": place_text,
+        "clear": lambda event: app.clear_canvas(),
+        "undo": lambda event: app.undo(),
+        "redo": lambda event: app.redo(),
+        "resize": lambda event: app.apply_resize(event["width"], event["height"]),
+        "save": save,
+    }
+    saves = []  # Время фонового сохранения и размер файлов
+    latencies = collections.defaultdict(list)
+    for event in events:
+        handler = handlers[event["type"]]
+        start = time.perf_counter()
+        handler(event)
+        latencies[event["type"]].append(time.perf_counter() - start)
+    tk_stub.run_pending()
+    os.rmdir(workdir)
+
+    total = sum(sum(samples) for samples in latencies.values())  # Время всех обработчиков
+    inputs = sum(len(samples) for kind, samples in latencies.items() if kind != "frame")  # События ввода
+    result = {
+        "scenario": name,
+        "display_mode": display_mode,
+        "events": inputs,
+        "frames": len(latencies.get("frame", ())),
+        "seconds": round(total, 4),
+        "events_per_second": round(inputs / total, 1) if total else None,
+        "latency": {kind: latency_stats(samples) for kind, samples in sorted(latencies.items())},
+        "peak_rss_kb": peak_rss_kb(),
+        "tk_items": len(app.canvas.find_all()),
+        "canvas": list(app.image.size),
+    }
+    if saves:
+        result["saves"] = saves
+    if profiler is not None:
+        app.update_profile_overlay()  # Число элементов холста и память изображения в трассе
+        app.root.after_cancel(app.profile_job)
+        profiler.dump_trace(os.path.join(profile_dir, name + ".trace.json"))
+        result["profile"] = profiler.summary()
+    return result
+
+
+def run_child(name, trace_path, display_mode, profile_dir=None):
+    """Запускает сценарий в отдельном процессе и возвращает его результаты."""
+    command = [sys.executable, os.path.abspath(__file__), "--child", name, "--display-mode", display_mode]
+    if trace_path:
+        command += ["--child-trace", trace_path]
+    if profile_dir:
+        command += ["--profile", profile_dir]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode("utf-8"))
+
+
+def compare(results, baseline_path):
+    """Печатает изменение событий в секунду и p99 задержки относительно результатов из файла baseline_path."""
+    with open(baseline_path, encoding="utf-8") as stream:
+        baseline = {result["scenario"]: result for result in json.load(stream)["results"]}
+    for result in results:
+        old = baseline.get(result["scenario"])
+        if old is None or not old["events_per_second"] or not result["events_per_second"]:
+            continue
+        change = (result["events_per_second"] / old["events_per_second"] - 1) * 100
+        print("%-16s событий/с: %+.1f%%" % (result["scenario"], change), file=sys.stderr)
+        for kind, stats in sorted(result["latency"].items()):
+            if kind in old["latency"] and old["latency"][kind]["p99_us"]:
+                change = (stats["p99_us"] / old["latency"][kind]["p99_us"] - 1) * 100
+                print("%-16s p99 %s: %+.1f%%" % ("", kind, change), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="встроенный сценарий (можно несколько; по умолчанию все)")
+    parser.add_argument("--trace", action="append", default=[], help="файл трассы событий (JSON Lines)")
+    parser.add_argument("--raster", action="store_true", help="растровый режим отображения")
+    parser.add_argument("--output", help="файл результатов JSON (по умолчанию - стандартный вывод)")
+    parser.add_argument("--baseline", help="результаты прошлого запуска для сравнения")
+    parser.add_argument("--profile", metavar="DIR", help="профилировать сценарии и записать их трассы в каталог")
+    parser.add_argument("--dump-traces", metavar="DIR", help="записать трассы встроенных сценариев и выйти")
+    parser.add_argument("--child", help=argparse.SUPPRESS)  # Сценарий для выполнения в этом процессе
+    parser.add_argument("--child-trace", help=argparse.SUPPRESS)
+    parser.add_argument("--display-mode", default="vector", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:  # Дочерний процесс: выполняем один сценарий
+        events = load_trace(args.child_trace) if args.child_trace else SCENARIOS[args.child]()
+        json.dump(replay(args.child, events, args.display_mode, args.profile), sys.stdout, ensure_ascii=False)
+        return
+
+    if args.dump_traces:
+        os.makedirs(args.dump_traces, exist_ok=True)
+        for name, make_trace in SCENARIOS.items():
+            dump_trace(make_trace(), os.path.join(args.dump_traces, name + ".jsonl"))
+        return
+
+    display_mode = "raster" if args.raster else "vector"
+    runs = [(name, None) for name in (args.scenario or ([] if args.trace else list(SCENARIOS)))]
+    runs += [(os.path.splitext(os.path.basename(path))[0], path) for path in args.trace]
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    results = []
+    for name, path in runs:
+        result = run_child(name, path, display_mode, args.profile and os.path.abspath(args.profile))
+        results.append(result)
+        print("%-16s %8d событий  %9.0f событий/с  p99 %9.1f мкс  RSS %s КБ  элементов Tk %d" % (
+            name, result["events"], result["events_per_second"] or 0,
+            max(stats["p99_us"] for stats in result["latency"].values()), result["peak_rss_kb"],
+            result["tk_items"]), file=sys.stderr)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "display_mode": display_mode,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as stream:
+            json.dump(report, stream, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Микробенчмарк текста: размещает 1000 надписей через DrawingApp.place_text.
+
+Надписи повторяются (набор из --distinct разных подписей), как при расстановке пометок на схеме, поэтому
+шрифты и отрендеренные маски надписей берутся из кэша. Выводит время на надпись и статистику кэшей.
+
+Запуск: python benchmarks/bench_text.py [--labels 1000] [--distinct 20] [--size 14]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Корень репозитория
+
+import tk_stub  # noqa: E402
+
+tk_stub.install()  # Бенчмарк работает без дисплея
+
+import tkinter as tk  # noqa: E402
+import drawing_app  # noqa: E402
+import drawing_engine  # noqa: E402
+
+
+class Event:
+    """Событие мыши с координатами."""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--labels", type=int, default=1000, help="число надписей")
+    parser.add_argument("--distinct", type=int, default=20, help="число разных надписей")
+    parser.add_argument("--size", type=int, default=14, help="размер шрифта")
+    args = parser.parse_args()
+
+    app = drawing_app.DrawingApp(tk.Tk())
+    width, height = app.image.size
+    texts = ["Метка %d" % i for i in range(args.distinct)]
+    rng = random.Random(1)
+
+    times = []
+    for i in range(args.labels):
+        app.text_mode = True  # Каждая надпись - отдельный вход в режим текста, как в интерфейсе
+        app.entered_text = texts[i % len(texts)]
+        app.text_size = args.size
+        start = time.perf_counter()
+        app.place_text(Event(rng.randrange(width - 80), rng.randrange(height - 20)))
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    print("надписей: %d (разных: %d)" % (args.labels, len(texts)))
+    print("всего: %.1f мс, p50 %.1f мкс, p99 %.1f мкс на надпись" % (
+        sum(times) * 1e3, times[len(times) // 2] * 1e6, times[int(len(times) * 0.99)] * 1e6))
+    print("кэш шрифтов: %s" % (drawing_engine.load_font.cache_info(),))
+    print("кэш надписей: %s" % (drawing_engine.render_text_mask.cache_info(),))
+
+
+if __name__ == "__main__":
+    main()
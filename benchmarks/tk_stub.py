@@ -0,0 +1,148 @@
+"""
+Заглушка Tkinter для запуска бенчмарков без дисплея.
+
+Подменяет модули tkinter в sys.modules до импорта drawing_app. Виджеты ничего не рисуют,
+а холст (Canvas) только хранит свои элементы, чтобы бенчмарк мог считать их количество.
+Таймеры after() складываются в очередь и выполняются вызовом run_pending().
+"""
+import sys
+import types
+
+_pending = []  # Очередь отложенных вызовов after()/after_idle()
+
+
+class Interpreter:
+    """Интерпретатор Tcl-заглушка: команды (например, копирование в PhotoImage) ничего не делают."""
+
+    def call(self, *args):
+        return None
+
+
+class Widget:
+    """Виджет-заглушка: принимает любые параметры и игнорирует неизвестные методы."""
+
+    tk = Interpreter()  # Через него drawing_app и PIL.ImageTk обновляют картинки холста
+
+    def __init__(self, master=None, *args, **kwargs):
+        self.master = master  # Родительский виджет
+        self.options = dict(kwargs)  # Параметры виджета (config/cget)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None  # Любой неизвестный метод ничего не делает
+
+    def config(self, **kwargs):
+        """Обновляет параметры виджета."""
+        self.options.update(kwargs)
+
+    configure = config
+
+    def __getitem__(self, key):
+        return self.options.get(key, "")
+
+    def after(self, ms, func=None, *args):
+        """Откладывает вызов до следующего run_pending()."""
+        job = [func, args]  # Задание можно отменить, обнулив функцию
+        _pending.append(job)
+        return job
+
+    def after_idle(self, func, *args):
+        """Откладывает вызов до следующего run_pending()."""
+        return self.after(0, func, *args)
+
+    def after_cancel(self, job):
+        """Отменяет отложенный вызов."""
+        job[0] = None
+
+
+class Canvas(Widget):
+    """Холст-заглушка, хранящий свои элементы и их координаты."""
+
+    def __init__(self, master=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.items = {}  # Элементы холста: идентификатор -> координаты
+        self.next_id = 1  # Идентификатор следующего элемента
+
+    def _create(self, *coords, **kwargs):
+        item = self.next_id  # Выдаём новый идентификатор
+        self.next_id += 1
+        self.items[item] = list(coords)
+        return item
+
+    create_line = create_text = create_image = create_oval = create_rectangle = _create
+
+    def coords(self, item, *coords):
+        """Возвращает или меняет координаты элемента."""
+        if coords:
+            self.items[item] = list(coords)
+        return self.items.get(item, [])
+
+    def delete(self, tag):
+        """Удаляет элемент или все элементы холста."""
+        if tag == "all":
+            self.items.clear()
+        else:
+            self.items.pop(tag, None)
+
+    def canvasx(self, x):
+        """Холст-заглушка не прокручивается: координаты окна совпадают с координатами холста."""
+        return x
+
+    def canvasy(self, y):
+        """Холст-заглушка не прокручивается: координаты окна совпадают с координатами холста."""
+        return y
+
+    def find_all(self):
+        """Возвращает идентификаторы всех элементов холста."""
+        return tuple(self.items)
+
+
+class OptionMenu(Widget):
+    """Выпадающий список-заглушка: его меню ("menu") тоже заглушка."""
+
+    def __init__(self, master=None, variable=None, *values, **kwargs):
+        super().__init__(master, **kwargs)
+        self.menu = Widget(self)  # Меню списка
+
+    def __getitem__(self, key):
+        return self.menu if key == "menu" else super().__getitem__(key)
+
+
+class Variable:
+    """Переменная Tkinter-заглушка."""
+
+    def __init__(self, master=None, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+def run_pending():
+    """Выполняет все отложенные вызовы after(), включая запланированные во время выполнения."""
+    while _pending:
+        func, args = _pending.pop(0)
+        if func is not None:
+            func(*args)
+
+
+def install():
+    """Подменяет tkinter и его подмодули заглушками. Вызывать до импорта drawing_app."""
+    tk = types.ModuleType("tkinter")
+    for name in ("Tk", "Toplevel", "Frame", "LabelFrame", "Button", "Label", "Entry", "Scale", "Scrollbar",
+                 "Checkbutton", "Radiobutton", "PhotoImage"):
+        setattr(tk, name, type(name, (Widget,), {}))
+    tk.Canvas = Canvas
+    tk.OptionMenu = OptionMenu
+    tk.IntVar = tk.StringVar = tk.BooleanVar = tk.DoubleVar = Variable
+    for name in ("X", "Y", "BOTH", "LEFT", "RIGHT", "TOP", "BOTTOM", "HORIZONTAL", "VERTICAL", "ROUND", "NW"):
+        setattr(tk, name, name.lower())
+    tk.TRUE = True
+    sys.modules["tkinter"] = tk
+    for name in ("colorchooser", "filedialog", "messagebox", "simpledialog"):
+        module = types.ModuleType("tkinter." + name)
+        module.__getattr__ = lambda attr: (lambda *args, **kwargs: None)  # Диалоги ничего не возвращают
+        sys.modules["tkinter." + name] = module
+        setattr(tk, name, module)
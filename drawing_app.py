@@ -1,6 +1,20 @@
+import argparse
+import asyncio
+import concurrent.futures
+import math
+import os
+import queue
+import sys
+import time
 import tkinter as tk
-from tkinter import colorchooser, filedialog, messagebox, simpledialog
-from PIL import Image, ImageDraw, ImageFont
+from tkinter import colorchooser, filedialog, messagebox
+from PIL import ImageTk
+
+from drawing_engine import ANCHORS, RESAMPLING, DrawingEngine, History, HistoryStep, load_font, render_file
+from drawing_journal import Journal, claim_session, has_recovery, recover
+from drawing_profiler import Profiler
+from drawing_project import PROJECT_EXTENSION, ProjectCommands, load_project, write_project
+from drawing_session import DEFAULT_PORT, LAYER_OPS, SessionClient, SharedCanvas, serve
 
 
 class DrawingApp:
@@ -10,11 +24,13 @@ class DrawingApp:
     Позволяет пользователю рисовать на холсте, выбирать цвет и размер кисти,
     очищать холст, использовать ластик, сохранять рисунок в файл и изменять размер холста.
     Также добавлена пипетка для выбора цвета с холста. Есть возможность ввода текста и изменения фона изображения.
+    Рисунок состоит из слоев с прозрачностью поверх фона; ластик стирает активный слой до прозрачности.
 
     Атрибуты:
         root (tk.Tk): Главное окно приложения.
-        image (PIL.Image.Image): Изображение, на котором происходит рисование.
-        draw (PIL.ImageDraw.Draw): Объект для рисования на изображении.
+        engine (DrawingEngine): Движок рисования, не зависящий от интерфейса; выполняет команды рисования.
+        image (TiledImage): Сведенное изображение всех слоев на фоне (кэш движка); его показывают холст,
+            сохранение и пипетка.
         canvas (tk.Canvas): Холст Tkinter, на котором отображается рисунок.
         last_x (int): Координата X предыдущей точки.
         last_y (int): Координата Y предыдущей точки.
@@ -24,7 +40,6 @@ class DrawingApp:
         selected_size (tk.StringVar): Переменная Tkinter, хранящая текущий размер кисти (строковое представление).
         brush_size_menu (tk.OptionMenu): Выпадающий список для выбора размера кисти.
         eraser_mode (bool): Флаг, указывающий, активен ли режим ластика.
-        previous_color (str): Предыдущий цвет кисти (до активации ластика).
         mode_label (tk.Label): Метка, отображающая текущий режим (Кисть/Ластик).
         eraser_button (tk.Button): Кнопка включения/выключения ластика.
         eraser_indicator (tk.Canvas):  Круглый индикатор состояния ластика.
@@ -33,35 +48,155 @@ class DrawingApp:
         text_mode (bool): Флаг, указывающий, включен ли режим добавления текста.
         entered_text (str): Текст, введённый пользователем при активации режима "Текст".
         text_size (int): Размер шрифта, который пользователь выбирает при вводе текста.
+        stroke_item (int): Идентификатор полилинии Tk текущего штриха (None, если штрих не начат).
+        stroke_points (list): Плоский список координат текущей полилинии штриха.
+        pending_points (list): Точки, накопленные между кадрами и ещё не отрисованные.
+        pending_pressures (list): Нажим этих точек (0..1), вычисленный по скорости движения мыши.
+        frame_job (str): Идентификатор запланированной отрисовки кадра (None, если не запланирована).
+        stroke_width (int): Размер кисти, зафиксированный на время текущего штриха.
+        stroke_color (str): Цвет кисти, зафиксированный на время текущего штриха.
+        stroke_erase (bool): Флаг, что текущий штрих стирает (ластик), зафиксированный на время штриха.
+        stroke_opacity (float): Непрозрачность кисти (0..1), зафиксированная на время штриха.
+        stroke_pressure (bool): Флаг, что толщина и непрозрачность текущего штриха зависят от нажима.
+        stroke_items (bool): Флаг, что текущий штрих показывается элементом холста Tk.
+        display_mode (str): Способ отображения: "vector" (элементы Tk) или "raster" (одна картинка PhotoImage).
+        photo (tk.PhotoImage): Картинка холста: весь рисунок в растровом режиме, в векторном - подложка под
+            элементами холста для содержимого без элементов (например, восстановленного рисунка); иначе None.
+            Картинка размером с видимую часть холста и при прокрутке переносится вслед за ней.
+        photo_box (tuple): Область изображения (x0, y0, x1, y1), которую показывает картинка холста.
+        dirty_box (tuple): Область изображения, изменённая с прошлого кадра (None, если изменений нет).
+        history (History): История отмены и повтора действий.
+        step_tag (str): Тег элементов холста Tk текущего записываемого действия (None, если запись не ведётся).
+        save_executor (concurrent.futures.ThreadPoolExecutor): Поток фонового сохранения.
+        save_future (concurrent.futures.Future): Текущее фоновое сохранение (None, если сохранений не было).
+        save_progress (float): Доля выполненного фонового сохранения.
+        save_done (callable): Завершение сохранения в главном потоке (получает результат фоновой записи) или None.
+        save_options (dict): Последние выбранные параметры сжатия PNG.
+        status_label (tk.Label): Строка состояния под холстом (ход сохранения).
+        font_family (str): Семейство шрифта для текста на изображении.
+        font_warning_shown (bool): Флаг, показано ли уже предупреждение об отсутствии шрифта.
+        journal (Journal): Журнал операций для восстановления после сбоя (None, если автосохранение выключено).
+        autosave_job (str): Идентификатор запланированной контрольной точки автосохранения.
+        base_commands (collections.abc.Sequence): Команды открытого проекта (распаковываются при обращении).
+        commands (list): Команды, выполненные после открытия проекта; отменённые действия из них убираются.
+        raster_base (bool): Флаг, что рисунок начинается с изображения без команд (восстановленного после сбоя).
+        start_size (tuple): Размер холста перед первой командой рисунка (для воспроизведения команд проекта).
+        layer_var (tk.StringVar): Название активного слоя в выпадающем списке слоев.
+        layer_menu (tk.OptionMenu): Выпадающий список слоев.
+        layer_visible_var (tk.BooleanVar): Видимость активного слоя.
+        profiler (Profiler): Профилировщик обработчиков и кадров (None, если профилирование выключено).
+        trace_path (str): Файл, в который F12 записывает трассу профилирования.
+        input_time (int): Время (perf_counter_ns) первого события мыши, ещё не показанного кадром.
+        profile_label (tk.Label): Панель показателей профилирования поверх холста.
+        session (SessionClient): Соединение с сервером общего холста (None, если сеанса нет).
+        session_id (int): Номер участника в сеансе (None, пока сервер не прислал снимок холста).
+        shared (SharedCanvas): Рисунок сеанса в порядке журнала сервера (None, пока сервер не прислал снимок).
+        step_shared (SharedCanvas): Рисунок сеанса, в котором записывается текущее действие (None - запись в движке).
 
     """
 
-    def __init__(self, root):
+    FRAME_INTERVAL_MS = 16  # Интервал между кадрами отрисовки штриха (~60 кадров в секунду)
+    MAX_STROKE_POINTS = 1024  # Максимум координат в одной полилинии Tk, после него начинается новая
+    PRESSURE_SPEED = 40  # Смещение мыши между событиями (пикселей), при котором нажим наименьший
+    MIN_PRESSURE = 0.2  # Наименьший нажим
+    MAX_CANVAS_SIZE = 100000  # Максимальная ширина и высота холста
+    VIEW_MAX_SIZE = (1200, 800)  # Максимальный размер видимой части холста, остальное прокручивается
+    AUTOSAVE_INTERVAL_MS = 60000  # Интервал между контрольными точками автосохранения
+    OVERLAY_INTERVAL_MS = 500  # Интервал обновления панели показателей профилирования
+    PROFILED_CALLS = ("paint", "reset", "place_text", "pick_color", "region_click", "undo", "redo", "clear_canvas",
+                      "save_image", "start_save", "start_project_save", "open_project", "apply_resize",
+                      "change_background", "render_frame", "flush_stroke", "flush_display", "execute",
+                      "compress_history", "autosave",
+                      "poll_session")  # Обработчики и этапы кадра, которые замеряет профилировщик
+
+    def __init__(self, root, display_mode="vector", history_budget_mb=64, autosave_dir=None, profiler=None,
+                 trace_path="drawing_trace.json"):
         """
         Инициализирует приложение DrawingApp.
+        Аргумент display_mode - "vector", чтобы рисовать элементами холста Tk, или "raster", чтобы показывать
+        изображение PIL одной картинкой и обновлять в ней только изменённые области.
+        Аргумент history_budget_mb ограничивает память истории отмены (в мегабайтах).
+        Аргумент autosave_dir - каталог журнала операций для восстановления после сбоя (None - без журнала).
+        Аргумент profiler - Profiler, если нужно замерять обработчики и кадры и показывать панель показателей;
+        trace_path - файл, в который F12 записывает трассу.
         """
         self.root = root
         self.root.title("Рисовалка с сохранением в PNG")
 
-        self.image = Image.new("RGB", (850, 500), "white")  # Создаем новое изображение PIL белого цвета
-        self.draw = ImageDraw.Draw(self.image)  # Создаем объект ImageDraw для рисования на изображении
-
-        self.canvas = tk.Canvas(root, width=850, height=500, bg='white')  # Создаем холст Tkinter
-        self.canvas.pack()  # Размещаем холст в окне
+        self.engine = DrawingEngine((850, 500), "white")  # Создаем движок с белым изображением из плиток
+
+        canvas_frame = tk.Frame(root)  # Фрейм для холста и полос прокрутки
+        canvas_frame.pack()  # Размещаем фрейм в окне
+        self.canvas = tk.Canvas(canvas_frame, width=850, height=500, bg='white',
+                                scrollregion=(0, 0, 850, 500))  # Создаем холст Tkinter
+        x_scroll = tk.Scrollbar(canvas_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)  # Прокрутка по X
+        y_scroll = tk.Scrollbar(canvas_frame, orient=tk.VERTICAL, command=self.canvas.yview)  # Прокрутка по Y
+        self.canvas.config(xscrollcommand=lambda *args: self.scrolled(x_scroll, *args),
+                           yscrollcommand=lambda *args: self.scrolled(y_scroll, *args))  # Связываем их с холстом
+        self.canvas.grid(row=0, column=0)  # Размещаем холст во фрейме
+        y_scroll.grid(row=0, column=1, sticky="ns")  # Вертикальная прокрутка справа от холста
+        x_scroll.grid(row=1, column=0, sticky="ew")  # Горизонтальная прокрутка под холстом
+
+        self.display_mode = display_mode  # Способ отображения рисунка
+        self.history = History(history_budget_mb * 1024 * 1024)  # История отмены с ограничением памяти
+        self.step_tag = None  # Действие для истории пока не записывается
+        self.step_count = 0  # Счетчик действий для тегов элементов холста
+        self.compress_job = None  # Запланированное сжатие истории отмены
+        self.save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # Поток фонового сохранения
+        self.save_future = None  # Фоновое сохранение еще не запускалось
+        self.save_progress = 0.0  # Доля выполненного сохранения
+        self.save_done = None  # Сохранению изображения завершение не нужно
+        self.save_options = {"compress_level": 6, "optimize": False}  # Параметры сжатия PNG по умолчанию
+        self.frame_job = None  # Запланированная отрисовка кадра
+        self.base_commands = []  # Команды открытого проекта
+        self.commands = []  # Команды рисунка для сохранения проекта
+        self.raster_base = False  # Рисунок начинается с чистого холста
+        self.start_size = self.image.size  # Команды рисунка начинаются с начального размера холста
+        self.session = None  # Общего холста нет
+        self.session_id = None
+        self.session_job = None
+        self.shared = None
+        self.step_shared = None
+        self.setup_display()  # Создаем картинку холста для растрового режима
+
+        self.profiler = profiler  # Профилирование включено, если передан профилировщик
+        self.trace_path = trace_path
+        self.input_time = None  # Непоказанных событий мыши нет
+        if profiler is not None:  # Обработчики заменяются замеряющими до их привязки к событиям
+            self.instrument()
 
         self.setup_ui()  # Настраиваем пользовательский интерфейс
+        if profiler is not None:
+            self.setup_profile_overlay()
 
         self.last_x, self.last_y = None, None  # Инициализируем координаты предыдущей точки (None, None в начале
         # рисования)
         self.pen_color = 'black'  # Инициализируем цвет пера (по умолчанию черный)
         self.eraser_mode = False  # Инициализируем флаг режима ластика (по умолчанию выключен)
-        self.previous_color = self.pen_color  # Инициализируем предыдущий цвет
         self.mode_label_fg = "black"  # Инициализация цвета текста метки режима
         self.update_mode_label_color()  # Обновляем цвет текста метки режима
 
         self.text_mode = False  # Инициализируем флаг режима текста
         self.entered_text = None  # Инициализируем текст, введенный пользователем
         self.text_size = 12  # Размер шрифта по умолчанию
+        self.font_family = "arial"  # Семейство шрифта по умолчанию
+        self.font_warning_shown = False  # Предупреждение об отсутствии шрифта ещё не показывалось
+
+        self.region_tool = None  # Инструмент по щелчку: "fill" (заливка), "select" (похожий цвет) или None
+        self.selection = None  # Аргументы команды "fill", задающие выделенную область (None - выделения нет)
+
+        self.stroke_item = None  # Полилиния Tk текущего штриха (None, пока штрих не начат)
+        self.stroke_points = []  # Координаты текущей полилинии штриха
+        self.pending_points = []  # Точки, пришедшие между кадрами и ещё не отрисованные
+        self.pending_pressures = []  # Нажим этих точек
+        self.stroke_pressures = []  # Нажим последней отрисованной точки штриха
+        self.stroke_width = self.brush_size_var.get()  # Размер кисти текущего штриха
+        self.stroke_opacity = 1.0  # Непрозрачность кисти текущего штриха
+        self.stroke_pressure = False  # Нажим текущего штриха не учитывается
+        self.stroke_start = False  # Начат ли новый штрих, ещё не переданный движку
+        self.stroke_color = self.pen_color  # Цвет кисти текущего штриха
+        self.stroke_erase = False  # Текущий штрих рисует, а не стирает
+        self.stroke_items = False  # Элемент холста для штриха создается в начале штриха
 
         self.canvas.bind('<B1-Motion>',
                          self.paint)  # Привязываем событие движения мыши с зажатой левой кнопкой к методу paint
@@ -69,6 +204,31 @@ class DrawingApp:
                          self.reset)  # Привязываем событие отпускания левой кнопки мыши к методу reset
         self.canvas.bind('<Button-3>', self.pick_color)  # Привязываем правую кнопку мыши к pick_color
 
+        self.journal = None  # Журнал операций создается после проверки незавершенного сеанса
+        self.autosave_job = None  # Контрольная точка автосохранения еще не запланирована
+        if autosave_dir is not None:
+            self.start_journal(autosave_dir)  # Предлагаем восстановить рисунок и начинаем журнал
+        self.root.protocol("WM_DELETE_WINDOW", self.close)  # При закрытии окна удаляем автосохранение
+
+    @property
+    def image(self):
+        """Изображение, на котором происходит рисование."""
+        return self.engine.image
+
+    def execute(self, command):
+        """
+        Выполняет команду рисования в движке, добавляет её в журнал операций и передает участникам сеанса.
+        Возвращает результат движка.
+        """
+        layer = self.engine.active  # Слой, на котором рисует команда
+        result = self.engine.apply(command) if self.shared is None else self.shared.execute(command)
+        self.commands.append(command)  # Команда станет частью проекта
+        if self.journal is not None:
+            self.journal.append(command)
+        if self.session_id is not None:  # Команду получат остальные участники
+            self.session.send(command, layer)
+        return result
+
     def setup_ui(self):
         """
         Настраивает пользовательский интерфейс приложения.
@@ -87,6 +247,9 @@ class DrawingApp:
         save_button = tk.Button(control_frame, text="Сохранить", command=self.save_image)  # Создаем кнопку "Сохранить"
         save_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
 
+        open_button = tk.Button(control_frame, text="Открыть", command=self.open_project)  # Создаем кнопку "Открыть"
+        open_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
+
         resize_button = tk.Button(control_frame, text="Изменить размер",
                                   command=self.resize_canvas)  # Создаем кнопку "Изменить размер"
         resize_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
@@ -98,6 +261,12 @@ class DrawingApp:
         text_button = tk.Button(control_frame, text="Текст", command=self.start_text_mode)  # Создаем кнопку "Текст"
         text_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
 
+        undo_button = tk.Button(control_frame, text="Отменить", command=self.undo)  # Создаем кнопку "Отменить"
+        undo_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
+
+        redo_button = tk.Button(control_frame, text="Повторить", command=self.redo)  # Создаем кнопку "Повторить"
+        redo_button.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем кнопку слева с отступами
+
         eraser_frame = tk.LabelFrame(control_frame, text="Выбор режима",
                                      height=50)  # Создаем рамку для элементов управления ластиком
         eraser_frame.pack(side=tk.LEFT, padx=5, pady=5,
@@ -135,6 +304,45 @@ class DrawingApp:
         self.brush_size_menu.config(width=3)  # Устанавливаем ширину выпадающего списка
         self.brush_size_menu.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем список слева с отступами
 
+        self.opacity_var = tk.IntVar(value=100)  # Непрозрачность кисти в процентах
+        opacity_scale = tk.Scale(brush_size_frame, from_=10, to=100, orient=tk.HORIZONTAL, label="Непрозр., %",
+                                 variable=self.opacity_var)  # Шкала непрозрачности кисти
+        opacity_scale.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем шкалу слева с отступами
+
+        self.pressure_var = tk.BooleanVar(value=False)  # Учитывать ли нажим
+        pressure_check = tk.Checkbutton(brush_size_frame, text="Нажим", variable=self.pressure_var)  # Флажок нажима
+        pressure_check.pack(side=tk.LEFT, padx=2, pady=5)  # Размещаем флажок слева
+
+        layer_frame = tk.LabelFrame(control_frame, text="Слои", height=50)  # Создаем рамку для управления слоями
+        layer_frame.pack(side=tk.LEFT, padx=5, pady=5, fill=tk.Y)  # Размещаем рамку слева
+
+        self.layer_var = tk.StringVar(value="Слой 1")  # Создаем переменную с названием активного слоя
+        self.layer_menu = tk.OptionMenu(layer_frame, self.layer_var, "Слой 1")  # Выпадающий список слоев
+        self.layer_menu.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем список слева с отступами
+
+        add_layer_button = tk.Button(layer_frame, text="+", command=self.add_layer)  # Кнопка добавления слоя
+        add_layer_button.pack(side=tk.LEFT, padx=2, pady=5)  # Размещаем кнопку слева
+
+        fill_frame = tk.LabelFrame(control_frame, text="Заливка", height=50)  # Создаем рамку для заливки и выделения
+        fill_frame.pack(side=tk.LEFT, padx=5, pady=5, fill=tk.Y)  # Размещаем рамку слева
+
+        fill_button = tk.Button(fill_frame, text="Заливка",
+                                command=lambda: self.set_region_tool("fill"))  # Кнопка инструмента заливки
+        fill_button.pack(side=tk.LEFT, padx=2, pady=5)  # Размещаем кнопку слева
+        select_button = tk.Button(fill_frame, text="Похожий цвет",
+                                  command=lambda: self.set_region_tool("select"))  # Кнопка выделения похожего цвета
+        select_button.pack(side=tk.LEFT, padx=2, pady=5)  # Размещаем кнопку слева
+
+        self.tolerance_var = tk.IntVar(value=32)  # Допуск цвета для заливки и выделения
+        tolerance_scale = tk.Scale(fill_frame, from_=0, to=255, orient=tk.HORIZONTAL,
+                                   variable=self.tolerance_var)  # Шкала допуска цвета
+        tolerance_scale.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем шкалу слева с отступами
+
+        self.layer_visible_var = tk.BooleanVar(value=True)  # Видимость активного слоя
+        layer_visible_check = tk.Checkbutton(layer_frame, text="Виден", variable=self.layer_visible_var,
+                                             command=self.toggle_layer_visibility)  # Флажок видимости слоя
+        layer_visible_check.pack(side=tk.LEFT, padx=2, pady=5)  # Размещаем флажок слева
+
         self.mode_label = tk.Label(eraser_frame, text="Режим: Кисть")  # Создаем метку для отображения текущего режима
         self.mode_label.pack(side=tk.LEFT, padx=5, pady=5)  # Размещаем метку слева с отступами
 
@@ -144,8 +352,16 @@ class DrawingApp:
         self.brush_color_indicator.create_oval(2, 2, 12, 12, fill='black', outline='black',
                                                tags="indicator_brush")  # Рисуем черный кружок
 
+        self.status_label = tk.Label(self.root, text="", anchor="w")  # Создаем строку состояния
+        self.status_label.pack(fill=tk.X)  # Размещаем её под элементами управления
+
         self.root.bind('<Control-s>', self.save_image)  # Привязываем Ctrl+s к функции сохранения изображения
+        self.root.bind('<Control-o>', self.open_project)  # Привязываем Ctrl+o к открытию проекта
         self.root.bind('<Control-c>', self.choose_color)  # Привязываем Ctrl+c к функции выбора цвета
+        self.root.bind('<Control-z>', self.undo)  # Привязываем Ctrl+z к отмене действия
+        self.root.bind('<Control-y>', self.redo)  # Привязываем Ctrl+y к повтору действия
+        self.root.bind('<Delete>', self.delete_selection)  # Привязываем Delete к стиранию выделения
+        self.root.bind('<Escape>', self.drop_selection)  # Привязываем Escape к снятию выделения
 
     def update_menu_from_scale(self, value):
         """Обновляет значение в выпадающем списке при изменении значения шкалы."""
@@ -156,37 +372,639 @@ class DrawingApp:
         self.brush_size_var.set(int(value))  # Устанавливаем значение размера кисти
 
     def paint(self, event):
-        """Рисует линию на холсте и на изображении PIL при движении мыши."""
-        if self.text_mode:  # Если включен режим добавления текста, не рисуем
+        """
+        Добавляет точку к текущему штриху при движении мыши.
+        Сама отрисовка откладывается до следующего кадра (render_frame), поэтому события движения,
+        пришедшие между кадрами, объединяются в одно обновление холста и изображения PIL.
+        """
+        if self.text_mode or self.region_tool:  # Если включен режим текста или заливки, не рисуем
             return
 
-        if self.last_x and self.last_y:  # Если есть предыдущие координаты
-            self.canvas.create_line(self.last_x, self.last_y, event.x, event.y,
-                                    width=self.brush_size_var.get(),  # Используем текущий размер кисти
-                                    fill=self.pen_color,
-                                    capstyle=tk.ROUND, smooth=tk.TRUE)  # Рисуем линию на холсте
-            self.draw.line([self.last_x, self.last_y, event.x, event.y], fill=self.pen_color,
-                           width=self.brush_size_var.get())  # Рисуем линию на изображении PIL
+        x, y = self.event_coords(event)  # Координаты точки на холсте с учетом прокрутки
+        if self.last_x is None:  # Первая точка штриха - полный нажим
+            pressure = 1.0
+        else:  # Чем быстрее движется мышь, тем слабее нажим, как у пера
+            pressure = max(self.MIN_PRESSURE, 1.0 - math.hypot(x - self.last_x, y - self.last_y) / self.PRESSURE_SPEED)
+        self.pending_points.extend((x, y))  # Запоминаем точку до следующего кадра
+        self.pending_pressures.append(round(pressure, 2))
+        if self.profiler is not None and self.input_time is None:  # Задержку ввода считаем от первого события
+            self.input_time = time.perf_counter_ns()
+        self.last_x = x  # Обновляем координаты предыдущей точки
+        self.last_y = y
+        self.schedule_frame()  # Планируем отрисовку кадра
+
+    def event_coords(self, event):
+        """Переводит координаты события мыши в координаты холста с учетом прокрутки."""
+        return int(self.canvas.canvasx(event.x)), int(self.canvas.canvasy(event.y))
+
+    def setup_display(self):
+        """
+        В растровом режиме создает на холсте единственную картинку, показывающую self.image.
+        В векторном режиме картинка не нужна: рисунок состоит из элементов холста Tk.
+        """
+        self.dirty_box = None  # Изменённых областей пока нет
+        self.photo = None  # Картинки холста пока нет
+        if self.display_mode == "raster":  # Если включен растровый режим
+            self.create_photo()
 
-        self.last_x = event.x  # Обновляем координаты предыдущей точки
-        self.last_y = event.y
+    def create_photo(self):
+        """
+        Создает картинку холста размером с видимую часть холста под всеми элементами холста и заполняет её
+        в следующем кадре. Картинка не больше VIEW_MAX_SIZE при любом размере холста: при прокрутке она
+        переносится в новую видимую часть (update_view). В векторном режиме она служит подложкой
+        для содержимого, у которого нет элементов холста.
+        """
+        self.photo_box = self.view_box()  # Картинка показывает видимую часть холста
+        x0, y0, x1, y1 = self.photo_box
+        self.photo = tk.PhotoImage(width=x1 - x0, height=y1 - y0)  # Пустая картинка Tk
+        self.photo_item = self.canvas.create_image(x0, y0, image=self.photo, anchor=tk.NW,
+                                                   tags="display")  # Показываем её на холсте
+        self.canvas.tag_lower("display")  # Элементы холста остаются поверх картинки
+        self.mark_dirty(self.photo_box)  # Заполняем картинку при первом кадре
+
+    def view_box(self):
+        """Возвращает видимую часть холста (x0, y0, x1, y1) с учетом прокрутки."""
+        width, height = min(self.image.width, self.VIEW_MAX_SIZE[0]), min(self.image.height, self.VIEW_MAX_SIZE[1])
+        x0 = max(0, min(int(self.canvas.canvasx(0)), self.image.width - width))  # Левый верхний угол видимой части
+        y0 = max(0, min(int(self.canvas.canvasy(0)), self.image.height - height))
+        return x0, y0, x0 + width, y0 + height
+
+    def scrolled(self, scrollbar, *args):
+        """Обновляет полосу прокрутки scrollbar после прокрутки холста и переносит картинку холста."""
+        scrollbar.set(*args)
+        self.update_view()
+
+    def update_view(self):
+        """
+        Переносит картинку холста в видимую часть холста (после прокрутки или смены размера холста)
+        и заполняет её в следующем кадре. Обновляется только видимая часть, поэтому стоимость не зависит
+        от размера холста.
+        """
+        if self.photo is None:
+            return
+        box = self.view_box()
+        if box == self.photo_box:  # Видимая часть не изменилась
+            return
+        self.photo_box = box
+        self.photo.configure(width=box[2] - box[0], height=box[3] - box[1])
+        self.canvas.coords(self.photo_item, box[0], box[1])
+        self.dirty_box = None  # Прежние изменения вне новой видимой части не нужны
+        self.mark_dirty(box)
+
+    def show_backdrop(self):
+        """Показывает изображение картинкой холста заново (после замены изображения или его размера)."""
+        if self.photo is not None:  # Старая картинка может быть другого размера
+            self.canvas.delete("display")
+        self.dirty_box = None  # Новая картинка заполняется целиком
+        self.create_photo()
+
+    def flatten_view(self):
+        """
+        В векторном режиме заменяет элементы холста картинкой сведенного изображения. Нужна, когда действие
+        нельзя показать элементом поверх остальных: стирание до прозрачности, рисование под верхним слоем,
+        скрытие слоя. Новые штрихи на верхнем слое снова рисуются элементами поверх картинки.
+        """
+        if self.photo is not None and self.canvas.find_all() == self.canvas.find_withtag("display"):
+            return  # Элементов нет - холст уже показывает картинку
+        self.canvas.delete("all")  # Картинка покажет всё, что было нарисовано элементами
+        self.photo = None
+        self.create_photo()
+
+    def prepare_items(self, erase=False):
+        """
+        Проверяет, можно ли показать действие элементом холста Tk: только в векторном режиме и только кистью
+        на верхнем слое. Если нельзя, в векторном режиме переходит к картинке изображения (flatten_view).
+        """
+        if self.display_mode == "raster":  # В растровом режиме элементов нет
+            return False
+        if not erase and self.engine.active == len(self.engine.layers) - 1:
+            return True
+        self.flatten_view()
+        return False
+
+    def schedule_frame(self):
+        """Планирует отрисовку кадра, если она ещё не запланирована."""
+        if self.frame_job is None:  # Если кадр ещё не запланирован
+            self.frame_job = self.root.after(self.FRAME_INTERVAL_MS, self.render_frame)  # Планируем его
+
+    def render_frame(self):
+        """Отрисовывает кадр: накопленные точки штриха и изменённые области растровой картинки."""
+        if self.frame_job is not None:  # Если кадр был запланирован
+            self.root.after_cancel(self.frame_job)  # Отменяем таймер (при вызове не по таймеру)
+            self.frame_job = None
+        queued = len(self.pending_pressures)  # События мыши, объединённые в этот кадр
+        self.flush_stroke()  # Рисуем накопленные точки штриха
+        self.flush_display()  # Переносим изменённые области изображения на экран
+        if self.profiler is not None:
+            self.profile_frame(queued)
+
+    def mark_dirty(self, box):
+        """
+        Добавляет область box = (x0, y0, x1, y1) к изменённым за кадр и планирует отрисовку.
+        Изменения вне видимой части не запоминаются: она обновится целиком при прокрутке (update_view).
+        """
+        if self.photo is None:  # В векторном режиме без подложки изменения уже показаны элементами холста
+            return
+        left, top, right, bottom = self.photo_box  # Ограничиваем область видимой частью изображения
+        box = (max(left, int(box[0])), max(top, int(box[1])), min(right, int(box[2]) + 1),
+               min(bottom, int(box[3]) + 1))
+        if box[0] >= box[2] or box[1] >= box[3]:  # Если область вне видимой части, обновлять нечего
+            return
+        if self.dirty_box is not None:  # Если уже есть изменённая область, объединяем с ней
+            box = (min(box[0], self.dirty_box[0]), min(box[1], self.dirty_box[1]),
+                   max(box[2], self.dirty_box[2]), max(box[3], self.dirty_box[3]))
+        self.dirty_box = box  # Запоминаем общую изменённую область
+        self.schedule_frame()  # Планируем отрисовку кадра
+
+    def flush_display(self):
+        """
+        Копирует изменённую область изображения в картинку холста по плиткам.
+        Копируется только dirty_box (в пределах видимой части), поэтому стоимость кадра зависит от площади
+        изменений, а не от всего рисунка. Области, где плиток нет, просто заливаются цветом фона.
+        """
+        if self.dirty_box is None:  # Если изменений нет, обновлять нечего
+            return
+        size = self.image.TILE_SIZE
+        left, top = self.photo_box[:2]  # Положение картинки холста на изображении
+        for tx, ty in self.image.tile_keys(self.dirty_box):  # Обновляем изменённую область по плиткам
+            x0, y0 = max(self.dirty_box[0], tx * size), max(self.dirty_box[1], ty * size)  # Часть области в плитке
+            x1, y1 = min(self.dirty_box[2], (tx + 1) * size), min(self.dirty_box[3], (ty + 1) * size)
+            tile = self.image.get_tile((tx, ty))
+            if tile is None:  # Плитки нет - заливаем часть цветом фона
+                color = "#{:02x}{:02x}{:02x}".format(*self.image.color[:3])
+                self.canvas.tk.call(str(self.photo), "put", color, "-to", x0 - left, y0 - top, x1 - left, y1 - top)
+            else:  # Иначе копируем изменённую часть плитки
+                patch = ImageTk.PhotoImage(tile.crop((x0 - tx * size, y0 - ty * size,
+                                                      x1 - tx * size, y1 - ty * size)))  # Картинка Tk части плитки
+                self.canvas.tk.call(str(self.photo), "copy", str(patch), "-to", x0 - left,
+                                    y0 - top)  # Копируем её на холст
+        self.dirty_box = None  # Изменения показаны
+
+    def flush_stroke(self):
+        """
+        Отрисовывает точки, накопленные с прошлого кадра.
+        На холсте Tk штрих - это одна растущая полилиния, которая продлевается через coords;
+        на изображении PIL новые точки рисуются одним вызовом draw.line.
+        """
+        if not self.pending_points:  # Если новых точек нет, рисовать нечего
+            return
+
+        if not self.stroke_points:  # Если штрих только начинается
+            self.stroke_width = self.brush_size_var.get()  # Фиксируем размер кисти на весь штрих
+            self.stroke_color = self.pen_color  # Фиксируем цвет кисти на весь штрих
+            self.stroke_erase = self.eraser_mode  # Ластик стирает слой до прозрачности
+            self.stroke_opacity = self.opacity_var.get() / 100  # Фиксируем непрозрачность и нажим на весь штрих
+            self.stroke_pressure = self.pressure_var.get()
+            self.stroke_start = True
+            translucent = not self.stroke_erase and (self.stroke_opacity < 1 or self.stroke_pressure)
+            self.stroke_items = self.prepare_items(self.stroke_erase or translucent)  # Можно ли показать элементом Tk
+            self.begin_step()  # Штрих - одно действие в истории отмены
+
+        new_points = self.pending_points  # Точки, пришедшие с прошлого кадра
+        self.pending_points = []  # Очищаем очередь точек
+        segment = self.stroke_points[-2:] + new_points  # Новые точки вместе с последней отрисованной
+        pressures = self.stroke_pressures[-1:] + self.pending_pressures  # Нажим этих точек
+        self.pending_pressures = []
+        self.stroke_pressures = pressures[-1:]
+        if len(segment) >= 4 and self.stroke_erase:  # Стираем новые точки на активном слое
+            self.mark_dirty(self.execute({"op": "erase", "points": segment, "width": self.stroke_width}))
+        elif len(segment) >= 4:  # Линию можно нарисовать только по двум и более точкам
+            command = {"op": "line", "points": segment, "color": self.stroke_color, "width": self.stroke_width}
+            if self.stroke_opacity < 1:  # Параметры кисти передаются, только если они нужны
+                command["opacity"] = self.stroke_opacity
+            if self.stroke_pressure:
+                command["pressures"] = pressures
+            if len(command) > 4 and self.stroke_start:  # Полупрозрачный штрих накапливается движком с начала
+                command["start"] = True
+            self.stroke_start = False
+            box = self.execute(command)  # Рисуем новые точки на изображении мазками кисти
+            self.mark_dirty(box)  # Обновляем изменённую область
+        if not self.stroke_items:  # Штрих покажет картинка холста, элементы холста Tk не создаются
+            self.stroke_points = segment[-2:]  # Достаточно помнить последнюю точку
+            return
+
+        if len(self.stroke_points) + len(new_points) > self.MAX_STROKE_POINTS:  # Если полилиния стала слишком длинной
+            self.stroke_item = None  # Начинаем новую полилинию, чтобы coords не передавал в Tk весь штрих
+            self.stroke_points = self.stroke_points[-2:]  # Новая полилиния продолжает старую с последней точки
+        self.stroke_points.extend(new_points)  # Добавляем новые точки к полилинии
+
+        if self.stroke_item is not None:  # Если полилиния уже есть на холсте
+            self.canvas.coords(self.stroke_item, *self.stroke_points)  # Продлеваем её
+        elif len(self.stroke_points) >= 4:  # Иначе создаём её, как только набралось две точки
+            self.stroke_item = self.canvas.create_line(*self.stroke_points,
+                                                       width=self.stroke_width,  # Размер кисти штриха
+                                                       fill=self.stroke_color,
+                                                       capstyle=tk.ROUND, joinstyle=tk.ROUND,
+                                                       smooth=tk.TRUE,
+                                                       tags=self.step_tag)  # Рисуем полилинию на холсте
 
     def reset(self, event):
-        """Сбрасывает координаты предыдущей точки."""
+        """Завершает текущий штрих: дорисовывает накопленные точки и сбрасывает координаты предыдущей точки."""
+        self.render_frame()  # Дорисовываем оставшиеся точки штриха, не дожидаясь кадра
+        self.end_stroke()  # Завершаем штрих
+        self.commit_step()  # Записываем штрих в историю отмены
+        if self.journal is not None:  # Законченный штрих сразу сбрасываем на диск
+            self.journal.flush()
+
+    def end_stroke(self):
+        """Забывает текущий штрих, не дорисовывая его (например, когда холст очищается)."""
+        self.stroke_item = None  # Следующий штрих начнёт новую полилинию
+        self.stroke_points = []  # Очищаем координаты штриха
+        self.pending_points = []  # Очищаем очередь точек
+        self.pending_pressures = []
+        self.stroke_pressures = []
         self.last_x, self.last_y = None, None  # Сбрасываем координаты
 
     def clear_canvas(self):
-        """Очищает холст и создает новое белое изображение."""
-        self.canvas.delete("all")  # Очищаем холст
-        self.image = Image.new("RGB", (850, 500), "white")  # Создаем новое изображение PIL
-        self.draw = ImageDraw.Draw(self.image)  # Создаем объект для рисования на изображении
+        """Очищает холст и изображение, заливая его белым цветом."""
+        self.end_stroke()  # Забываем незавершённый штрих
+        self.commit_step()  # Уже нарисованная часть штриха остается отдельным действием
+        self.begin_step(shows_items=False)  # Очистка скрывает элементы холста, чтобы её можно было отменить
+        self.execute({"op": "clear"})  # Удаляем все плитки изображения
+        self.mark_dirty((0, 0) + self.image.size)  # Обновляем картинку холста целиком
+        if self.display_mode != "raster":  # В векторном режиме скрываем элементы холста
+            self.hide_all_items(self.step_tag)
+        self.commit_step()  # Записываем очистку в историю отмены
+
+    def hide_all_items(self, tag):
+        """
+        Помечает тегом tag все видимые элементы холста и скрывает их (они удалятся, когда отмена станет невозможной).
+        Элементы, уже скрытые прежней очисткой, помечены тегом "cleared" и в действие не входят: иначе отмена
+        этой очистки показала бы и их.
+        """
+        # Картинку холста не скрываем: она сама покажет очищенное изображение
+        self.canvas.addtag_withtag(tag, "all && !cleared && !display")  # Помечаем видимые элементы тегом действия
+        self.canvas.addtag_withtag("cleared", tag)
+        self.canvas.itemconfigure(tag, state="hidden")  # Скрываем их
+
+    def begin_step(self, shows_items=True):
+        """
+        Начинает запись действия для истории отмены: запоминает состояние холста и включает запись плиток.
+        Аргумент shows_items - добавляет ли действие элементы холста со своим тегом (True) или скрывает их (False).
+        """
+        self.drop_selection()  # Действие меняет рисунок - выделение устаревает
+        for step in self.history.drop_redo():  # После нового действия повторять отменённые нельзя
+            if step.shows_items:  # Элементы отменённых действий скрыты и больше не понадобятся
+                self.canvas.delete(step.tag)
+        self.step_count += 1  # Новый тег для элементов действия
+        self.step_tag = "step%d" % self.step_count
+        self.step_shows_items = shows_items  # Добавляет или скрывает действие элементы холста
+        self.step_state = self.capture_state()  # Состояние холста до действия
+        self.step_start = len(self.commands)  # Команды действия начнутся с этого места
+        self.step_shared = self.shared
+        if self.shared is not None:  # На общем холсте шаг - заплатки своих команд, без чужих операций
+            self.shared.begin_step()
+        else:
+            self.engine.begin_changes()  # Запоминаем плитки слоев до их первого изменения
+
+    def commit_step(self):
+        """Заканчивает запись действия и добавляет его в историю отмены (если действие что-то изменило)."""
+        if self.step_tag is None:  # Если действие не записывается, добавлять нечего
+            return
+        if self.step_shared is not None:
+            step = HistoryStep(self.step_shared.end_step(), self.step_state, self.step_tag, self.step_shows_items,
+                               self.commands[self.step_start:], patch=True)
+        else:
+            step = HistoryStep(self.engine.end_changes(), self.step_state, self.step_tag, self.step_shows_items,
+                               self.commands[self.step_start:])
+        self.step_shared = None
+        self.step_tag = None  # Запись закончена
+        if not step.tiles and step.state == self.capture_state():  # Действие ничего не изменило
+            del self.commands[self.step_start:]  # Его команды не нужны и в проекте
+            return
+        for old in self.history.push(step):  # Самые старые шаги вытесняются при нехватке памяти
+            self.forget_step(old)
+        self.schedule_history_compression()  # Плитки шага сожмутся в свободное время
+        if self.journal is not None and self.journal.needs_checkpoint:  # Журнал вырос - сворачиваем его
+            self.checkpoint()
+
+    def schedule_history_compression(self):
+        """Планирует сжатие плиток истории отмены на время, когда приложение простаивает."""
+        if self.compress_job is None:
+            self.compress_job = self.root.after_idle(self.compress_history)
+
+    def compress_history(self):
+        """Сжимает несколько плиток истории отмены и, если осталось ещё, планирует продолжение."""
+        self.compress_job = None
+        if self.history.compress_some():
+            self.schedule_history_compression()
+
+    def forget_step(self, step):
+        """Удаляет элементы холста, которые были скрыты шагом, если этот шаг больше нельзя отменить."""
+        if not step.shows_items:
+            self.canvas.delete(step.tag)
+
+    def capture_state(self):
+        """Возвращает состояние холста вне плиток: размер изображения, цвет фона, видимость слоев и активный слой."""
+        return self.engine.capture_state()
+
+    def restore_state(self, state):
+        """Восстанавливает состояние холста, сохраненное capture_state, и обновляет по нему холст Tk."""
+        old_state = self.capture_state()  # Состояние до восстановления
+        self.engine.restore_state(state)  # Восстанавливаем состояние движка
+        self.show_state(old_state)
+
+    def show_state(self, old_state):
+        """Обновляет холст Tk и элементы управления после изменения состояния холста (old_state - прежнее)."""
+        state = self.capture_state()
+        self.update_layer_controls()  # Слои могли добавиться, исчезнуть или поменять видимость
+        if state["background"] != old_state["background"] or state["layers"] != old_state["layers"]:
+            self.mark_dirty((0, 0) + self.image.size)  # Сведенное изображение изменилось не только в плитках шага
+        self.canvas.config(bg=state["background"])  # Цвет фона холста Tk
+        if state["size"] != old_state["size"]:  # Если изменился размер, перестраиваем холст
+            self.update_canvas_size()
+            if self.photo is not None:  # Картинка холста должна быть нового размера
+                self.show_backdrop()
+
+    def apply_step(self, step, redo):
+        """
+        Возвращает холст в состояние шага step (при отмене redo=False, при повторе redo=True).
+        Восстанавливаются только плитки шага, поэтому время зависит от площади действия. Шаг общего холста
+        накладывает заплатки и сам передается участникам сеанса как операция.
+        Возвращает обратный шаг с текущим состоянием холста.
+        """
+        self.drop_selection()  # Выделение относится к рисунку до восстановления
+        state = self.capture_state()  # Состояние холста до восстановления
+        if step.patch and self.shared is not None:
+            tiles = self.shared.patch(step.state, step.tiles)
+            self.engine.active = min(step.state["active"], len(self.engine.layers) - 1)  # Свой активный слой
+            self.show_state(state)
+            self.session.send_patch(step.state, dict(step.tiles))
+        else:
+            self.restore_state(step.state)  # Сначала состояние: восстанавливаемые плитки могут быть в добавленном слое
+            tiles = self.engine.patch_tiles(step.tiles) if step.patch else self.engine.restore_tiles(step.tiles)
+        inverse = HistoryStep(tiles, state, step.tag, step.shows_items, step.commands, step.patch)
+        if redo:  # Команды действия возвращаются в рисунок или убираются из него (это всегда последние команды)
+            self.commands.extend(step.commands)
+        else:
+            del self.commands[len(self.commands) - len(step.commands):]
+        for _, tx, ty in step.tiles:  # Обновляем восстановленные плитки на картинке холста в следующем кадре
+            self.mark_dirty(self.image.tile_box((tx, ty)))
+        if self.display_mode != "raster":  # В векторном режиме показываем или скрываем элементы действия
+            self.canvas.itemconfigure(step.tag, state="normal" if step.shows_items == redo else "hidden")
+            if not step.shows_items and redo:  # Повторённая очистка снова скрывает свои элементы
+                self.canvas.addtag_withtag("cleared", step.tag)
+            elif not step.shows_items:  # Отменённая очистка: её элементы снова видны
+                self.canvas.dtag(step.tag, "cleared")
+        if self.journal is not None:  # В журнал попадает результат: восстановленные плитки и состояние
+            if step.patch:  # Заплатка меняет часть плитки - в журнал идет плитка целиком
+                restored = {key: self.engine.layers[key[0]].image.keep_tile(key[1:]) for key in tiles}
+            else:
+                restored = dict(step.tiles)
+            self.journal.append_tiles(restored, step.state)
+        return inverse
+
+    def undo(self, event=None):
+        """Отменяет последнее действие."""
+        self.reset(event)  # Завершаем штрих, если кнопка мыши еще нажата
+        step = self.history.pop_undo()  # Последнее действие
+        if step is not None:
+            self.history.push_redo(self.apply_step(step, redo=False))  # Отменённое действие можно повторить
+            self.schedule_history_compression()  # Обратный шаг сожмется в свободное время
+
+    def redo(self, event=None):
+        """Повторяет последнее отменённое действие."""
+        step = self.history.pop_redo()  # Последнее отменённое действие
+        if step is not None:
+            for old in self.history.push(self.apply_step(step, redo=True)):  # Повторённое действие снова отменяемо
+                self.forget_step(old)
+            self.schedule_history_compression()  # Обратный шаг сожмется в свободное время
+
+    def start_journal(self, directory):
+        """
+        Начинает журнал операций в своем подкаталоге каталога directory. Если там остался сеанс, владелец
+        которого завершился аварийно, предлагает восстановить рисунок; сеансы других работающих экземпляров
+        программы не затрагиваются.
+        """
+        session, lock = claim_session(directory)  # Брошенный сеанс с данными или новый подкаталог
+        if has_recovery(session) and messagebox.askyesno(
+                "Восстановление", "Предыдущий сеанс завершился некорректно. Восстановить рисунок?"):
+            try:
+                recover(session, self.engine)  # Контрольная точка и журнал после неё
+            except (OSError, ValueError) as error:
+                messagebox.showerror("Ошибка", "Не удалось восстановить рисунок:\n%s" % error)
+            else:
+                state = self.capture_state()
+                self.canvas.config(bg=state["background"])  # Цвет фона холста Tk
+                self.update_canvas_size()  # Размер холста по восстановленному изображению
+                self.update_layer_controls()  # Слои восстановленного рисунка
+                self.show_backdrop()  # У восстановленного рисунка нет элементов холста - показываем его картинкой
+                self.raster_base = True  # Команд восстановленного рисунка нет, в проекте он сохранится растром
+                self.start_size = self.image.size
+                self.journal = Journal(session, self.engine.layer_snapshots(), state, lock)  # Контрольная точка
+        if self.journal is None:  # Новый сеанс начинается с чистого холста
+            self.journal = Journal(session, lock=lock)
+        self.schedule_autosave()
+
+    def checkpoint(self):
+        """Передает журналу снимки слоев для контрольной точки; после неё журнал начинается заново."""
+        self.journal.checkpoint(self.engine.layer_snapshots(), self.capture_state())
+
+    def schedule_autosave(self):
+        """Планирует следующую контрольную точку автосохранения."""
+        self.autosave_job = self.root.after(self.AUTOSAVE_INTERVAL_MS, self.autosave)
+
+    def autosave(self):
+        """Записывает контрольную точку, если журнал изменился и штрих не рисуется, и планирует следующую."""
+        if self.journal.error is not None:  # После ошибки записи журнал не ведется
+            self.status_label.config(text="Автосохранение отключено: %s" % self.journal.error)
+            return
+        if self.journal.journal_bytes and not self.stroke_points:
+            self.checkpoint()
+        self.schedule_autosave()
+
+    def close(self):
+        """Закрывает приложение: рисунок сохранен или не нужен, поэтому журнал операций удаляется."""
+        if self.autosave_job is not None:
+            self.root.after_cancel(self.autosave_job)
+        if self.journal is not None:
+            self.journal.close(discard=True)
+        if self.profiler is not None and self.profile_job is not None:
+            self.root.after_cancel(self.profile_job)
+        if self.session is not None:
+            self.session.close()
+        self.root.destroy()
+
+    def instrument(self):
+        """Заменяет обработчики и этапы кадра из PROFILED_CALLS версиями, которые замеряет профилировщик."""
+        for name in self.PROFILED_CALLS:
+            setattr(self, name, self.profiler.wrap(name, getattr(self, name)))
+
+    def setup_profile_overlay(self):
+        """Создает панель показателей поверх холста, привязывает F12 к записи трассы и запускает обновление панели."""
+        self.profile_label = tk.Label(self.canvas, text="", justify=tk.LEFT, bg="#ffffe0",
+                                      font=("TkFixedFont", 8))  # Панель в левом верхнем углу холста
+        self.profile_label.place(x=4, y=4)
+        self.profile_bases = {}  # Снимки гистограмм при прошлом обновлении панели
+        self.profile_job = None
+        self.root.bind('<F12>', self.dump_profile_trace)  # Привязываем F12 к записи трассы
+        self.update_profile_overlay()
+
+    def profile_frame(self, queued):
+        """
+        Записывает в профилировщик время перерисовки Tk, задержку ввода (от первого ещё не показанного события
+        мыши до конца кадра) и число событий мыши queued, объединённых в кадр. Обычно Tk перерисовывает окно
+        после обработчика; при профилировании перерисовка вызывается сразу (update_idletasks), чтобы её замерить.
+        """
+        start = time.perf_counter_ns()
+        self.root.update_idletasks()  # Перерисовка холста Tk
+        end = time.perf_counter_ns()
+        self.profiler.record("tk_redraw", start, end)
+        if self.input_time is not None:
+            self.profiler.histogram("input_latency").add((end - self.input_time) // 1000)
+            self.input_time = None
+        if queued:
+            self.profiler.histogram("queued_events", unit="").add(queued)
+
+    def recent_percentile(self, name, fraction):
+        """Возвращает процентиль гистограммы name по замерам с прошлого обновления панели (None, если их нет)."""
+        histogram = self.profiler.histograms.get(name)
+        if histogram is None:  # Замеров ещё не было
+            return None
+        value = histogram.percentile(fraction, self.profile_bases.get(name))
+        self.profile_bases[name] = histogram.snapshot()
+        return value
+
+    def update_profile_overlay(self):
+        """Обновляет панель показателей: время кадра, задержку ввода, очередь событий, элементы холста и память."""
+        profiler = self.profiler
+        profiler.gauge("canvas_items", len(self.canvas.find_all()))  # Число элементов холста Tk
+        profiler.gauge("image_mb", round(self.engine.nbytes / 2 ** 20, 1))  # Память плиток изображения
+        profiler.gauge("history_mb", round(self.history.nbytes / 2 ** 20, 1))  # Память истории отмены
+        frame = self.recent_percentile("render_frame", 0.99)
+        latency = self.recent_percentile("input_latency", 0.99)
+        queued = self.recent_percentile("queued_events", 1.0)
+
+        def ms(value):
+            return "-" if value is None else "%.1f мс" % (value / 1000)
+
+        self.profile_label.config(text="кадр p99: %s  ввод p99: %s  событий в кадре: %s\n"
+                                       "элементов Tk: %d  изображение: %.1f МБ  история: %.1f МБ" % (
+                                           ms(frame), ms(latency), "-" if queued is None else "%d" % queued,
+                                           profiler.gauges["canvas_items"], profiler.gauges["image_mb"],
+                                           profiler.gauges["history_mb"]))
+        self.profile_job = self.root.after(self.OVERLAY_INTERVAL_MS, self.update_profile_overlay)
+
+    def dump_profile_trace(self, event=None):
+        """Записывает трассу профилирования в файл trace_path (формат Chrome Trace Event)."""
+        try:
+            self.profiler.dump_trace(self.trace_path)
+        except OSError as error:
+            messagebox.showerror("Ошибка", "Не удалось записать трассу: %s" % error)  # Показываем ошибку
+            return
+        self.status_label.config(text="Трасса записана: %s" % self.trace_path)
+
+    def open_project(self, event=None):
+        """
+        Открывает файл проекта: рисунок показывается сразу из растрового кэша, а команды проекта читаются
+        из файла только при сохранении. Открытие начинает новую историю отмены.
+        """
+        file_path = filedialog.askopenfilename(filetypes=[('Проект рисовалки', '*' + PROJECT_EXTENSION)],
+                                               title="Открыть проект")  # Диалог открытия файла
+        if not file_path:
+            return
+        try:
+            project = load_project(file_path)
+        except (OSError, ValueError) as error:
+            messagebox.showerror("Ошибка", "Не удалось открыть проект: %s" % error)  # Показываем ошибку
+            return
+        self.load_raster(project.state, project.tiles)
+        self.base_commands = project.commands  # Команды проекта распакуются при сохранении
+        self.commands = []
+        self.raster_base = project.raster_base
+        self.start_size = project.start_size
+        if self.journal is not None:  # Открытый рисунок - новая основа журнала
+            self.checkpoint()
+
+    def load_raster(self, state, tiles):
+        """
+        Заменяет рисунок состоянием холста state и плитками слоев tiles: (слой, tx, ty) -> сжатые байты.
+        История отмены начинается заново, рисунок показывается картинкой холста.
+        """
+        self.end_stroke()  # Забываем незавершённый штрих
+        self.commit_step()
+        self.history.clear()  # Действия прежнего рисунка больше нельзя отменить
+        self.canvas.delete("all")  # Элементы прежнего рисунка больше не нужны
+        self.photo = None
+        self.restore_state(state)  # Размер, фон и слои нового рисунка
+        self.engine.clear()  # Плитки прежнего рисунка
+        self.engine.restore_tiles(tiles)  # Плитки слоев нового рисунка
+        self.update_canvas_size()
+        self.show_backdrop()  # У нового рисунка нет элементов холста - показываем его картинкой
+
+    def join_session(self, host, port, name=""):
+        """
+        Подключается к серверу общего холста host:port. Когда сервер пришлет снимок, рисунок заменится рисунком
+        сеанса; после этого свои команды передаются участникам, а их команды показываются на холсте.
+        """
+        self.session = SessionClient(host, port, name)
+        self.status_label.config(text="Подключение к %s:%d..." % (host, port))
+        self.poll_session()
+
+    def poll_session(self):
+        """Применяет всё, что пришло от сервера сеанса с прошлого вызова, и планирует следующую проверку."""
+        self.session_job = None
+        operations = []  # Операции журнала сеанса, выполняемые вместе: свои откатываются один раз
+        while True:
+            try:
+                message = self.session.incoming.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] in ("ops", "patch"):
+                operations.append((message[0], message[1], message[3] if message[0] == "ops" else message[3:]))
+                continue
+            if operations:
+                self.apply_session(operations)
+                operations = []
+            if message[0] == "welcome":  # Снимок холста сеанса заменяет рисунок
+                _, self.session_id, state, tiles = message
+                self.load_raster(state, tiles)
+                self.base_commands = []
+                self.commands = []
+                self.raster_base = True  # Рисунок сеанса начинается со снимка, а не с команд
+                self.start_size = self.image.size
+                self.shared = SharedCanvas(self.engine, self.session_id)
+                if self.journal is not None:  # Снимок - новая основа журнала
+                    self.checkpoint()
+                self.status_label.config(text="Сеанс: участник %d" % self.session_id)
+            else:  # Соединение закрыто
+                self.session = None
+                self.session_id = None
+                self.shared = None  # Неподтвержденные команды остаются на рисунке
+                self.status_label.config(text="Сеанс завершён%s" % ("" if message[1] is None else ": %s" % message[1]))
+                return
+        if operations:
+            self.apply_session(operations)
+        self.session_job = self.root.after(self.FRAME_INTERVAL_MS, self.poll_session)
+
+    def apply_session(self, operations):
+        """
+        Выполняет операции журнала сеанса operations: (вид, отправитель, данные) (SharedCanvas.receive).
+        Штрихи, текст и заливка участников показываются обновлением изменённых областей картинки холста;
+        стирание, очистка, смена фона, размера и слоев, отмена и повтор не видны поверх элементов холста Tk,
+        поэтому в векторном режиме холст сначала переходит к картинке (flatten_view).
+        Операции участников не попадают в историю отмены, журнал и команды проекта: рисунок сеанса хранит сервер.
+        """
+        remote = [(kind, payload) for kind, sender, payload in operations if sender != self.session_id]
+        if remote:
+            self.drop_selection()  # Рисунок изменился - выделение устаревает
+            if any(kind == "patch" or any(command.get("op") not in LAYER_OPS or command["op"] == "erase"
+                                          for command in payload) for kind, payload in remote):
+                self.flatten_view()
+            elif self.photo is None:  # Чужое рисование показывает картинка холста под элементами
+                self.create_photo()
+        old_state = self.capture_state()
+        boxes = self.shared.receive(operations)
+        if self.capture_state() != old_state:
+            self.show_state(old_state)
+        for box in boxes:
+            self.mark_dirty(box)
 
     def choose_color(self, event=None):
         """Открывает диалог выбора цвета и обновляет текущий цвет кисти."""
         chosen_color = colorchooser.askcolor(color=self.pen_color)[1]  # Открываем диалог выбора цвета
         if chosen_color:  # Если цвет выбран
             self.pen_color = chosen_color  # Обновляем цвет кисти
-            self.previous_color = self.pen_color  # Обновляем предыдущий цвет
             self.eraser_mode = False  # Выключаем режим ластика
             self.update_mode_label()  # Обновляем метку режима
             self.update_eraser_indicator()  # Обновляем индикатор ластика
@@ -194,30 +1012,182 @@ class DrawingApp:
             self.update_mode_label_color()  # Обновляем цвет метки режима
 
     def save_image(self, event=None):
-        """Открывает диалог сохранения файла и сохраняет изображение в формате PNG."""
+        """
+        Открывает диалог сохранения файла и сохраняет изображение в фоновом потоке.
+        Для PNG дополнительно спрашивает уровень сжатия; TIFF без сжатия и WebP без потерь сохраняются быстрее.
+        Файл проекта (.drw) сохраняет рисунок редактируемым: вместе с командами рисования.
+        """
+        if self.save_future is not None and not self.save_future.done():  # Если предыдущее сохранение не закончено
+            messagebox.showwarning("Внимание", "Предыдущее сохранение еще не закончено.")  # Показываем предупреждение
+            return
         file_path = filedialog.asksaveasfilename(defaultextension='.png',  # Расширение по умолчанию
-                                                 filetypes=[('PNG files', '*.png')],  # Типы файлов
+                                                 filetypes=[('PNG files', '*.png'),
+                                                            ('TIFF без сжатия', '*.tif *.tiff'),
+                                                            ('WebP без потерь', '*.webp'),
+                                                            ('Проект рисовалки',
+                                                             '*' + PROJECT_EXTENSION)],  # Типы файлов
                                                  title="Сохранить изображение как")  # Заголовок диалога
         if file_path:  # Если путь к файлу выбран
-            self.image.save(file_path)  # Сохраняем изображение
+            if file_path.lower().endswith('.png'):  # Для PNG спрашиваем параметры сжатия
+                self.open_save_options_dialog(lambda level, optimize: self.start_save(file_path, level, optimize))
+            elif file_path.lower().endswith(PROJECT_EXTENSION):  # Проект сохраняется вместе с командами
+                self.start_project_save(file_path)
+            else:
+                self.start_save(file_path)  # Сохраняем в выбранном формате
+
+    def open_save_options_dialog(self, callback):
+        """
+        Открывает диалоговое окно параметров сжатия PNG.
+        Аргумент callback - функция, которая будет вызвана с уровнем сжатия и флагом оптимизации.
+        """
+        dialog = tk.Toplevel(self.root)  # Создаем диалоговое окно
+        dialog.title("Параметры сохранения PNG")  # Устанавливаем заголовок диалога
+
+        level_label = tk.Label(dialog, text="Уровень сжатия:")  # Создаем метку для шкалы уровня сжатия
+        level_label.grid(row=0, column=0, padx=5, pady=5)  # Размещаем метку в диалоге
+        level_var = tk.IntVar(value=self.save_options["compress_level"])  # Переменная уровня сжатия
+        level_scale = tk.Scale(dialog, from_=0, to=9, orient=tk.HORIZONTAL, variable=level_var)  # Шкала 0-9
+        level_scale.grid(row=0, column=1, padx=5, pady=5)  # Размещаем шкалу в диалоге
+
+        optimize_var = tk.BooleanVar(value=self.save_options["optimize"])  # Переменная флага оптимизации
+        optimize_check = tk.Checkbutton(dialog, text="Оптимизировать (меньше файл, дольше сохранение)",
+                                        variable=optimize_var)  # Создаем флажок оптимизации
+        optimize_check.grid(row=1, column=0, columnspan=2, padx=5, pady=5)  # Размещаем флажок в диалоге
+
+        def apply_and_close():
+            """Запоминает выбранные параметры, закрывает диалог и запускает сохранение."""
+            self.save_options = {"compress_level": level_var.get(), "optimize": optimize_var.get()}
+            dialog.destroy()  # Закрываем диалоговое окно
+            callback(self.save_options["compress_level"], self.save_options["optimize"])
+
+        save_button = tk.Button(dialog, text="Сохранить", command=apply_and_close)  # Создаем кнопку "Сохранить"
+        save_button.grid(row=2, column=0, columnspan=2, padx=5, pady=5)  # Размещаем кнопку в диалоге
+
+    def start_save(self, file_path, compress_level=6, optimize=False):
+        """
+        Запускает сохранение снимка изображения в фоновом потоке.
+        Снимок не копирует пиксели (плитки копируются только при следующем изменении), поэтому рисовать
+        можно, не дожидаясь конца сохранения.
+        """
+        self.render_frame()  # Дорисовываем точки текущего штриха, чтобы они попали в файл
+        snapshot = self.image.snapshot()  # Снимок изображения на момент сохранения
+        self.save_progress = 0.0
+
+        def save_snapshot(*args):
+            try:
+                snapshot.save(*args)
+            finally:
+                snapshot.release()  # Снимок прочитан - его плитки и слоты подкачки больше не нужны
+        save = save_snapshot if self.profiler is None else self.profiler.wrap("save_worker", save_snapshot)
+        self.save_done = None
+        self.save_future = self.save_executor.submit(save, file_path, None, compress_level, optimize,
+                                                     self.set_save_progress)  # Сохраняем в фоновом потоке
+        self.poll_save()  # Следим за ходом сохранения
+
+    def start_project_save(self, file_path):
+        """
+        Запускает сохранение проекта (команды и снимки слоев как растровый кэш) в фоновом потоке.
+        Проект пишется во временный файл, а прежний файл заменяет finish_project_save.
+        """
+        self.render_frame()  # Дорисовываем точки текущего штриха, чтобы они попали в файл
+        base = self.base_commands  # Основа читается из файла открытого проекта в фоновом потоке
+        self.save_progress = 0.0
+        save = write_project if self.profiler is None else self.profiler.wrap("project_save_worker", write_project)
+        self.save_future = self.save_executor.submit(save, file_path + ".tmp", self.engine.layer_snapshots(),
+                                                     self.capture_state(), list(self.commands), self.start_size,
+                                                     self.raster_base, self.set_save_progress,
+                                                     base)  # Сохраняем в фоновом потоке
+        self.save_done = lambda count: self.finish_project_save(file_path, base, count)
+        self.poll_save()  # Следим за ходом сохранения
+
+    def finish_project_save(self, file_path, base, count):
+        """
+        Заканчивает сохранение проекта в главном потоке: закрывает отображение файла, из которого читалась
+        основа команд base, заменяет файл file_path записанным временным и читает основу (первые count команд)
+        уже из нового файла. Иначе новый файл заменял бы отображенный в память (в Windows это невозможно),
+        а следующее сохранение читало бы основу из замененного файла.
+        """
+        if isinstance(base, ProjectCommands):
+            base.project.close()
+        try:
+            os.replace(file_path + ".tmp", file_path)
+        except OSError:
+            if isinstance(base, ProjectCommands) and base is self.base_commands:  # Основа остается в прежнем файле
+                self.base_commands = load_project(base.project.path).base_commands(len(base))
+            raise
+        if base is self.base_commands:  # Пока шло сохранение, другой рисунок не открывался
+            self.base_commands = load_project(file_path).base_commands(count) if count else []
+
+    def set_save_progress(self, fraction):
+        """Запоминает долю выполненного сохранения (вызывается из фонового потока)."""
+        self.save_progress = fraction
+
+    def poll_save(self):
+        """Показывает ход фонового сохранения в строке состояния и сообщает о его завершении."""
+        if not self.save_future.done():  # Сохранение еще идет - проверим снова позже
+            self.status_label.config(text="Сохранение... %d%%" % (self.save_progress * 100))
+            self.root.after(100, self.poll_save)
+            return
+        self.status_label.config(text="")  # Очищаем строку состояния
+        error = self.save_future.exception()  # Ошибка сохранения (None, если сохранение прошло успешно)
+        if error is None and self.save_done is not None:
+            try:
+                self.save_done(self.save_future.result())
+            except (OSError, ValueError) as finish_error:
+                error = finish_error
+        if error is not None:
+            messagebox.showerror("Ошибка", "Не удалось сохранить изображение: %s" % error)  # Показываем ошибку
+        else:
             messagebox.showinfo("Информация", "Изображение успешно сохранено!")  # Показываем сообщение
 
+    def add_layer(self):
+        """Добавляет новый слой поверх остальных и делает его активным."""
+        self.begin_step()  # Добавление слоя можно отменить
+        self.execute({"op": "add_layer"})
+        self.commit_step()
+        self.update_layer_controls()
+
+    def select_layer(self, index):
+        """Делает активным слой index (выбор из выпадающего списка слоев)."""
+        if index != self.engine.active:
+            self.begin_step()  # Выбор слоя входит в историю, чтобы отмена возвращала и слой рисования
+            self.execute({"op": "select_layer", "index": index})
+            self.commit_step()
+        self.update_layer_controls()
+
+    def toggle_layer_visibility(self):
+        """Показывает или скрывает активный слой (флажок "Виден")."""
+        self.prepare_items(erase=True)  # Видимость слоя элементами холста не показать
+        self.begin_step()  # Видимость слоя можно отменить
+        box = self.execute({"op": "layer_visibility", "index": self.engine.active,
+                            "visible": self.layer_visible_var.get()})
+        if box is not None:  # Сведенное изображение меняется только в плитках слоя
+            self.mark_dirty(box)
+        self.commit_step()
+
+    def update_layer_controls(self):
+        """Обновляет список слоев и флажок видимости по слоям движка."""
+        menu = self.layer_menu["menu"]
+        menu.delete(0, "end")  # Заполняем список слоев заново
+        for index in range(len(self.engine.layers)):
+            menu.add_command(label="Слой %d" % (index + 1), command=lambda index=index: self.select_layer(index))
+        self.layer_var.set("Слой %d" % (self.engine.active + 1))
+        self.layer_visible_var.set(self.engine.layers[self.engine.active].visible)
+
     def toggle_eraser(self):
-        """Переключает режим ластика."""
+        """Переключает режим ластика. Ластик стирает до прозрачности, поэтому цвет кисти не меняется."""
         self.eraser_mode = not self.eraser_mode  # Инвертируем режим ластика
-        if self.eraser_mode:  # Если включен режим ластика
-            self.previous_color = self.pen_color  # Сохраняем текущий цвет кисти
-            self.pen_color = self.canvas['bg']  # Устанавливаем цвет ластика равным цвету фона
-        else:  # Если выключен режим ластика
-            self.pen_color = self.previous_color  # Восстанавливаем предыдущий цвет кисти
         self.update_mode_label()  # Обновляем метку режима
         self.update_eraser_indicator()  # Обновляем индикатор ластика
-        self.update_brush_color_indicator()  # Обновляем индикатор цвета кисти
         self.update_mode_label_color()  # Обновляем цвет метки режима
 
     def update_mode_label(self):
-        """Обновляет текст метки режима в зависимости от значения self.eraser_mode."""
-        if self.eraser_mode:  # Если включен режим ластика
+        """Обновляет текст метки режима в зависимости от инструмента self.region_tool и значения self.eraser_mode."""
+        if self.region_tool == "fill":  # Если включена заливка
+            self.mode_label.config(text="Режим: Заливка")  # Устанавливаем текст метки "Режим: Заливка"
+        elif self.region_tool == "select":  # Если включено выделение похожего цвета
+            self.mode_label.config(text="Режим: Выделение")  # Устанавливаем текст метки "Режим: Выделение"
+        elif self.eraser_mode:  # Если включен режим ластика
             self.mode_label.config(text="Режим: Ластик")  # Устанавливаем текст метки "Режим: Ластик"
         else:  # Если выключен режим ластика
             self.mode_label.config(text="Режим: Кисть")  # Устанавливаем текст метки "Режим: Кисть"
@@ -225,8 +1195,8 @@ class DrawingApp:
     def update_eraser_indicator(self):
         """Обновляет цвет индикатора ластика."""
         if self.eraser_mode:  # Если включен режим ластика
-            self.eraser_indicator.itemconfig("indicator", fill=self.pen_color,
-                                             outline="black")  # Устанавливаем цвет индикатора равным цвету ластика
+            self.eraser_indicator.itemconfig("indicator", fill="white",
+                                             outline="black")  # Ластик не связан ни с цветом кисти, ни с фоном
         else:  # Если выключен режим ластика
             self.eraser_indicator.itemconfig("indicator", fill="gray",
                                              outline="gray")  # Устанавливаем серый цвет индикатора
@@ -236,16 +1206,15 @@ class DrawingApp:
         Выбирает цвет пикселя на холсте под курсором мыши (правая кнопка).
         Устанавливает цвет кисти равным цвету выбранного пикселя.
         """
-        x, y = event.x, event.y  # Получаем координаты клика
+        x, y = self.event_coords(event)  # Получаем координаты клика
         try:
-            rgb = self.image.getpixel((x, y))  # Получаем RGB цвет пикселя из изображения PIL
+            rgb = self.image.getpixel((x, y))  # Получаем RGB цвет пикселя из изображения
             hex_color = "#{:02x}{:02x}{:02x}".format(*rgb)  # Преобразуем RGB в HEX
         except IndexError:
             messagebox.showwarning("Внимание", "Вы кликнули за пределами холста!")  # Показываем предупреждение
             return  # Прерываем выполнение, чтобы избежать ошибки
 
         self.pen_color = hex_color  # Устанавливаем цвет кисти равным выбранному цвету
-        self.previous_color = self.pen_color  # Обновляем предыдущий цвет кисти
         self.eraser_mode = False  # Выключаем режим ластика
         self.update_mode_label()  # Обновляем метку режима
         self.update_eraser_indicator()  # Обновляем индикатор ластика
@@ -267,29 +1236,162 @@ class DrawingApp:
         self.mode_label.config(foreground=self.mode_label_fg)  # Применяем цвет текста к метке
 
     def resize_canvas(self):
-        """Открывает диалоговое окно для ввода новых размеров холста и обновляет холст."""
-        new_width = simpledialog.askinteger("Изменение размера", "Введите новую ширину холста:", minvalue=100,
-                                            maxvalue=2000)  # Запрашиваем новую ширину холста
-        new_height = simpledialog.askinteger("Изменение размера", "Введите новую высоту холста:", minvalue=100,
-                                             maxvalue=2000)  # Запрашиваем новую высоту холста
-        if new_width is not None and new_height is not None:  # Если размеры введены
-            self.canvas.config(width=new_width, height=new_height)  # Устанавливаем новые размеры холста
-            self.image = Image.new("RGB", (new_width, new_height), "white")  # Создаем новое изображение PIL
-            self.draw = ImageDraw.Draw(self.image)  # Создаем объект для рисования на изображении
-            self.canvas.delete("all")  # Очищаем холст
+        """Открывает диалоговое окно для ввода новых размеров холста и изменяет размер, сохраняя рисунок."""
+        self.open_resize_dialog(self.apply_resize)
+
+    def open_resize_dialog(self, callback):
+        """
+        Открывает диалоговое окно нового размера холста: ширина, высота, положение рисунка и масштабирование.
+        Аргумент callback - функция, которая будет вызвана с шириной, высотой, положением (ключ ANCHORS),
+        флагом масштабирования и фильтром (ключ RESAMPLING).
+        """
+        dialog = tk.Toplevel(self.root)  # Создаем диалоговое окно
+        dialog.title("Изменение размера")  # Устанавливаем заголовок диалога
+
+        entries = []  # Поля ввода ширины и высоты
+        for row, (text, value) in enumerate((("Ширина:", self.image.width), ("Высота:", self.image.height))):
+            label = tk.Label(dialog, text=text)  # Создаем метку поля ввода
+            label.grid(row=row, column=0, padx=5, pady=5)  # Размещаем метку в диалоге
+            entry = tk.Entry(dialog)  # Создаем поле ввода
+            entry.insert(0, str(value))  # По умолчанию - текущий размер
+            entry.grid(row=row, column=1, padx=5, pady=5)  # Размещаем поле ввода в диалоге
+            entries.append(entry)
+
+        anchor_label = tk.Label(dialog, text="Положение рисунка:")  # Создаем метку выбора положения
+        anchor_label.grid(row=2, column=0, padx=5, pady=5)  # Размещаем метку в диалоге
+        anchor_var = tk.StringVar(value="nw")  # По умолчанию рисунок остается в левом верхнем углу
+        anchor_menu = tk.OptionMenu(dialog, anchor_var, *ANCHORS)  # Выпадающий список положений
+        anchor_menu.grid(row=2, column=1, padx=5, pady=5)  # Размещаем список в диалоге
+
+        scale_var = tk.BooleanVar(value=False)  # Флаг масштабирования рисунка
+        scale_check = tk.Checkbutton(dialog, text="Масштабировать рисунок", variable=scale_var)  # Флажок
+        scale_check.grid(row=3, column=0, padx=5, pady=5)  # Размещаем флажок в диалоге
+        resample_var = tk.StringVar(value="bicubic")  # Фильтр масштабирования по умолчанию
+        resample_menu = tk.OptionMenu(dialog, resample_var, *RESAMPLING)  # Выпадающий список фильтров
+        resample_menu.grid(row=3, column=1, padx=5, pady=5)  # Размещаем список в диалоге
+
+        def apply_and_close():
+            """Проверяет введенный размер, закрывает диалог и изменяет размер холста."""
+            try:
+                width, height = int(entries[0].get()), int(entries[1].get())  # Получаем введенный размер
+            except ValueError:
+                messagebox.showerror("Ошибка", "Неверный формат размера. Введите целые числа.")  # Показываем ошибку
+                return
+            if not (100 <= width <= self.MAX_CANVAS_SIZE and 100 <= height <= self.MAX_CANVAS_SIZE):
+                messagebox.showwarning("Внимание", "Размер должен быть от 100 до %d." % self.MAX_CANVAS_SIZE)
+                return
+            dialog.destroy()  # Закрываем диалоговое окно
+            callback(width, height, anchor_var.get(), scale_var.get(), resample_var.get())
+
+        apply_button = tk.Button(dialog, text="Применить", command=apply_and_close)  # Создаем кнопку "Применить"
+        apply_button.grid(row=4, column=0, columnspan=2, padx=5, pady=5)  # Размещаем кнопку в диалоге
+
+    def apply_resize(self, width, height, anchor="nw", scale=False, resample="bicubic"):
+        """
+        Изменяет размер холста, сохраняя рисунок (см. DrawingEngine.resize), и обновляет холст Tk по частям:
+        без сдвига и масштабирования картинка холста только дополняется новыми полосами.
+        """
+        moved = scale or anchor != "nw"  # Сдвигается или масштабируется ли рисунок
+        self.end_stroke()  # Забываем незавершённый штрих
+        self.commit_step()  # Уже нарисованная часть штриха остается отдельным действием
+        if moved:  # Сдвинутый рисунок показывает картинка холста, элементы холста Tk не переносятся
+            self.prepare_items(erase=True)
+        old_size = self.image.size  # Размер до изменения
+        self.begin_step()  # Изменение размера можно отменить
+        self.execute({"op": "resize", "width": width, "height": height, "anchor": anchor, "scale": scale,
+                      "resample": resample})  # Плитки переносятся, а не перерисовываются
+        self.update_canvas_size()  # Устанавливаем новые размеры холста и видимую часть картинки холста
+        if self.photo is not None:
+            if moved:  # Рисунок сдвинулся - обновляем всю картинку
+                self.mark_dirty((0, 0, width, height))
+            else:  # Обновляем только полосы справа и снизу (с крайними плитками, где мог остаться старый край)
+                size = self.image.TILE_SIZE
+                self.mark_dirty((min(old_size[0], width) // size * size, 0, width, height))
+                self.flush_display()  # Полосы обновляются отдельно, чтобы не объединять их в весь холст
+                self.mark_dirty((0, min(old_size[1], height) // size * size, width, height))
+        self.commit_step()  # Записываем изменение размера в историю отмены
+
+    def update_canvas_size(self):
+        """Устанавливает размеры холста Tk и области прокрутки по размеру изображения."""
+        width, height = self.image.size
+        self.canvas.config(width=min(width, self.VIEW_MAX_SIZE[0]), height=min(height, self.VIEW_MAX_SIZE[1]),
+                           scrollregion=(0, 0, width, height))
+        self.update_view()  # Видимая часть могла измениться вместе с размером
 
     def change_background(self):
         """
         Открывает диалоговое окно для выбора цвета и изменяет фон холста.
-        Если ластик был включен, сразу меняем цвет ластика на новый цвет фона.
         """
         chosen_color = colorchooser.askcolor(color=self.canvas['bg'])[1]  # Открываем диалог выбора цвета
         if chosen_color:  # Если цвет выбран
+            self.begin_step()  # Смену фона можно отменить
+            self.mark_dirty(self.execute({"op": "background", "color": chosen_color}))  # Фон под всеми слоями
             self.canvas.config(bg=chosen_color)  # Устанавливаем новый цвет фона холста
-            if self.eraser_mode:  # Если включен режим ластика
-                self.pen_color = chosen_color  # Устанавливаем цвет ластика равным цвету фона
-                self.update_eraser_indicator()  # Обновляем индикатор ластика
-                self.update_brush_color_indicator()  # Обновляем индикатор цвета кисти
+            self.commit_step()  # Записываем смену фона в историю отмены
+
+    def set_region_tool(self, tool):
+        """
+        Включает инструмент tool ("fill" - заливка, "select" - выделение похожего цвета), который работает
+        по щелчку левой кнопкой мыши; повторный выбор того же инструмента возвращает кисть.
+        """
+        self.region_tool = None if tool == self.region_tool else tool
+        if self.region_tool is not None:
+            self.canvas.bind("<Button-1>", self.region_click)  # Привязываем щелчок к инструменту
+        else:
+            self.canvas.unbind("<Button-1>")  # Возвращаем кисть
+        self.update_mode_label()  # Обновляем метку режима
+
+    def region_click(self, event):
+        """
+        Щелчок инструментом заливки или выделения. Выделение находит все пиксели холста,
+        похожие по цвету на пиксель под курсором, и обводит их рамкой. Заливка закрашивает цветом кисти
+        (ластиком - стирает) связную область похожего цвета, а если есть выделение - всё выделение.
+        """
+        x, y = self.event_coords(event)  # Координаты щелчка
+        if not (0 <= x < self.image.width and 0 <= y < self.image.height):
+            return
+        command = {"op": "fill", "x": x, "y": y, "color": None if self.eraser_mode else self.pen_color,
+                   "tolerance": self.tolerance_var.get(), "contiguous": True,
+                   "background": self.engine.background_color}  # Область зависит от фона
+        if self.region_tool == "select":
+            self.select_similar(dict(command, contiguous=False))
+        else:
+            self.apply_fill(dict(command, **self.selection) if self.selection is not None else command)
+
+    def select_similar(self, command):
+        """Выделяет область команды заливки command (без заливки) и показывает её рамкой вокруг выделения."""
+        self.drop_selection()  # Новое выделение заменяет прежнее
+        found = self.engine.similar_region(command["x"], command["y"], command["tolerance"], command["contiguous"])
+        bbox = found[1] if found is not None else None  # Рамка найденных пикселей
+        if bbox is None:
+            return
+        self.selection = {key: command[key] for key in ("x", "y", "tolerance", "contiguous", "background")}
+        self.canvas.create_rectangle(*bbox, dash=(4, 4), outline="black", tags="selection")  # Рамка вокруг выделения
+
+    def drop_selection(self, event=None):
+        """Снимает выделение."""
+        if self.selection is not None:
+            self.selection = None
+            self.canvas.delete("selection")  # Убираем рамку выделения
+
+    def delete_selection(self, event=None):
+        """Стирает выделенную область активного слоя до прозрачности."""
+        if self.selection is not None:
+            self.apply_fill(dict(self.selection, op="fill", color=None))
+
+    def apply_fill(self, command):
+        """
+        Выполняет команду заливки command как одно действие. Залитая область показывается картинкой холста
+        и обновляется в следующем кадре одним прямоугольником, а не элементами холста Tk.
+        """
+        self.end_stroke()  # Забываем незавершённый штрих
+        self.commit_step()  # Уже нарисованная часть штриха остается отдельным действием
+        self.prepare_items(erase=True)  # Заливку показывает картинка холста
+        self.begin_step()  # Заливка - одно действие в истории отмены
+        box = self.execute(command)  # Движок заливает область построчно
+        if box is not None:
+            self.mark_dirty(box)  # Обновляем залитую область
+        self.commit_step()  # Записываем заливку в историю отмены
 
     def start_text_mode(self):
         """
@@ -299,6 +1401,8 @@ class DrawingApp:
 
         def place_text_wrapper(text, size):
             """Замыкание для передачи текста и размера в place_text."""
+            if self.region_tool is not None:  # Щелчок размещает текст, а не заливает
+                self.set_region_tool(self.region_tool)
             self.entered_text = text  # Сохраняем введенный текст
             self.text_size = size  # Сохраняем выбранный размер шрифта
             self.text_mode = True  # Включаем режим текста
@@ -358,26 +1462,32 @@ class DrawingApp:
         Отключает режим текста после размещения.
         Использует выбранный (self.text_size) размер шрифта,
         пытается загрузить Arial, если не доступен - использует стандартный шрифт PIL.
+        Шрифты и отрендеренные надписи берутся из кэша, предупреждение о шрифте показывается один раз.
         """
         if self.text_mode and self.entered_text:  # Проверяем, включен ли режим текста и введен ли текст
-            x, y = event.x, event.y  # Получаем координаты клика
+            x, y = self.event_coords(event)  # Получаем координаты клика
 
-            # Пытаемся загрузить шрифт Arial
-            try:
-                font = ImageFont.truetype("arial.ttf", self.text_size)  # Пытаемся загрузить шрифт Arial
-            except OSError:
-                # Если arial.ttf не найден, используем стандартный шрифт PIL
-                font = ImageFont.load_default()  # Загружаем шрифт по умолчанию
+            # Пытаемся загрузить шрифт Arial (если не найден, load_font вернет стандартный шрифт PIL)
+            found = load_font(self.font_family, self.text_size)[1]
+            if not found and not self.font_warning_shown:  # Предупреждаем об отсутствии шрифта только один раз
+                self.font_warning_shown = True
                 messagebox.showwarning("Внимание",
                                        "Шрифт Arial не найден. Используется шрифт по умолчанию.")  # Показываем
                 # предупреждение
 
-            # Рисуем текст на холсте Tkinter
-            self.canvas.create_text(x, y, text=self.entered_text, fill=self.pen_color,
-                                    anchor='nw', font=("TkDefaultFont", self.text_size))  # Создаем текст на холсте
+            self.begin_step()  # Размещение текста - одно действие в истории отмены
+
+            # Рисуем текст на холсте Tkinter (в растровом режиме или под верхним слоем текст покажет картинка холста)
+            if self.prepare_items():
+                self.canvas.create_text(x, y, text=self.entered_text, fill=self.pen_color,
+                                        anchor='nw', font=("TkDefaultFont", self.text_size),
+                                        tags=self.step_tag)  # Создаем текст на холсте
 
-            # Рисуем текст на изображении PIL - **Исправлено**
-            self.draw.text((x, y), self.entered_text, fill=self.pen_color, font=font)  # Рисуем текст на изображении
+            # Рисуем текст на изображении: движок штампует маску надписи из кэша
+            box = self.execute({"op": "text", "x": x, "y": y, "text": self.entered_text, "color": self.pen_color,
+                                "size": self.text_size, "font": self.font_family})  # Рисуем текст на изображении
+            self.mark_dirty(box)  # Обновляем область текста
+            self.commit_step()  # Записываем текст в историю отмены
 
             self.text_mode = False  # Выключаем режим текста
             self.entered_text = None  # Очищаем введенный текст
@@ -391,11 +1501,97 @@ class DrawingApp:
 def main():
     """
     Создает главное окно приложения и запускает основной цикл обработки событий.
+    Ключ --raster включает растровый режим отображения, --autosave-dir задает каталог журнала для восстановления
+    после сбоя (пустая строка отключает журнал), --profile включает профилирование (трасса в --trace-file),
+    --join АДРЕС:ПОРТ подключает к общему холсту сервера сеанса (python drawing_app.py serve).
     """
+    parser = argparse.ArgumentParser(description="Рисовалка с сохранением в PNG")  # Разбираем аргументы
+    parser.add_argument("--raster", action="store_true",
+                        help="показывать рисунок одной картинкой вместо элементов холста Tk")
+    parser.add_argument("--history-mb", type=int, default=64, help="память истории отмены в мегабайтах")
+    parser.add_argument("--autosave-dir", default=os.path.join(os.path.expanduser("~"), ".drawing_app", "autosave"),
+                        help="каталог журнала операций для восстановления после сбоя (пустая строка - без журнала)")
+    parser.add_argument("--profile", action="store_true",
+                        help="замерять обработчики и кадры, показывать панель показателей и записать трассу")
+    parser.add_argument("--trace-file", default="drawing_trace.json",
+                        help="файл трассы профилирования (пишется по F12 и при выходе)")
+    parser.add_argument("--join", metavar="АДРЕС:ПОРТ", help="подключиться к общему холсту сервера сеанса")
+    parser.add_argument("--name", default="", help="имя участника сеанса")
+    args = parser.parse_args()
+
+    profiler = Profiler() if args.profile else None  # Профилировщик только по запросу
     root = tk.Tk()  # Создаем главное окно
-    app = DrawingApp(root)  # Создаем экземпляр приложения
+    app = DrawingApp(root, display_mode="raster" if args.raster else "vector",
+                     history_budget_mb=args.history_mb,
+                     autosave_dir=args.autosave_dir or None,
+                     profiler=profiler, trace_path=args.trace_file)  # Создаем экземпляр приложения
+    if args.join:  # Общий холст
+        host, _, port = args.join.rpartition(":")
+        app.join_session(host or "127.0.0.1", int(port or DEFAULT_PORT), args.name)
     root.mainloop()  # Запускаем главный цикл обработки событий
+    if profiler is not None:  # Сводка замеров и трасса сеанса
+        profiler.dump_trace(args.trace_file)
+        print(profiler.format_summary())
+        print("Трасса: %s" % args.trace_file)
+
+
+def render_main(argv=None):
+    """
+    Пакетный рендер без интерфейса: выполняет файлы команд (JSON Lines) и сохраняет каждый рисунок в PNG.
+    Файлы обрабатываются параллельно в пуле процессов. Запуск:
+        python drawing_app.py render рисунок1.jsonl рисунок2.jsonl -o каталог -j 4
+    Возвращает код завершения: 0, если все файлы отрисованы, иначе 1.
+    """
+    parser = argparse.ArgumentParser(prog="drawing_app.py render",
+                                     description="Рендер файлов команд рисования в PNG")  # Разбираем аргументы
+    parser.add_argument("files", nargs="+", help="файлы команд рисования (JSON Lines)")
+    parser.add_argument("-o", "--output-dir", default=".", help="каталог для PNG (по умолчанию текущий)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="число процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--width", type=int, default=850, help="начальная ширина холста")
+    parser.add_argument("--height", type=int, default=500, help="начальная высота холста")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)  # Создаем каталог для результатов
+    failed = 0  # Число файлов, которые не удалось отрисовать
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for path in args.files:  # Отдаем каждый файл в пул процессов
+            out_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + ".png")
+            futures[pool.submit(render_file, path, out_path, (args.width, args.height))] = (path, out_path)
+        for future in concurrent.futures.as_completed(futures):  # Печатаем результаты по мере готовности
+            path, out_path = futures[future]
+            try:
+                print("%s -> %s (%.2f с)" % (path, out_path, future.result()))
+            except Exception as error:
+                print("%s: ошибка: %s" % (path, error), file=sys.stderr)
+                failed += 1
+    return 1 if failed else 0
+
+
+def serve_main(argv=None):
+    """
+    Сервер общего холста: хранит журнал операций сеанса и пересылает операции участникам. Запуск:
+        python drawing_app.py serve --host 127.0.0.1 --port 8765
+    Участники подключаются ключом --join АДРЕС:ПОРТ. Сервер работает до Ctrl+C.
+    """
+    parser = argparse.ArgumentParser(prog="drawing_app.py serve",
+                                     description="Сервер общего холста")  # Разбираем аргументы
+    parser.add_argument("--host", default="127.0.0.1", help="адрес сервера (по умолчанию только этот компьютер)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="порт сервера (0 - любой свободный)")
+    parser.add_argument("--width", type=int, default=850, help="начальная ширина холста")
+    parser.add_argument("--height", type=int, default=500, help="начальная высота холста")
+    parser.add_argument("--background", default="white", help="начальный цвет фона")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, (args.width, args.height), args.background))
+    except KeyboardInterrupt:
+        pass
+    return 0
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["render"]:  # Пакетный рендер без интерфейса
+        sys.exit(render_main(sys.argv[2:]))
+    if sys.argv[1:2] == ["serve"]:  # Сервер общего холста
+        sys.exit(serve_main(sys.argv[2:]))
     main()  # Запускаем приложение
@@ -0,0 +1,1495 @@
+"""
+Движок рисования без интерфейса: изображение из плиток, шрифты, история отмены и команды рисования.
+
+Не зависит от Tkinter, поэтому рисунки можно строить на сервере без дисплея: DrawingEngine выполняет
+поток команд (отрезки, ластик, текст, заливка, очистка, фон, размер, слои) и дает то же изображение, что и рисование
+в DrawingApp.
+Команды хранятся в формате JSON Lines: одна команда (словарь с ключом "op") в строке.
+"""
+import collections
+import contextlib
+import functools
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
+
+
+class TileSpill:
+    """
+    Файл подкачки плиток, отображённый в память (mmap).
+
+    Плитки, вытесненные из памяти, записываются в слоты фиксированного размера временного файла.
+    Освобождённые слоты используются повторно, файл растёт только при нехватке слотов.
+    Слот может принадлежать нескольким снимкам изображения (TiledImage.snapshot), поэтому у слотов есть
+    счетчик ссылок. Файлом пользуются и главный поток, и поток фонового сохранения, поэтому доступ защищен lock.
+    """
+
+    def __init__(self, slot_size):
+        """Создает пустой временный файл подкачки со слотами размера slot_size байт."""
+        self.slot_size = slot_size  # Размер одного слота в байтах
+        self.file = tempfile.TemporaryFile()  # Временный файл удаляется автоматически при закрытии
+        self.map = None  # Отображение файла в память (создаётся при первой записи)
+        self.capacity = 0  # Число слотов в файле
+        self.free_slots = []  # Освобождённые слоты для повторного использования
+        self.refs = {}  # Число владельцев каждого занятого слота
+        self.lock = threading.Lock()  # Защита от одновременного доступа из нескольких потоков
+
+    def write(self, data):
+        """Записывает байты плитки в свободный слот и возвращает его номер."""
+        with self.lock:
+            if not self.free_slots:  # Если свободных слотов нет, увеличиваем файл вдвое
+                self.grow(max(16, self.capacity * 2))
+            slot = self.free_slots.pop()  # Берем свободный слот
+            offset = slot * self.slot_size  # Смещение слота в файле
+            self.map[offset:offset + len(data)] = data  # Копируем байты плитки в файл
+            self.refs[slot] = 1  # У слота один владелец
+            return slot
+
+    def read(self, slot):
+        """Возвращает байты плитки из слота."""
+        with self.lock:
+            offset = slot * self.slot_size  # Смещение слота в файле
+            return self.map[offset:offset + self.slot_size]
+
+    def retain(self, slot):
+        """Добавляет слоту еще одного владельца."""
+        with self.lock:
+            self.refs[slot] += 1
+
+    def free(self, slot):
+        """Убирает владельца слота; слот без владельцев используется повторно."""
+        with self.lock:
+            self.refs[slot] -= 1
+            if not self.refs[slot]:
+                del self.refs[slot]
+                self.free_slots.append(slot)
+
+    def grow(self, capacity):
+        """Увеличивает файл до capacity слотов и заново отображает его в память."""
+        if self.map is not None:  # Старое отображение закрываем перед изменением размера файла
+            self.map.close()
+        self.file.truncate(capacity * self.slot_size)  # Увеличиваем файл
+        self.map = mmap.mmap(self.file.fileno(), capacity * self.slot_size)  # Отображаем файл в память
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))  # Новые слоты свободны
+        self.capacity = capacity
+
+
+class TiledImage:
+    """
+    Разреженное изображение, разбитое на квадратные плитки TILE_SIZE x TILE_SIZE.
+
+    Плитка создается только при первом рисовании в ней; нетронутые области хранятся как цвет фона и памяти
+    не занимают. Если плиток в памяти больше max_resident_tiles, давно не использованные вытесняются в файл
+    подкачки (TileSpill), поэтому размер холста ограничен диском, а не оперативной памятью. Плитки открытого
+    проекта хранятся сжатыми байтами, а плитки кэшей - отложенными (defer_tile): плитка распаковывается
+    или строится только при первом обращении, поэтому большой рисунок открывается сразу.
+    Поддерживает ту часть интерфейса PIL.Image, которая нужна приложению: size, getpixel, crop, paste, save.
+
+    Атрибуты:
+        size (tuple): Ширина и высота изображения.
+        mode (str): Режим изображения PIL ("RGB").
+        color (tuple): Цвет фона - цвет пикселей в плитках, которые еще не созданы.
+        tiles (collections.OrderedDict): Плитки в памяти: (tx, ty) -> PIL.Image, от давно использованных к недавним.
+        spilled (dict): Плитки вне памяти: (tx, ty) -> номер слота файла подкачки, сжатые байты плитки
+            или функция, строящая плитку (None - плитки нет).
+        spill (TileSpill): Файл подкачки (None, пока он не понадобился или если mmap недоступен).
+        changes (dict): Прежнее состояние плиток, изменённых с вызова begin_changes (None, если запись не ведётся).
+        shared (set): Ключи плиток, общих с историей отмены (keep_tile); перед изменением такая плитка копируется.
+        snapshots (list): Снимки (snapshot), которые еще не освобождены: их плитки тоже копируются перед изменением.
+        frozen (bool): Изображение - снимок только для чтения: плитки из файла подкачки читаются без переноса в память.
+        released (bool): Снимок освобожден (release) и больше не удерживает плитки и слоты файла подкачки.
+    """
+
+    TILE_SIZE = 256  # Размер стороны плитки в пикселях
+
+    def __init__(self, size, color="white", mode="RGB", max_resident_tiles=512):
+        """Создает изображение размера size, залитое цветом color, без единой плитки."""
+        self.size = tuple(size)  # Размер изображения
+        self.mode = mode  # Режим изображения PIL
+        self.color = ImageColor.getcolor(color, mode) if isinstance(color, str) else color  # Цвет фона
+        self.max_resident_tiles = max_resident_tiles  # Сколько плиток держать в памяти
+        self.tiles = collections.OrderedDict()  # Плитки в памяти
+        self.spilled = {}  # Плитки в файле подкачки
+        self.spill = None  # Файл подкачки создаётся при первом вытеснении
+        self.changes = None  # Запись изменений для истории отмены выключена
+        self.shared = set()  # Плитки, общие с историей отмены
+        self.snapshots = []  # Неосвобожденные снимки изображения
+        self.frozen = False  # Изображение можно изменять
+        self.released = False  # Снимок еще не освобожден
+
+    @property
+    def width(self):
+        """Ширина изображения."""
+        return self.size[0]
+
+    @property
+    def height(self):
+        """Высота изображения."""
+        return self.size[1]
+
+    @property
+    def nbytes(self):
+        """Память плиток, находящихся в памяти (плитки в файле подкачки не считаются)."""
+        return len(self.tiles) * Image.getmodebands(self.mode) * self.TILE_SIZE ** 2
+
+    def tile_keys(self, box):
+        """Возвращает ключи (tx, ty) всех плиток, пересекающихся с областью box = (x0, y0, x1, y1)."""
+        size = self.TILE_SIZE
+        x0, y0 = max(0, int(box[0])), max(0, int(box[1]))  # Ограничиваем область размерами изображения
+        x1, y1 = min(self.width, int(box[2])), min(self.height, int(box[3]))
+        if x0 >= x1 or y0 >= y1:  # Пустая область не задевает ни одной плитки
+            return []
+        return [(tx, ty) for ty in range(y0 // size, (y1 - 1) // size + 1)
+                for tx in range(x0 // size, (x1 - 1) // size + 1)]
+
+    def get_tile(self, key, create=False):
+        """
+        Возвращает плитку key из памяти или файла подкачки.
+        Если плитки нет, возвращает None, а при create=True создает новую плитку цвета фона.
+        """
+        tile = self.tiles.get(key)  # Ищем плитку в памяти
+        if tile is not None:
+            if not self.frozen:
+                self.tiles.move_to_end(key)  # Плитка использована недавно
+            return tile
+        if self.frozen:  # Снимок только читает слот: он не занимает новых слотов и не вытесняет плиток
+            entry = self.spilled.get(key)
+            if entry is None:
+                return None
+            return self.unpack(entry)
+        entry = self.spilled.pop(key, None)  # Ищем плитку вне памяти
+        if entry is not None:
+            tile = self.unpack(entry)
+            self.drop(entry)  # Слот больше не нужен
+        if tile is None and create:
+            tile = Image.new(self.mode, (self.TILE_SIZE, self.TILE_SIZE), self.color)  # Новая плитка цвета фона
+        elif tile is None:
+            return None
+        self.tiles[key] = tile  # Плитка теперь в памяти
+        self.evict()  # Вытесняем лишние плитки
+        return tile
+
+    def evict(self):
+        """Вытесняет давно не использованные плитки в файл подкачки, пока их в памяти не станет не больше лимита."""
+        while len(self.tiles) > self.max_resident_tiles:
+            if self.spill is None:  # Создаем файл подкачки при первом вытеснении
+                try:
+                    self.spill = TileSpill(Image.getmodebands(self.mode) * self.TILE_SIZE ** 2)
+                except (OSError, ValueError):  # Если mmap недоступен, держим все плитки в памяти
+                    self.max_resident_tiles = float("inf")
+                    return
+            key, tile = self.tiles.popitem(last=False)  # Самая давно использованная плитка
+            self.shared.discard(key)  # Вытесненная плитка больше не общая: её загрузят в новый объект
+            self.spilled[key] = self.spill.write(tile.tobytes())  # Записываем её в файл подкачки
+
+    def unpack(self, entry):
+        """Возвращает плитку записи spilled: читает слот, распаковывает сжатые байты или строит плитку."""
+        if isinstance(entry, int):
+            return Image.frombytes(self.mode, (self.TILE_SIZE, self.TILE_SIZE), self.spill.read(entry))
+        if isinstance(entry, bytes):
+            return Image.frombytes(self.mode, (self.TILE_SIZE, self.TILE_SIZE), zlib.decompress(entry))
+        return entry()
+
+    def drop(self, entry):
+        """Освобождает запись spilled, которая больше не нужна (слот файла подкачки)."""
+        if isinstance(entry, int):
+            self.spill.free(entry)
+
+    def defer_tile(self, key, build):
+        """
+        Заменяет плитку key отложенной: при первом обращении её построит build() (None - плитки нет).
+        Изменение не записывается для отмены.
+        """
+        self.set_tile(key, None)
+        self.spilled[key] = build
+
+    def build_deferred(self):
+        """Строит все отложенные плитки (перед переносом плиток и снимком для другого потока)."""
+        for key, entry in list(self.spilled.items()):
+            if callable(entry):
+                self.get_tile(key)
+
+    def getpixel(self, xy):
+        """Возвращает цвет пикселя xy. Вне изображения возбуждает IndexError, как PIL.Image.getpixel."""
+        x, y = int(xy[0]), int(xy[1])
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("image index out of range")
+        tile = self.get_tile((x // self.TILE_SIZE, y // self.TILE_SIZE))  # Плитка с этим пикселем
+        if tile is None:  # Плитки нет - пиксель цвета фона
+            return self.color
+        return tile.getpixel((x % self.TILE_SIZE, y % self.TILE_SIZE))
+
+    def crop(self, box):
+        """Собирает область box = (x0, y0, x1, y1) в обычное изображение PIL."""
+        x0, y0, x1, y1 = (int(v) for v in box)
+        region = Image.new(self.mode, (x1 - x0, y1 - y0), self.color)  # Область цвета фона
+        for tx, ty in self.tile_keys(box):  # Копируем в неё существующие плитки
+            tile = self.get_tile((tx, ty))
+            if tile is not None:
+                region.paste(tile, (tx * self.TILE_SIZE - x0, ty * self.TILE_SIZE - y0))
+        return region
+
+    def paste(self, image, xy, mask=None, skip_background=False):
+        """
+        Вставляет изображение PIL image в точку xy, при необходимости с маской mask.
+        При skip_background=True не создает плитки там, где вставляемая часть целиком цвета фона.
+        """
+        x0, y0 = int(xy[0]), int(xy[1])
+        size = self.TILE_SIZE
+        for tx, ty in self.tile_keys((x0, y0, x0 + image.width, y0 + image.height)):
+            offset = (x0 - tx * size, y0 - ty * size)  # Положение вставки относительно плитки
+            if skip_background and (tx, ty) not in self.tiles and (tx, ty) not in self.spilled:
+                part = image.crop((-offset[0], -offset[1], size - offset[0], size - offset[1]))  # Часть в плитке
+                colors = part.getcolors(1)  # None, если в части больше одного цвета
+                if colors and colors[0][1] == self.color:  # Часть совпадает с фоном - плитка не нужна
+                    continue
+            self.remember_tile((tx, ty))  # Сохраняем прежнее состояние плитки для отмены
+            self.writable_tile((tx, ty)).paste(image, offset, mask)
+
+    def set_tile(self, key, tile):
+        """Заменяет плитку key готовой плиткой tile (None - удаляет плитку). Изменения не записываются для отмены."""
+        self.tiles.pop(key, None)
+        entry = self.spilled.pop(key, None)
+        if entry is not None:  # Прежняя плитка в файле подкачки больше не нужна
+            self.drop(entry)
+        self.shared.discard(key)  # Снимки сохраняют ссылку на прежнюю плитку
+        if tile is not None:
+            self.tiles[key] = tile
+            self.evict()  # Вытесняем лишние плитки
+
+    def tile_box(self, key):
+        """Возвращает область (x0, y0, x1, y1) плитки key."""
+        size = self.TILE_SIZE
+        return key[0] * size, key[1] * size, (key[0] + 1) * size, (key[1] + 1) * size
+
+    def writable_tile(self, key):
+        """
+        Возвращает плитку key для изменения: создает её при необходимости и копирует, если она общая
+        с историей отмены или со снимком.
+        """
+        tile = self.get_tile(key, create=True)
+        if key in self.shared or self.in_snapshot(key, tile):  # Плитка должна остаться неизменной - изменяем копию
+            tile = self.tiles[key] = tile.copy()
+            self.shared.discard(key)
+        return tile
+
+    def in_snapshot(self, key, tile):
+        """Проверяет, хранит ли какой-нибудь неосвобожденный снимок плитку tile под ключом key."""
+        if not self.snapshots:
+            return False
+        self.snapshots = [copy for copy in self.snapshots if not copy.released]  # Освобожденные снимки забываем
+        return any(copy.tiles.get(key) is tile for copy in self.snapshots)
+
+    def snapshot(self):
+        """
+        Возвращает снимок изображения для чтения в другом потоке (например, при фоновом сохранении).
+        Снимок не копирует пиксели: плитки общие, а изображение копирует плитку перед первым изменением,
+        пока снимок не освобожден. Прочитав снимок, владелец вызывает release (в любом потоке).
+        """
+        self.build_deferred()  # Отложенные плитки строятся здесь, а не в потоке снимка
+        copy = TiledImage(self.size, self.color, self.mode, self.max_resident_tiles)
+        copy.tiles = collections.OrderedDict(self.tiles)  # Общие плитки в памяти
+        copy.spilled = dict(self.spilled)  # Общие слоты файла подкачки
+        copy.spill = self.spill
+        copy.frozen = True
+        for entry in copy.spilled.values():  # Слоты не освободятся, пока ими пользуется снимок
+            if isinstance(entry, int):
+                self.spill.retain(entry)
+        self.snapshots.append(copy)
+        return copy
+
+    def release(self):
+        """Освобождает снимок: отдает его слоты файла подкачки и разрешает изображению менять плитки на месте."""
+        if self.released:
+            return
+        self.released = True
+        for entry in self.spilled.values():
+            self.drop(entry)
+        self.tiles, self.spilled = collections.OrderedDict(), {}
+
+    @contextlib.contextmanager
+    def edit(self, box):
+        """
+        Контекстный менеджер для рисования в области box: выдает изображение PIL этой области и смещение
+        (x0, y0) её левого верхнего угла, а по выходе записывает область обратно в плитки.
+        """
+        x0, y0, x1, y1 = (int(v) for v in box)
+        region = self.crop((x0, y0, x1, y1))  # Копия области для рисования
+        yield region, (x0, y0)
+        self.paste(region, (x0, y0), skip_background=True)  # Записываем нарисованное обратно
+
+    def draw_line(self, points, fill, width, joint=None):
+        """
+        Рисует ломаную по плоскому списку координат points, как ImageDraw.line.
+        Возвращает изменённую область (x0, y0, x1, y1).
+        """
+        radius = width // 2 + 2  # Запас на толщину линии
+        box = (min(points[0::2]) - radius, min(points[1::2]) - radius,
+               max(points[0::2]) + radius + 1, max(points[1::2]) + radius + 1)
+        with self.edit(box) as (region, (x0, y0)):
+            shifted = [v - (y0 if i % 2 else x0) for i, v in enumerate(points)]  # Координаты внутри области
+            ImageDraw.Draw(region).line(shifted, fill=fill, width=width, joint=joint)
+        return box
+
+    def draw_mask(self, xy, mask, fill, replace=False):
+        """
+        Закрашивает цветом fill пиксели под маской mask (изображение "L"), приложенной левым верхним углом к xy.
+        Так рисуется текст: маска надписи рендерится один раз (render_text_mask) и затем только штампуется.
+        При replace=True пиксели под маской заменяются цветом вместе с прозрачностью (так заливка может стирать).
+        Возвращает изменённую область (x0, y0, x1, y1).
+        """
+        x0, y0 = int(xy[0]), int(xy[1])
+        box = (x0, y0, x0 + mask.width, y0 + mask.height)
+        color = ImageColor.getcolor(fill, self.mode) if isinstance(fill, str) else fill  # Цвет в режиме изображения
+        if self.mode == "RGBA" and not replace:  # На прозрачном слое маска - прозрачность цвета, а не смесь с пустотой
+            patch = Image.new("RGBA", mask.size, color)
+            patch.putalpha(mask)
+        size = self.TILE_SIZE
+        for tx, ty in self.tile_keys(box):
+            left, top = x0 - tx * size, y0 - ty * size  # Положение маски относительно плитки
+            self.remember_tile((tx, ty))  # Сохраняем прежнее состояние плитки для отмены
+            tile = self.writable_tile((tx, ty))
+            if self.mode == "RGBA" and not replace:  # Накладываем цвет поверх содержимого слоя
+                tile.alpha_composite(patch, (max(0, left), max(0, top)), (max(0, -left), max(0, -top)))
+            elif replace and mask.crop((-left, -top, size - left, size - top)).getextrema() == (255, 255):
+                tile.paste(color, (0, 0, size, size))  # Маска покрывает всю плитку - заливаем без маски
+            else:
+                tile.paste(color, (left, top, left + mask.width, top + mask.height), mask)
+        return box
+
+    def similar(self, box, color, tolerance):
+        """
+        Возвращает маску similar_mask области box: пиксели, похожие на цвет color. Пиксели сравниваются
+        только в плитках с разными цветами: на месте отсутствующих плиток маска целиком 0 или 255 по цвету фона,
+        а плитки, все каналы которых (по getextrema) близки к color или далеки от него, дают 255 или 0 целиком.
+        """
+        x0, y0, x1, y1 = box
+        background = ImageColor.getcolor(self.color, self.mode) if isinstance(self.color, str) else self.color
+        similar = all(abs(a - b) <= tolerance for a, b in zip(background, color))  # Похож ли цвет фона
+        mask = Image.new("L", (x1 - x0, y1 - y0), 255 if similar else 0)
+        size = self.TILE_SIZE
+        for tx, ty in self.tile_keys(box):
+            tile = self.get_tile((tx, ty))
+            if tile is None:
+                continue
+            left, top = tx * size - x0, ty * size - y0  # Положение плитки в маске
+            ranges = list(zip(tile.getextrema(), color))  # Диапазон значений каждого канала плитки
+            if all(low >= value - tolerance and high <= value + tolerance for (low, high), value in ranges):
+                mask.paste(255, (left, top, left + size, top + size))  # Вся плитка похожего цвета
+            elif any(high < value - tolerance or low > value + tolerance for (low, high), value in ranges):
+                mask.paste(0, (left, top, left + size, top + size))  # Похожих пикселей в плитке нет
+            else:
+                mask.paste(similar_mask(tile, color, tolerance), (left, top))
+        return mask
+
+    def flood(self, seed, color, tolerance, box):
+        """
+        Находит в области box пиксели, похожие на color (как similar) и связные с точкой seed (соседи по сторонам).
+        Плитки обходятся по одной: в плитке заливка идет построчно (flood_spans), а отрезки, дошедшие до края
+        плитки, продолжаются в соседней. Часть плитки, целиком похожая на color, заливается без обхода пикселей.
+        Возвращает маски залитых пикселей по плиткам: (tx, ty) -> (маска части плитки в box, её левый верхний угол).
+        """
+        size = self.TILE_SIZE
+        found = {}  # Похожие пиксели плиток: (tx, ty) -> (маска similar, bytearray еще не залитых) или None
+        full = set()  # Плитки, залитые целиком
+        seeds = collections.defaultdict(list)  # Точки, с которых заливка продолжается в плитке
+        start = (seed[0] // size, seed[1] // size)
+        seeds[start].append(seed)
+        stack = [start]
+        while stack:
+            key = stack.pop()
+            points = seeds.pop(key, None)
+            if not points or key in full:
+                continue
+            x0, y0 = max(key[0] * size, box[0]), max(key[1] * size, box[1])  # Часть плитки в box
+            x1, y1 = min((key[0] + 1) * size, box[2]), min((key[1] + 1) * size, box[3])
+            width, height = x1 - x0, y1 - y0
+            if key not in found:
+                mask = self.similar((x0, y0, x1, y1), color, tolerance)
+                low, high = mask.getextrema()
+                if low == 255:  # Похожа вся часть плитки - она заливается целиком
+                    full.add(key)
+                    found[key] = (mask, None)
+                    spans = [(y, 0, width) for y in range(height)]
+                else:
+                    found[key] = (mask, bytearray(mask.tobytes())) if high else None
+            if key not in full:
+                if found[key] is None:  # Похожих пикселей в плитке нет
+                    continue
+                spans = flood_spans(found[key][1], width, height, [(x - x0, y - y0) for x, y in points])
+            for y, left, right in spans:  # Отрезки на краях плитки продолжаются в соседних
+                neighbours = []
+                if y == 0 and y0 > box[1]:
+                    neighbours.append(((key[0], key[1] - 1), [(x0 + x, y0 - 1) for x in range(left, right)]))
+                if y == height - 1 and y1 < box[3]:
+                    neighbours.append(((key[0], key[1] + 1), [(x0 + x, y1) for x in range(left, right)]))
+                if left == 0 and x0 > box[0]:
+                    neighbours.append(((key[0] - 1, key[1]), [(x0 - 1, y0 + y)]))
+                if right == width and x1 < box[2]:
+                    neighbours.append(((key[0] + 1, key[1]), [(x1, y0 + y)]))
+                for near, near_points in neighbours:
+                    if near not in full:
+                        seeds[near].extend(near_points)
+                        stack.append(near)
+        masks = {}
+        for key, entry in found.items():
+            if entry is None:
+                continue
+            mask, free = entry
+            if free is not None:  # Залитые пиксели - похожие без еще не залитых
+                mask = ImageChops.subtract(mask, Image.frombytes("L", mask.size, bytes(free)))
+                if mask.getbbox() is None:
+                    continue
+            masks[key] = (mask, (max(key[0] * size, box[0]), max(key[1] * size, box[1])))
+        return masks
+
+    def erase_mask(self, xy, mask):
+        """
+        Стирает до прозрачности пиксели под маской mask (изображение "L"), приложенной левым верхним углом к xy:
+        альфа-канал умножается на 1 - mask / 255. Возвращает изменённую область (x0, y0, x1, y1).
+        """
+        x0, y0 = int(xy[0]), int(xy[1])
+        box = (x0, y0, x0 + mask.width, y0 + mask.height)
+        keep = ImageChops.invert(mask)  # Доля прозрачности, которая остается
+        size = self.TILE_SIZE
+        for tx, ty in self.tile_keys(box):
+            if self.get_tile((tx, ty)) is None:  # Плитки нет - стирать нечего
+                continue
+            part = Image.new("L", (size, size), 255)
+            part.paste(keep, (x0 - tx * size, y0 - ty * size))  # Маска в координатах плитки
+            self.remember_tile((tx, ty))  # Сохраняем прежнее состояние плитки для отмены
+            tile = self.writable_tile((tx, ty))
+            tile.putalpha(ImageChops.multiply(tile.getchannel("A"), part))
+        return box
+
+    def clear(self, color=None):
+        """Удаляет все плитки, заливая изображение цветом фона (или новым цветом color)."""
+        for key in list(self.tiles) + list(self.spilled):  # Запоминаем удаляемые плитки для отмены
+            self.remember_tile(key)
+        for entry in self.spilled.values():  # Освобождаем слоты файла подкачки
+            self.drop(entry)
+        self.tiles.clear()
+        self.shared.clear()
+        self.spilled.clear()
+        if color is not None:  # Меняем цвет фона
+            self.color = ImageColor.getcolor(color, self.mode) if isinstance(color, str) else color
+
+    def move(self, offset, size):
+        """
+        Меняет размер изображения на size, сдвигая содержимое на offset = (dx, dy); вышедшее за края обрезается.
+        При сдвиге на целое число плиток (в частности, без сдвига) плитки переносятся без копирования пикселей,
+        иначе каждая плитка вставляется на новое место. Изменения записываются для отмены.
+        """
+        dx, dy = offset
+        source = self.detach()  # Все плитки займут новые места
+        old_width, old_height = source.size
+        self.size = tuple(size)
+        size = self.TILE_SIZE
+        columns, rows = (self.width - 1) // size + 1, (self.height - 1) // size + 1  # Число плиток по сторонам
+        for tx, ty in list(source.tiles) + list(source.spilled):  # Плитки переносятся по одной
+            tile = source.pop_tile((tx, ty))
+            x, y = tx * size + dx, ty * size + dy  # Новое положение плитки
+            if x % size or y % size:  # Плитка ложится на несколько плиток - вставляем её пиксели
+                self.paste(tile, (x, y), skip_background=True)
+            elif 0 <= x // size < columns and 0 <= y // size < rows:  # Плитка переносится целиком, без копирования
+                key = (x // size, y // size)
+                self.remember_tile(key)
+                self.tiles[key] = tile
+                self.shared.add(key)  # Плитку хранит и история отмены - перед изменением она скопируется
+                self.evict()
+        # В крайних плитках за бывшими краями изображения могли остаться пиксели - заливаем их цветом фона
+        valid = (max(0, dx), max(0, dy), min(self.width, dx + old_width), min(self.height, dy + old_height))
+        for key in list(self.tiles) + list(self.spilled):
+            x0, y0, x1, y1 = self.tile_box(key)
+            for box in ((x0, y0, x1, valid[1]), (x0, valid[3], x1, y1),  # Полосы выше и ниже содержимого
+                        (x0, y0, valid[0], y1), (valid[2], y0, x1, y1)):  # Полосы левее и правее содержимого
+                box = (max(box[0], x0), max(box[1], y0), min(box[2], x1), min(box[3], y1))
+                if box[0] < box[2] and box[1] < box[3]:
+                    self.remember_tile(key)
+                    self.writable_tile(key).paste(self.color, (box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+        self.evict()
+
+    def rescale(self, size, content_size, offset, resample):
+        """
+        Меняет размер изображения на size, масштабируя содержимое до content_size фильтром resample
+        и помещая его в точку offset. Изменения записываются для отмены.
+        Новое изображение строится блоками (не больше плитки): каждый блок масштабируется из вырезанной области
+        прежнего изображения с запасом на ширину фильтра, поэтому целиком изображение в памяти не собирается.
+        """
+        source = self.detach()
+        self.size = tuple(size)
+        if not source.tiles and not source.spilled:  # Пустое изображение масштабировать незачем
+            return
+        scale_x, scale_y = source.width / content_size[0], source.height / content_size[1]  # Пикселей на пиксель
+        block = self.TILE_SIZE
+        while block > 16 and block * max(scale_x, scale_y) > 4 * self.TILE_SIZE:  # Вырезаемая область не больше
+            block //= 2  # четырех плиток
+        margin = int(3 * max(scale_x, scale_y, 1)) + 2  # Запас на ширину фильтра (у lanczos - 3 пикселя)
+        x_end, y_end = min(self.width, offset[0] + content_size[0]), min(self.height, offset[1] + content_size[1])
+        for y in range(max(0, offset[1]) // block * block, y_end, block):
+            for x in range(max(0, offset[0]) // block * block, x_end, block):
+                x0, y0 = max(x, offset[0]), max(y, offset[1])  # Блок в новом изображении
+                x1, y1 = min(x + block, x_end), min(y + block, y_end)
+                box = ((x0 - offset[0]) * scale_x, (y0 - offset[1]) * scale_y,  # Блок в прежнем изображении
+                       (x1 - offset[0]) * scale_x, (y1 - offset[1]) * scale_y)
+                crop = (max(0, int(box[0]) - margin), max(0, int(box[1]) - margin),
+                        min(source.width, math.ceil(box[2]) + margin), min(source.height, math.ceil(box[3]) + margin))
+                if not any(key in source.tiles or key in source.spilled for key in source.tile_keys(crop)):
+                    continue  # Там только фон - он и останется
+                box = (box[0] - crop[0], box[1] - crop[1], box[2] - crop[0], box[3] - crop[1])  # Блок в вырезанной
+                part = source.crop(crop).resize((x1 - x0, y1 - y0), resample, box)  # области
+                self.paste(part, (x0, y0), skip_background=True)
+        source.clear()  # Освобождаем слоты файла подкачки прежних плиток
+
+    def detach(self):
+        """
+        Переносит все плитки изображения в новое изображение того же размера и возвращает его; само
+        изображение становится пустым (для move и rescale, которые строят плитки заново). Прежнее состояние
+        плиток записывается для отмены. Файл подкачки у изображений общий.
+        """
+        for key in list(self.tiles) + list(self.spilled):
+            self.remember_tile(key)
+        source = TiledImage(self.size, self.color, self.mode, self.max_resident_tiles)
+        source.tiles, source.spilled, source.spill = self.tiles, self.spilled, self.spill
+        self.tiles, self.spilled = collections.OrderedDict(), {}
+        self.shared.clear()
+        return source
+
+    def pop_tile(self, key):
+        """Забирает плитку key из памяти или файла подкачки (None, если плитки нет). Изменение не записывается."""
+        tile = self.tiles.pop(key, None)
+        entry = self.spilled.pop(key, None)
+        if entry is not None:
+            tile = self.unpack(entry)
+            self.drop(entry)
+        self.shared.discard(key)
+        return tile
+
+    def begin_changes(self):
+        """Начинает запись прежнего состояния изменяемых плиток."""
+        self.changes = {}
+
+    def end_changes(self):
+        """Заканчивает запись и возвращает прежнее состояние изменённых плиток: (tx, ty) -> плитка или None."""
+        changes, self.changes = self.changes, None
+        return changes or {}
+
+    def remember_tile(self, key):
+        """Если идет запись изменений, сохраняет состояние плитки key до её первого изменения."""
+        if self.changes is not None and key not in self.changes:
+            self.changes[key] = self.keep_tile(key)
+
+    def keep_tile(self, key):
+        """
+        Возвращает плитку key для хранения вне изображения (None, если плитки нет).
+        Пиксели не копируются: плитка становится общей и будет скопирована перед следующим изменением.
+        Плитка из файла подкачки возвращается сжатыми байтами и в память не загружается.
+        """
+        entry = self.spilled.get(key)
+        if isinstance(entry, bytes):  # Плитка и так хранится сжатой
+            return entry
+        if isinstance(entry, int):
+            return zlib.compress(self.spill.read(entry), 1)
+        if entry is not None:  # Отложенную плитку нужно построить, пока она не изменилась
+            self.get_tile(key)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.shared.add(key)
+        return tile
+
+    def restore_tiles(self, states):
+        """
+        Восстанавливает плитки из states: (tx, ty) -> плитка, её сжатые байты (HistoryStep.compress) или None.
+        Сжатые плитки остаются сжатыми и распаковываются при первом обращении.
+        Возвращает текущее состояние этих плиток, чтобы восстановление можно было повторить обратно.
+        """
+        inverse = {}
+        for key, data in states.items():
+            inverse[key] = self.keep_tile(key)  # Состояние плитки до восстановления
+            self.set_tile(key, None)  # Удаляем текущую плитку
+            if isinstance(data, bytes):  # Сжатая плитка распакуется при первом обращении
+                self.spilled[key] = data
+            elif data is not None:  # Возвращаем сохраненную плитку; она может быть общей со снимком
+                self.tiles[key] = data
+                self.shared.add(key)
+        self.evict()  # Вытесняем лишние плитки
+        return inverse
+
+    def tile_image(self, data):
+        """Возвращает сохраненное состояние плитки (плитка, её сжатые байты или None) как изображение PIL."""
+        if isinstance(data, bytes):
+            return Image.frombytes(self.mode, (self.TILE_SIZE, self.TILE_SIZE), zlib.decompress(data))
+        if data is None:  # Плитки не было - она цвета фона
+            return Image.new(self.mode, (self.TILE_SIZE, self.TILE_SIZE), self.color)
+        return data
+
+    def changed_mask(self, key, data):
+        """
+        Возвращает маску "L" пикселей плитки key, которые отличаются от её прежнего состояния data
+        (плитка, сжатые байты или None): 255 - пиксель изменился. Если отличий нет, возвращает None.
+        """
+        tile = self.get_tile(key)
+        if tile is data:
+            return None
+        mask = difference_mask(self.tile_image(data), self.tile_image(tile))
+        return mask if mask.getbbox() else None
+
+    def patch_tile(self, key, mask, pixels, expected):
+        """
+        Заменяет пиксели плитки key под маской mask пикселями pixels, но только те, что сейчас равны expected:
+        пиксели, измененные с тех пор кем-то еще, не трогаются. Маска и пиксели - изображения или сжатые байты.
+        """
+        if isinstance(mask, bytes):
+            mask = Image.frombytes("L", (self.TILE_SIZE, self.TILE_SIZE), zlib.decompress(mask))
+        tile = self.get_tile(key)
+        mask = ImageChops.subtract(mask, difference_mask(self.tile_image(tile), self.tile_image(expected)))
+        if mask.getbbox():
+            self.remember_tile(key)
+            self.writable_tile(key).paste(self.tile_image(pixels), (0, 0), mask)
+
+    def to_image(self):
+        """Собирает все изображение целиком в обычное изображение PIL."""
+        return self.crop((0, 0) + self.size)
+
+    def save(self, fp, format=None, compress_level=6, optimize=False, progress=None):
+        """
+        Сохраняет изображение в файл fp. PNG записывается потоково, полосами высотой в одну плитку, поэтому
+        целиком изображение в памяти не собирается. TIFF сохраняется без сжатия, WebP - без потерь
+        с самой быстрой настройкой; для этих форматов изображение собирается через PIL.
+        Аргументы compress_level (0-9) и optimize задают сжатие PNG, progress(доля) вызывается по ходу записи.
+        """
+        if format is None:  # Определяем формат по расширению файла
+            format = Image.registered_extensions().get(os.path.splitext(str(fp))[1].lower(), "PNG")
+        if format == "PNG":
+            with open(fp, "wb") as out:
+                self.write_png(out, compress_level, optimize, progress)
+        else:
+            options = {"TIFF": {"compression": "raw"}, "WEBP": {"lossless": True, "method": 0}}  # Быстрые варианты
+            self.to_image().save(fp, format, **options.get(format, {}))
+        if progress is not None:
+            progress(1.0)  # Сохранение закончено
+
+    def write_png(self, out, compress_level=6, optimize=False, progress=None):
+        """
+        Потоково записывает изображение в открытый двоичный файл out в формате PNG.
+        Без optimize строки пишутся без фильтра (быстрее всего). С optimize к строкам применяется фильтр Sub
+        (разность с левым пикселем, считается через ImageChops) и максимальное сжатие: файл меньше, запись дольше.
+        """
+        color_types = {"L": 0, "RGB": 2, "RGBA": 6}  # Типы цвета PNG для режимов PIL
+        width, height = self.size
+        stride = width * Image.getmodebands(self.mode)  # Байт в строке изображения
+
+        def chunk(kind, data):
+            """Записывает блок PNG: длина, тип, данные и контрольная сумма."""
+            out.write(struct.pack(">I", len(data)) + kind + data)
+            out.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+        out.write(b"\x89PNG\r\n\x1a\n")  # Сигнатура PNG
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_types[self.mode], 0, 0, 0))
+        compressor = zlib.compressobj(9 if optimize else compress_level)  # Все полосы сжимаются одним потоком
+        row_filter = b"\x01" if optimize else b"\x00"  # Фильтр строк PNG: Sub или без фильтра
+        for y in range(0, height, self.TILE_SIZE):  # Полосы высотой в одну плитку
+            band = self.crop((0, y, width, min(height, y + self.TILE_SIZE)))
+            if optimize:  # Фильтр Sub: из каждого байта вычитается тот же канал левого пикселя
+                band = ImageChops.subtract_modulo(band, band.crop((-1, 0, band.width - 1, band.height)))
+            data = band.tobytes()
+            rows = b"".join(row_filter + data[i:i + stride] for i in range(0, len(data), stride))
+            data = compressor.compress(rows)
+            if data:
+                chunk(b"IDAT", data)
+            if progress is not None:
+                progress(min(height, y + self.TILE_SIZE) / height)  # Доля записанных строк
+        chunk(b"IDAT", compressor.flush())
+        chunk(b"IEND", b"")
+
+
+def difference_mask(first, second):
+    """Возвращает маску "L" пикселей, которыми различаются изображения first и second: 255 - пиксели разные."""
+    difference = ImageChops.difference(first, second)
+    return functools.reduce(ImageChops.lighter, difference.split()).point(lambda value: 255 if value else 0)
+
+
+@functools.lru_cache(maxsize=16)
+def similarity_table(color, tolerance):
+    """Таблица для Image.point: по каждому каналу 255, если значение отличается от канала color не больше tolerance."""
+    table = []
+    for value in color:
+        table += [255 if abs(level - value) <= tolerance else 0 for level in range(256)]
+    return table
+
+
+def similar_mask(region, color, tolerance):
+    """
+    Возвращает маску (изображение "L") пикселей region, у которых каждый канал отличается от color не больше
+    чем на tolerance: 255 - похожий цвет, 0 - нет. Считается операциями Pillow над всем изображением сразу.
+    """
+    table = similarity_table(tuple(color), tolerance)
+    return functools.reduce(ImageChops.darker, region.point(table).split())  # Похожи все каналы
+
+
+def flood_spans(free, width, height, seeds):
+    """
+    Построчная заливка в bytearray free размера width x height (255 - похожий пиксель, ещё не попавший в заливку):
+    заливает области, связные с точками seeds (соседи по сторонам), обнуляя залитые пиксели.
+    Отрезок строки и отрезки соседних строк находятся поиском байтов (bytearray.find), а не обходом пикселей.
+    Возвращает залитые отрезки строк: (y, x начала, x конца).
+    """
+    spans = []
+    stack = list(seeds)
+    while stack:
+        x, y = stack.pop()
+        row = y * width
+        if not free[row + x]:  # Пиксель не похож или отрезок уже залит с другой строки
+            continue
+        left = free.rfind(0, row, row + x) + 1 or row  # Границы отрезка строки вокруг x
+        right = free.find(0, row + x, row + width)
+        if right < 0:
+            right = row + width
+        free[left:right] = bytes(right - left)  # Заливаем отрезок
+        spans.append((y, left - row, right - row))
+        for near in (y - 1, y + 1):  # Непрерывные куски похожих пикселей над и под отрезком
+            if 0 <= near < height:
+                start, end = left - row + near * width, right - row + near * width
+                while start < end:
+                    start = free.find(255, start, end)
+                    if start < 0:
+                        break
+                    stack.append((start - near * width, near))
+                    start = free.find(0, start, end)
+                    if start < 0:
+                        break
+    return spans
+
+
+def flood_mask(mask, seed):
+    """Оставляет в маске mask только область, связную с точкой seed (соседи по сторонам), заливкой flood_spans."""
+    free = bytearray(mask.tobytes())  # 255 - похожий пиксель, ещё не попавший в заливку
+    flood_spans(free, mask.width, mask.height, [seed])
+    return ImageChops.subtract(mask, Image.frombytes("L", mask.size, bytes(free)))  # Залитые пиксели
+
+
+BRUSH_SUPERSAMPLING = 4  # Во сколько раз маска штриха крупнее изображения до сглаживания
+BRUSH_CHUNK = 256  # Наибольший размер части штриха, рисуемой одной маской
+
+
+def brush_dabs(points, width, pressures=None):
+    """
+    Расставляет мазки кисти вдоль ломаной points (плоский список координат) с постоянным шагом - четверть
+    диаметра мазка, но не меньше пикселя, - независимо от того, как часто пришли точки. Нажим pressures
+    (0..1 для каждой точки, по умолчанию 1) интерполируется между точками. Возвращает список (x, y, нажим).
+    """
+    xs, ys = points[0::2], points[1::2]
+    weights = pressures if pressures is not None else [1.0] * len(xs)
+    dabs = [(xs[0], ys[0], weights[0])]  # Первый мазок - в начале ломаной
+    spacing = max(1.0, width * weights[0] / 4)  # Шаг до следующего мазка
+    carry = 0.0  # Путь от последнего мазка до начала отрезка
+    for i in range(1, len(xs)):
+        dx, dy = xs[i] - xs[i - 1], ys[i] - ys[i - 1]
+        length = math.hypot(dx, dy)
+        distance = spacing - carry  # Путь по отрезку до следующего мазка
+        while distance <= length:
+            t = distance / length
+            weight = weights[i - 1] + (weights[i] - weights[i - 1]) * t
+            dabs.append((xs[i - 1] + dx * t, ys[i - 1] + dy * t, weight))
+            spacing = max(1.0, width * weight / 4)
+            distance += spacing
+        carry = length - (distance - spacing)
+    if dabs[-1][:2] != (xs[-1], ys[-1]):  # Последний мазок - в конце ломаной
+        dabs.append((xs[-1], ys[-1], weights[-1]))
+    return dabs
+
+
+def brush_masks(points, width, opacity=1.0, pressures=None):
+    """
+    Рисует сглаженные маски штриха кистью толщины width: мазки brush_dabs (круги диаметра width * нажим
+    с непрозрачностью opacity * нажим) рисуются в маску, увеличенную в BRUSH_SUPERSAMPLING раз, которая затем
+    уменьшается усреднением (Image.reduce). Края получаются сглаженными по точной площади покрытия, а мазки
+    накладываются вместе, без смешивания каждого мазка с изображением. Длинный штрих рисуется частями
+    не больше BRUSH_CHUNK пикселей. Возвращает список (маска "L", (x0, y0) - её левый верхний угол).
+    """
+    scale = BRUSH_SUPERSAMPLING
+    dabs = brush_dabs(points, width, pressures)
+    masks = []
+    start = 0
+    while start < len(dabs):
+        x0 = x1 = dabs[start][0]  # Охватывающий прямоугольник центров мазков части
+        y0 = y1 = dabs[start][1]
+        end = start + 1
+        while end < len(dabs):  # Добавляем мазки, пока часть не больше BRUSH_CHUNK
+            x, y = dabs[end][0], dabs[end][1]
+            if max(x1, x) - min(x0, x) > BRUSH_CHUNK or max(y1, y) - min(y0, y) > BRUSH_CHUNK:
+                break
+            x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x), max(y1, y)
+            end += 1
+        margin = width / 2 + 1  # Запас на радиус мазка и сглаживание
+        left, top = math.floor(x0 - margin), math.floor(y0 - margin)
+        size = (math.ceil(x1 + margin) + 1 - left, math.ceil(y1 + margin) + 1 - top)
+        big = Image.new("L", (size[0] * scale, size[1] * scale), 0)  # Увеличенная маска части
+        draw = ImageDraw.Draw(big)
+        for x, y, pressure in dabs[start:end]:
+            radius = max(0.5, width * pressure / 2) * scale
+            cx, cy = (x + 0.5 - left) * scale, (y + 0.5 - top) * scale  # Центр пикселя в увеличенной маске
+            draw.ellipse((cx - radius, cy - radius, cx + radius - 1, cy + radius - 1),
+                         fill=round(255 * opacity * pressure))
+        masks.append((big.reduce(scale), (left, top)))
+        start = end
+    return masks
+
+
+FONT_DIRS = [
+    os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts"),  # Windows
+    "/Library/Fonts", "/System/Library/Fonts", os.path.expanduser("~/Library/Fonts"),  # macOS
+    "/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),  # Linux
+]  # Системные каталоги шрифтов
+
+
+@functools.lru_cache(maxsize=None)
+def find_font_file(family):
+    """
+    Ищет файл шрифта family (например, "arial") в системных каталогах шрифтов.
+    Результат (путь или None) кэшируется, поэтому каталоги просматриваются один раз для каждого шрифта.
+    """
+    names = {family.lower() + extension for extension in (".ttf", ".otf", ".ttc")}  # Возможные имена файла
+    for folder in FONT_DIRS:
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if filename.lower() in names:
+                    return os.path.join(dirpath, filename)
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(family, size):
+    """
+    Возвращает шрифт family размера size и флаг, найден ли он. Загруженные шрифты кэшируются (LRU).
+    Если шрифта нет в системе, возвращается стандартный шрифт PIL.
+    """
+    path = find_font_file(family)  # Путь к файлу шрифта
+    if path is not None:
+        return ImageFont.truetype(path, size), True
+    try:
+        return ImageFont.load_default(size), False  # Масштабируемый стандартный шрифт (Pillow 10.1+)
+    except TypeError:
+        return ImageFont.load_default(), False  # Старые версии Pillow
+
+
+@functools.lru_cache(maxsize=512)
+def render_text_mask(text, family, size):
+    """
+    Рендерит надпись в маску (изображение "L") и возвращает её вместе со смещением (left, top) маски
+    относительно точки привязки текста. Повторяющиеся надписи (подписи, пометки) берутся из кэша (LRU)
+    и только штампуются в изображение. Возвращаемую маску изменять нельзя.
+    """
+    font = load_font(family, size)[0]
+    left, top, right, bottom = font.getbbox(text)  # Размеры текста относительно точки привязки
+    mask = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)  # Рисуем текст в маску
+    return mask, (left, top)
+
+
+class HistoryStep:
+    """
+    Шаг истории отмены: состояние изображения до (или после) одного действия.
+
+    Хранит только плитки, которые действие затронуло, поэтому память шага зависит от площади изменений,
+    а не от размера холста. Сначала плитки хранятся как общие с изображением объекты (без копирования,
+    чтобы не задерживать рисование), а в свободное время сжимаются методом compress.
+
+    Атрибуты:
+        tiles (dict): Плитки слоев: (слой, tx, ty) -> изображение PIL, сжатые байты или None (плитки не было);
+            у шага из заплаток - (маска, пиксели, ожидаемые пиксели) для DrawingEngine.patch_tiles.
+        state (dict): Состояние холста вне плиток (DrawingEngine.capture_state).
+        tag (str): Тег элементов холста Tk, созданных или скрытых действием.
+        shows_items (bool): True, если действие добавляет элементы с тегом tag, False - если скрывает их.
+        commands (list): Команды рисования, выполненные действием (при отмене они убираются из рисунка).
+        patch (bool): Шаг из заплаток (действие на общем холсте), а не из плиток целиком.
+        nbytes (int): Примерный объем памяти, занятый шагом.
+    """
+
+    def __init__(self, tiles, state, tag, shows_items, commands=(), patch=False):
+        self.tiles = tiles  # Плитки до (или после) действия
+        self.patch = patch  # Плитки - заплатки
+        self.state = state  # Состояние холста вне плиток
+        self.tag = tag  # Тег элементов холста Tk
+        self.shows_items = shows_items  # Показывает или скрывает действие элементы с тегом
+        self.commands = commands  # Команды действия
+        self.nbytes = 256 + sum(self.tile_nbytes(tile) for tile in tiles.values())  # Память шага
+
+    @staticmethod
+    def tile_nbytes(tile):
+        """Память, занятая плиткой: размер пикселей несжатой плитки или длина сжатых байтов."""
+        if isinstance(tile, tuple):  # Заплатка: маска и пиксели
+            return sum(HistoryStep.tile_nbytes(part) for part in tile)
+        if isinstance(tile, Image.Image):
+            return tile.width * tile.height * len(tile.getbands())
+        return len(tile) if tile else 0
+
+    def compress(self, limit):
+        """Сжимает не больше limit несжатых плиток шага. Возвращает True, если несжатых плиток не осталось."""
+        for key, tile in self.tiles.items():
+            parts = tile if isinstance(tile, tuple) else (tile,)  # У заплатки сжимаются маска и оба вида пикселей
+            if any(isinstance(part, Image.Image) for part in parts):
+                if not limit:  # Лимит исчерпан, а несжатые плитки еще есть
+                    return False
+                data = tuple(zlib.compress(part.tobytes(), 1) if isinstance(part, Image.Image) else part
+                             for part in parts)  # Быстрое сжатие: плитки в основном одноцветные
+                data = data if isinstance(tile, tuple) else data[0]
+                self.nbytes += self.tile_nbytes(data) - self.tile_nbytes(tile)
+                self.tiles[key] = data
+                limit -= 1
+        return True
+
+
+class History:
+    """
+    История отмены и повтора действий с ограничением по памяти.
+
+    Новые шаги сжимаются позже, по частям, вызовами compress_some. Если шаги занимают больше budget_bytes,
+    ожидающие шаги сначала сжимаются сразу, и только если памяти все равно не хватает (или шагов больше
+    max_steps), самые старые шаги отмены удаляются. Иначе одна очистка большого холста, еще не сжатая,
+    вытесняла бы всю историю.
+
+    Атрибуты:
+        undo_steps (collections.deque): Шаги для отмены, от старых к новым.
+        redo_steps (list): Шаги для повтора, последний отменённый - в конце.
+        uncompressed (collections.deque): Шаги, плитки которых еще не сжаты.
+        nbytes (int): Память, занятая всеми шагами отмены и повтора.
+    """
+
+    def __init__(self, budget_bytes=64 * 1024 * 1024, max_steps=200):
+        self.budget_bytes = budget_bytes  # Ограничение памяти истории
+        self.max_steps = max_steps  # Ограничение числа шагов отмены
+        self.undo_steps = collections.deque()  # Шаги для отмены
+        self.redo_steps = []  # Шаги для повтора
+        self.uncompressed = collections.deque()  # Шаги, ожидающие сжатия
+        self.nbytes = 0  # Память всех шагов
+
+    def push(self, step):
+        """Добавляет шаг отмены и возвращает шаги, которые были вытеснены из-за ограничений."""
+        self.undo_steps.append(step)
+        self.uncompressed.append(step)
+        self.nbytes += step.nbytes
+        while self.nbytes > self.budget_bytes and self.compress_some(float("inf")):
+            pass  # Сначала сжимаем ожидающие шаги целиком, а вытесняем только то, что и сжатым не помещается
+        evicted = []
+        while len(self.undo_steps) > 1 and (self.nbytes > self.budget_bytes or len(self.undo_steps) > self.max_steps):
+            old = self.undo_steps.popleft()  # Самый старый шаг
+            self.nbytes -= old.nbytes
+            evicted.append(old)
+        return evicted
+
+    def clear(self):
+        """Удаляет все шаги отмены и повтора."""
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.uncompressed.clear()
+        self.nbytes = 0
+
+    def drop_redo(self):
+        """Удаляет все шаги повтора (после нового действия они больше не нужны) и возвращает их."""
+        dropped, self.redo_steps = self.redo_steps, []
+        self.nbytes -= sum(step.nbytes for step in dropped)
+        return dropped
+
+    def pop_undo(self):
+        """Забирает последний шаг отмены (None, если отменять нечего)."""
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.nbytes -= step.nbytes
+        return step
+
+    def pop_redo(self):
+        """Забирает последний шаг повтора (None, если повторять нечего)."""
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.nbytes -= step.nbytes
+        return step
+
+    def push_redo(self, step):
+        """Добавляет шаг повтора."""
+        self.redo_steps.append(step)
+        self.uncompressed.append(step)
+        self.nbytes += step.nbytes
+
+    def compress_some(self, limit=8):
+        """Сжимает не больше limit плиток ожидающих шагов. Возвращает True, если сжимать еще есть что."""
+        while self.uncompressed:
+            step = self.uncompressed[0]
+            if step not in self.undo_steps and step not in self.redo_steps:  # Шаг уже удален из истории
+                self.uncompressed.popleft()
+                continue
+            nbytes = step.nbytes
+            done = step.compress(limit)
+            self.nbytes += step.nbytes - nbytes  # Сжатие уменьшает память шага
+            if not done:  # Лимит исчерпан на этом шаге
+                return True
+            self.uncompressed.popleft()
+            return bool(self.uncompressed)
+        return False
+
+
+ANCHORS = {"nw": (0, 0), "n": (0.5, 0), "ne": (1, 0), "w": (0, 0.5), "center": (0.5, 0.5), "e": (1, 0.5),
+           "sw": (0, 1), "s": (0.5, 1), "se": (1, 1)}  # Положение рисунка при смене размера: доли свободного места
+RESAMPLING = {"nearest": Image.Resampling.NEAREST, "bilinear": Image.Resampling.BILINEAR,
+              "bicubic": Image.Resampling.BICUBIC, "lanczos": Image.Resampling.LANCZOS}  # Фильтры масштабирования
+
+
+class Layer:
+    """
+    Слой рисунка: прозрачное изображение RGBA из плиток.
+
+    Атрибуты:
+        image (TiledImage): Пиксели слоя; там, где на слое ничего не нарисовано, он прозрачен.
+        visible (bool): Флаг, виден ли слой.
+    """
+
+    def __init__(self, size, visible=True):
+        self.image = TiledImage(size, (0, 0, 0, 0), "RGBA")  # Пустой прозрачный слой
+        self.visible = visible  # Видимость слоя
+
+
+class DrawingEngine:
+    """
+    Движок рисования: выполняет команды рисования над слоями и хранит их сведенное изображение.
+
+    Рисунок состоит из фона (цвета background_color) и слоев с прозрачностью; рисование идет на активном слое.
+    Сведенное изображение кэшируется по плиткам и пересчитывается только там, где изменился какой-нибудь слой:
+    в flat хранятся сведенные слои без фона, в image - они же поверх фона. Поэтому смена фона
+    накладывает на фон одну готовую плитку flat, а не заново сводит все слои, а отображение, сохранение
+    и пипетка читают готовое изображение image.
+
+    Команды - словари с ключом "op" и аргументами соответствующего метода:
+        {"op": "line", "points": [x0, y0, x1, y1, ...], "color": "#000000", "width": 5}
+        {"op": "line", "points": [...], "color": "#000000", "width": 5, "opacity": 0.5, "pressures": [1.0, ...],
+         "start": true}
+        {"op": "erase", "points": [x0, y0, x1, y1, ...], "width": 5}
+        {"op": "text", "x": 10, "y": 20, "text": "Привет", "color": "black", "size": 12, "font": "arial"}
+        {"op": "fill", "x": 10, "y": 20, "color": "#ff0000", "tolerance": 32, "contiguous": true,
+         "background": "#ffffff"}
+        {"op": "fill", "x": 10, "y": 20, "color": null, "tolerance": 32, "contiguous": false,
+         "box": [0, 0, 850, 500]}
+        {"op": "clear"}
+        {"op": "background", "color": "#ffffff"}
+        {"op": "resize", "width": 1000, "height": 800, "anchor": "center", "scale": false, "resample": "bicubic"}
+        {"op": "add_layer"}
+        {"op": "select_layer", "index": 0}
+        {"op": "layer_visibility", "index": 0, "visible": false}
+
+    Атрибуты:
+        layers (list): Слои (Layer) снизу вверх.
+        active (int): Номер слоя, на котором идет рисование.
+        background_color (str): Цвет фона.
+        flat (TiledImage): Кэш сведенных видимых слоев без фона (RGBA).
+        image (TiledImage): Кэш сведенного изображения: слои поверх фона (RGB).
+        stroke (tuple): Буфер текущего полупрозрачного штриха (см. line) или None.
+    """
+
+    OPS = ("line", "erase", "text", "fill", "clear", "background", "resize", "add_layer", "select_layer",
+           "layer_visibility")  # Допустимые команды
+
+    def __init__(self, size=(850, 500), background="white"):
+        """Создает движок с одним пустым слоем размера size на фоне цвета background."""
+        self.layers = [Layer(size)]  # Один слой для рисования
+        self.active = 0  # Рисование идет на нем
+        self.background_color = background  # Цвет фона
+        self.flat = TiledImage(size, (0, 0, 0, 0), "RGBA")  # Сведенные слои (пока пусто)
+        self.image = TiledImage(size, background)  # Сведенное изображение (пока только фон)
+        self.stroke = None  # Буфер полупрозрачного штриха: (слой, цвет) и плитки до штриха с покрытием
+
+    def apply(self, command):
+        """
+        Выполняет одну команду рисования. Возвращает изменённую область изображения (x0, y0, x1, y1)
+        или None, если изображение не изменилось.
+        """
+        op = command.get("op")
+        if op not in self.OPS:
+            raise ValueError("Неизвестная команда: %r" % (op,))
+        if op != "line":  # Полупрозрачный штрих закончился
+            self.stroke = None
+        return getattr(self, op)(**{key: value for key, value in command.items() if key != "op"})
+
+    def render(self, commands):
+        """Выполняет последовательность команд и возвращает получившееся изображение."""
+        for command in commands:
+            self.apply(command)
+        return self.image
+
+    @property
+    def layer(self):
+        """Изображение активного слоя."""
+        return self.layers[self.active].image
+
+    def line(self, points, color, width, opacity=1.0, pressures=None, start=False):
+        """
+        Рисует штрих кистью DrawingApp: сглаженные круглые мазки вдоль ломаной (brush_masks).
+        Аргумент opacity - непрозрачность кисти, pressures - нажим в каждой точке (0..1), уменьшающий толщину
+        и непрозрачность. Штрих приходит частями (по кадрам), поэтому полупрозрачные части накапливаются
+        в буфере штриха (draw_stroke) и не темнеют там, где перекрываются; start=True начинает новый штрих.
+        """
+        if len(points) < 4:  # Линию можно нарисовать только по двум и более точкам
+            return None
+        buffered = opacity < 1 or pressures is not None  # Нужен ли буфер штриха
+        if buffered and (start or self.stroke is None or self.stroke[0] != (self.active, color)):
+            self.stroke = ((self.active, color), {})  # Новый штрих
+        box = None
+        for mask, xy in brush_masks(points, width, opacity, pressures):
+            part = self.draw_stroke(xy, mask, color) if buffered else self.layer.draw_mask(xy, mask, color)
+            box = part if box is None else (min(box[0], part[0]), min(box[1], part[1]),
+                                            max(box[2], part[2]), max(box[3], part[3]))
+        return self.refresh(box)
+
+    def draw_stroke(self, xy, mask, color):
+        """
+        Накладывает маску части полупрозрачного штриха: покрытие штриха в каждой плитке - наибольшее из масок
+        его частей, а плитка слоя заново получается из плитки до штриха и цвета с прозрачностью покрытия.
+        Возвращает изменённую область (x0, y0, x1, y1).
+        """
+        layer = self.layer
+        tiles = self.stroke[1]  # Плитка -> [плитка до штриха, покрытие]
+        x0, y0 = xy
+        box = (x0, y0, x0 + mask.width, y0 + mask.height)
+        size = layer.TILE_SIZE
+        for key in layer.tile_keys(box):
+            if key not in tiles:  # Штрих впервые попал в плитку - запоминаем её
+                tile = layer.get_tile(key)
+                tiles[key] = [tile.copy() if tile is not None else None, Image.new("L", (size, size), 0)]
+            base, coverage = tiles[key]
+            part = Image.new("L", (size, size), 0)
+            part.paste(mask, (x0 - key[0] * size, y0 - key[1] * size))  # Маска в координатах плитки
+            coverage = tiles[key][1] = ImageChops.lighter(coverage, part)
+            x, y = key[0] * size, key[1] * size
+            region = (max(0, x0 - x), max(0, y0 - y), min(size, box[2] - x), min(size, box[3] - y))
+            patch = Image.new("RGBA", (region[2] - region[0], region[3] - region[1]),
+                              ImageColor.getcolor(color, "RGBA"))
+            patch.putalpha(coverage.crop(region))
+            layer.remember_tile(key)  # Сохраняем прежнее состояние плитки для отмены
+            # Собирается только часть плитки под маской: сведенное изображение пересчитывается только в ней
+            layer.writable_tile(key).paste(patch if base is None else Image.alpha_composite(base.crop(region), patch),
+                                           region[:2])
+        return box
+
+    def erase(self, points, width):
+        """Стирает ломаную на активном слое до полной прозрачности сглаженными мазками, как ластик DrawingApp."""
+        if len(points) < 4:
+            return None
+        box = None
+        for mask, xy in brush_masks(points, width):
+            part = self.layer.erase_mask(xy, mask)
+            box = part if box is None else (min(box[0], part[0]), min(box[1], part[1]),
+                                            max(box[2], part[2]), max(box[3], part[3]))
+        return self.refresh(box)
+
+    def text(self, x, y, text, color, size, font="arial"):
+        """Рисует надпись с левым верхним углом в точке (x, y), как режим текста DrawingApp."""
+        mask, (left, top) = render_text_mask(text, font, size)  # Маска надписи из кэша
+        return self.refresh(self.layer.draw_mask((x + left, y + top), mask, color))
+
+    def similar_region(self, x, y, tolerance=32, contiguous=True, box=None):
+        """
+        Находит пиксели сведенного изображения в области box (по умолчанию - всё изображение; box - явное
+        ограничение), цвет которых отличается от цвета точки (x, y) не больше чем на tolerance по каждому каналу;
+        при contiguous=True - только связные с точкой (x, y). Область обходится по плиткам (TiledImage.flood),
+        поэтому маска размером с изображение не строится. Возвращает маски по плиткам
+        {(tx, ty): (маска "L", левый верхний угол)} и рамку найденных пикселей (x0, y0, x1, y1)
+        или None, если точка вне области.
+        """
+        width, height = self.image.size
+        x0, y0, x1, y1 = box if box is not None else (0, 0, width, height)
+        box = (max(0, int(x0)), max(0, int(y0)), min(width, int(x1)), min(height, int(y1)))
+        if not (box[0] <= x < box[2] and box[1] <= y < box[3]):
+            return None
+        color = self.image.getpixel((x, y))
+        if contiguous:
+            masks = self.image.flood((x, y), color, tolerance, box)
+        else:
+            masks = {}
+            for key in self.image.tile_keys(box):
+                x0, y0, x1, y1 = self.image.tile_box(key)
+                part = (max(x0, box[0]), max(y0, box[1]), min(x1, box[2]), min(y1, box[3]))  # Часть плитки в box
+                mask = self.image.similar(part, color, tolerance)
+                if mask.getbbox() is not None:
+                    masks[key] = (mask, part[:2])
+        boxes = [(left + bbox[0], top + bbox[1], left + bbox[2], top + bbox[3])
+                 for bbox, (left, top) in ((mask.getbbox(), origin) for mask, origin in masks.values())]
+        if not boxes:
+            return masks, None
+        return masks, (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                       max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    def fill(self, x, y, color, tolerance=32, contiguous=True, box=None, background=None):
+        """
+        Заливает цветом color на активном слое область похожего цвета вокруг точки (x, y) (см. similar_region;
+        при contiguous=False - все похожие пиксели области box). Цвет None стирает область до прозрачности.
+        Заливка идет по плиткам и охватывает всю связную область, а не только видимую часть холста.
+        background - цвет фона, на котором команда записана: область ищется на нём, даже если при
+        воспроизведении фон уже другой (команды смены фона при сжатии проекта отбрасываются).
+        """
+        current = self.background_color
+        if background is not None and ImageColor.getrgb(background) != ImageColor.getrgb(current):
+            self.background(background)  # Область зависит от фона под полупрозрачными и пустыми пикселями
+            try:
+                found = self.similar_region(x, y, tolerance, contiguous, box)
+            finally:
+                self.background(current)
+        else:
+            found = self.similar_region(x, y, tolerance, contiguous, box)
+        if found is None or found[1] is None:
+            return None
+        masks, bbox = found
+        color = (0, 0, 0, 0) if color is None else color
+        for mask, (left, top) in masks.values():
+            self.refresh(self.layer.draw_mask((left, top), mask, color, replace=True))
+        return bbox
+
+    def clear(self):
+        """Очищает все слои: остается только фон."""
+        for layer in self.layers:
+            layer.image.clear()
+        self.flat.clear()  # Кэши сведенного изображения пусты
+        self.image.clear()
+        return (0, 0) + self.image.size
+
+    def background(self, color):
+        """Меняет цвет фона. Кэш сведенных слоев не меняется: на новый фон накладываются его готовые плитки."""
+        self.background_color = color
+        self.image.color = ImageColor.getcolor(color, self.image.mode)
+        for key in list(self.flat.tiles) + list(self.flat.spilled):
+            if not callable(self.image.spilled.get(key)):  # Отложенная плитка наложится на новый фон сама
+                self.image.set_tile(key, self.blend(self.flat.get_tile(key)))
+        return (0, 0) + self.image.size
+
+    def resize(self, width, height, anchor="nw", scale=False, resample="bicubic"):
+        """
+        Меняет размер изображения, сохраняя рисунок. Аргумент anchor - к какой стороне или углу
+        (ключ ANCHORS) прижат рисунок; при scale=True рисунок масштабируется с сохранением пропорций так,
+        чтобы поместиться в новый размер, фильтром resample (ключ RESAMPLING).
+        Без масштабирования плитки слоев и кэшей переносятся, а не перерисовываются.
+        """
+        old_width, old_height = self.image.size
+        factor = min(width / old_width, height / old_height) if scale else 1  # Масштаб рисунка
+        content = (max(1, round(old_width * factor)), max(1, round(old_height * factor)))  # Размер рисунка
+        fx, fy = ANCHORS[anchor]
+        offset = (int((width - content[0]) * fx), int((height - content[1]) * fy))  # Положение рисунка
+        if not scale:  # Сведенное изображение сдвигается вместе со слоями
+            for image in (self.image, self.flat):  # Отложенные плитки кэшей сводятся, пока слои на прежних местах
+                image.build_deferred()
+            for image in self.images():
+                image.move(offset, (width, height))
+            return (0, 0) + self.image.size
+        keys = set()  # Плитки, в которых после масштабирования есть рисунок
+        for layer in self.layers:
+            layer.image.rescale((width, height), content, offset, RESAMPLING[resample])
+            keys.update(layer.image.tiles, layer.image.spilled)
+        for image in (self.flat, self.image):  # Кэши сводятся заново по масштабированным слоям
+            image.clear()
+            image.size = (width, height)
+        self.refresh_tiles(keys)
+        return (0, 0) + self.image.size
+
+    def add_layer(self):
+        """Добавляет пустой слой поверх остальных и делает его активным."""
+        self.layers.append(Layer(self.image.size))
+        self.active = len(self.layers) - 1
+        return None
+
+    def select_layer(self, index):
+        """Делает активным слой index."""
+        self.active = index
+        return None
+
+    def layer_visibility(self, index, visible):
+        """Показывает или скрывает слой index; сведенное изображение пересчитывается только в плитках слоя."""
+        layer = self.layers[index]
+        if layer.visible == visible:
+            return None
+        layer.visible = visible
+        return self.refresh_tiles(list(layer.image.tiles) + list(layer.image.spilled))
+
+    def images(self):
+        """Возвращает все изображения движка: слои и кэши сведенного изображения."""
+        return [layer.image for layer in self.layers] + [self.flat, self.image]
+
+    @property
+    def nbytes(self):
+        """Память плиток всех изображений движка (слоев и кэшей сведенного изображения)."""
+        return sum(image.nbytes for image in self.images())
+
+    def blend(self, flat):
+        """Накладывает плитку сведенных слоев flat на фон и возвращает плитку сведенного изображения."""
+        tile = Image.new(self.image.mode, flat.size, self.image.color)
+        tile.paste(flat, (0, 0), flat)  # Прозрачность слоев - маска поверх фона
+        return tile
+
+    def refresh(self, box):
+        """Пересчитывает кэши сведенного изображения в области box и возвращает box."""
+        if box is not None:
+            for key in self.image.tile_keys(box):
+                x0, y0, x1, y1 = self.image.tile_box(key)
+                self.refresh_tile(key, (max(0, int(box[0]) - x0), max(0, int(box[1]) - y0),
+                                        min(x1, int(box[2])) - x0, min(y1, int(box[3])) - y0))
+        return box
+
+    def refresh_tiles(self, keys, defer=False):
+        """
+        Пересчитывает кэши сведенного изображения в плитках keys целиком; при defer=True только откладывает
+        пересчет до первого обращения к плитке (TiledImage.defer_tile).
+        Возвращает область, охватывающую пересчитанные плитки (None, если плиток нет).
+        """
+        box = None
+        for key in keys:
+            tile_box = self.image.tile_box(key)
+            if defer:
+                self.flat.defer_tile(key, functools.partial(self.compose_tile, key))
+                self.image.defer_tile(key, functools.partial(self.blend_tile, key))
+            else:
+                self.refresh_tile(key, (0, 0, self.image.TILE_SIZE, self.image.TILE_SIZE))
+            box = tile_box if box is None else (min(box[0], tile_box[0]), min(box[1], tile_box[1]),
+                                                max(box[2], tile_box[2]), max(box[3], tile_box[3]))
+        return box
+
+    def compose_tile(self, key):
+        """Сводит плитку key видимых слоев целиком (None, если ни на одном видимом слое её нет)."""
+        tiles = [layer.image.get_tile(key) for layer in self.layers if layer.visible]
+        tiles = [tile for tile in tiles if tile is not None]
+        if not tiles:
+            return None
+        part = tiles[0].copy()
+        for tile in tiles[1:]:  # Накладываем слои снизу вверх
+            part = Image.alpha_composite(part, tile)
+        return part
+
+    def blend_tile(self, key):
+        """Накладывает плитку key сведенных слоев на фон (None, если плитки нет - там только фон)."""
+        flat = self.flat.get_tile(key)
+        return None if flat is None else self.blend(flat)
+
+    def refresh_tile(self, key, region):
+        """
+        Пересчитывает кэши сведенного изображения в части region = (x0, y0, x1, y1) плитки key:
+        сводит эту часть видимых слоев и накладывает её на фон. Пересчитывается только изменённая часть,
+        поэтому штрих стоит пропорционально своей площади, а не площади плиток.
+        """
+        tiles = [layer.image.get_tile(key) for layer in self.layers if layer.visible]
+        tiles = [tile for tile in tiles if tile is not None]
+        if not tiles:  # Ни на одном видимом слое плитки нет - здесь только фон
+            self.flat.set_tile(key, None)
+            self.image.set_tile(key, None)
+            return
+        if region == (0, 0, self.image.TILE_SIZE, self.image.TILE_SIZE) and len(tiles) == 1:
+            part = tiles[0].copy()  # Один слой целиком - сводить нечего
+        else:
+            part = tiles[0].crop(region)
+            for tile in tiles[1:]:  # Накладываем слои снизу вверх
+                part = Image.alpha_composite(part, tile.crop(region))
+        self.flat.writable_tile(key).paste(part, region[:2])
+        tile = self.image.writable_tile(key)
+        tile.paste(self.image.color, region)  # Фон под слоями
+        tile.paste(part, region[:2], part)  # Прозрачность слоев - маска поверх фона
+
+    def begin_changes(self):
+        """Начинает запись прежнего состояния изменяемых плиток всех слоев (для истории отмены)."""
+        for layer in self.layers:
+            layer.image.begin_changes()
+
+    def end_changes(self):
+        """Заканчивает запись и возвращает прежнее состояние плиток: (слой, tx, ty) -> плитка или None."""
+        changes = {}
+        for index, layer in enumerate(self.layers):
+            for (tx, ty), tile in layer.image.end_changes().items():
+                changes[(index, tx, ty)] = tile
+        return changes
+
+    def restore_tiles(self, states):
+        """
+        Восстанавливает плитки слоев из states: (слой, tx, ty) -> плитка, сжатые байты или None.
+        Сжатые плитки и сведенное изображение в этих плитках распаковываются и сводятся только при первом
+        обращении, поэтому большой проект открывается без обхода всех плиток. Возвращает прежнее состояние плиток.
+        """
+        self.stroke = None  # Плитки, запомненные буфером штриха, заменяются
+        by_layer = collections.defaultdict(dict)
+        for (index, tx, ty), tile in states.items():
+            by_layer[index][(tx, ty)] = tile
+        inverse = {}
+        for index, tiles in by_layer.items():
+            for (tx, ty), tile in self.layers[index].image.restore_tiles(tiles).items():
+                inverse[(index, tx, ty)] = tile
+        self.refresh_tiles({(tx, ty) for _, tx, ty in states}, defer=True)
+        return inverse
+
+    def patch_tiles(self, patches):
+        """
+        Накладывает заплатки patches: (слой, tx, ty) -> (маска "L", новые пиксели, ожидаемые пиксели) -
+        изображения или сжатые байты (HistoryStep.compress), пиксели None - цвет фона. Под маской заменяются
+        только пиксели, равные ожидаемым, поэтому остальное содержимое плиток и пиксели, которые с тех пор
+        изменил кто-то еще (участник сеанса), сохраняются. Возвращает обратные заплатки.
+        """
+        self.stroke = None  # Плитки, запомненные буфером штриха, изменяются
+        inverse = {}
+        for (index, tx, ty), (mask, pixels, expected) in patches.items():
+            if index < len(self.layers):  # Слой мог быть удален отменой
+                self.layers[index].image.patch_tile((tx, ty), mask, pixels, expected)
+                inverse[(index, tx, ty)] = (mask, expected, pixels)
+        self.refresh_tiles({(tx, ty) for _, tx, ty in inverse})
+        return inverse
+
+    def layer_snapshots(self):
+        """Возвращает снимки слоев (TiledImage.snapshot) для чтения в другом потоке."""
+        return [layer.image.snapshot() for layer in self.layers]
+
+    def capture_state(self):
+        """Возвращает состояние вне плиток: размер изображения, цвет фона, видимость слоев и активный слой."""
+        return {"size": self.image.size, "background": self.background_color,
+                "layers": [layer.visible for layer in self.layers], "active": self.active}
+
+    def restore_state(self, state):
+        """Восстанавливает состояние, сохраненное capture_state, и пересчитывает затронутое им изображение."""
+        size = tuple(state["size"])
+        for image in self.images():
+            image.size = size
+        changed = set()  # Плитки, где изменилась видимость или число слоев
+        for layer in self.layers[len(state["layers"]):]:  # Лишние слои (добавленные после состояния) удаляются
+            changed.update(layer.image.tiles, layer.image.spilled)
+        del self.layers[len(state["layers"]):]
+        for index, visible in enumerate(state["layers"]):
+            if index == len(self.layers):
+                self.layers.append(Layer(size, visible))
+            elif self.layers[index].visible != visible:
+                self.layers[index].visible = visible
+                changed.update(self.layers[index].image.tiles, self.layers[index].image.spilled)
+        self.active = state["active"]
+        self.refresh_tiles(changed)
+        if state["background"] != self.background_color:
+            self.background(state["background"])
+
+
+def load_commands(path):
+    """Читает команды рисования из файла JSON Lines (пустые строки пропускаются)."""
+    with open(path, encoding="utf-8") as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def dump_commands(commands, path):
+    """Записывает команды рисования в файл JSON Lines."""
+    with open(path, "w", encoding="utf-8") as stream:
+        for command in commands:
+            stream.write(json.dumps(command, ensure_ascii=False) + "\n")
+
+
+def render_file(path, out_path, size=(850, 500)):
+    """
+    Выполняет команды из файла path и сохраняет результат в PNG out_path.
+    Возвращает время работы в секундах. Функция верхнего уровня, чтобы её можно было отдать в пул процессов.
+    """
+    start = time.perf_counter()
+    DrawingEngine(size).render(load_commands(path)).save(out_path)
+    return time.perf_counter() - start
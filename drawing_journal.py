@@ -0,0 +1,456 @@
+"""
+Журнал операций рисования для восстановления после сбоя.
+
+Каждая команда движка (DrawingEngine.apply) дописывается в конец двоичного файла журнала, а состояние после
+отмены и повтора - набором восстановленных плиток слоев. Запись, сброс на диск (fsync) пачками и контрольные
+точки выполняются в отдельном потоке, поэтому интерфейс не ждет диска. Контрольная точка - сжатые плитки
+снимков слоев и состояние холста; после неё журнал начинается заново. При следующем запуске
+recover восстанавливает рисунок из последней контрольной точки и журнала после неё.
+
+Каждый экземпляр программы пишет журнал в свой подкаталог каталога автосохранения и держит на нем блокировку
+файла LOCK_NAME (claim_session). Блокировку снимает операционная система, когда процесс завершается, даже
+аварийно, поэтому восстановить можно только сеанс, блокировка которого свободна, а журналы работающих
+экземпляров не трогаются.
+
+Формат журнала: заголовок MAGIC + номер поколения, затем записи
+    код (1 байт), длина данных (4 байта), данные, CRC32 кода, длины и данных (4 байта).
+Запись с неверной контрольной суммой (оборванная при сбое) и все записи после неё отбрасываются.
+"""
+import array
+import json
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка через msvcrt
+    fcntl = None
+    import msvcrt
+
+JOURNAL_MAGIC = b"DRWJ\x02"  # Сигнатура и версия файла журнала
+CHECKPOINT_MAGIC = b"DRWC\x02"  # Сигнатура и версия файла контрольной точки
+JOURNAL_NAME = "journal.bin"  # Имя файла журнала в каталоге автосохранения
+CHECKPOINT_NAME = "checkpoint.bin"  # Имя файла контрольной точки
+LOCK_NAME = "owner.lock"  # Имя файла блокировки сеанса
+SESSION_PREFIX = "session-"  # Начало имени подкаталога сеанса
+
+RECORD_LINE = 1  # Команда "line": толщина, цвет и координаты в двоичном виде
+RECORD_COMMAND = 2  # Любая другая команда в виде JSON
+RECORD_TILES = 3  # Состояние холста и плитки слоев после отмены или повтора
+
+LINE_KEYS = frozenset(("op", "points", "color", "width"))  # Ключи штриха без дополнительных параметров кисти
+
+RECORD_HEADER = struct.Struct("<BI")  # Код записи и длина данных
+TILE_HEADER = struct.Struct("<iiiI")  # Номер слоя, координаты плитки и длина её сжатых байтов
+
+
+def pack_points(points):
+    """Упаковывает координаты в байты (int32, little-endian)."""
+    packed = array.array("i", [int(v) for v in points])
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_points(data):
+    """Распаковывает координаты, упакованные pack_points."""
+    points = array.array("i")
+    points.frombytes(data)
+    if sys.byteorder == "big":
+        points.byteswap()
+    return points.tolist()
+
+
+def pack_state(state):
+    """Упаковывает состояние холста (DrawingEngine.capture_state) в байты JSON с длиной впереди."""
+    data = json.dumps(state).encode("utf-8")
+    return struct.pack("<I", len(data)) + data
+
+
+def unpack_state(data, offset):
+    """Распаковывает состояние холста; возвращает его и смещение после него."""
+    (length,) = struct.unpack_from("<I", data, offset)
+    state = json.loads(data[offset + 4:offset + 4 + length].decode("utf-8"))
+    state["size"] = tuple(state["size"])  # JSON превращает кортежи в списки
+    return state, offset + 4 + length
+
+
+def pack_tiles(tiles):
+    """Упаковывает плитки (слой, tx, ty) -> изображение PIL, сжатые байты или None в байты."""
+    parts = [struct.pack("<I", len(tiles))]
+    for key, tile in tiles.items():
+        if tile is not None and not isinstance(tile, bytes):  # Несжатую плитку сжимаем
+            tile = zlib.compress(tile.tobytes(), 1)
+        parts.append(TILE_HEADER.pack(*key, len(tile or b"")) + (tile or b""))
+    return b"".join(parts)
+
+
+def unpack_tiles(data, offset):
+    """Распаковывает плитки, упакованные pack_tiles (пустые байты - плитки нет)."""
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    tiles = {}
+    for _ in range(count):
+        index, tx, ty, length = TILE_HEADER.unpack_from(data, offset)
+        offset += TILE_HEADER.size
+        tiles[(index, tx, ty)] = bytes(data[offset:offset + length]) or None
+        offset += length
+    return tiles, offset
+
+
+def is_plain_line(command):
+    """Проверяет, что команда - штрих без параметров кисти (непрозрачности, нажима): его можно хранить массивами."""
+    return command["op"] == "line" and command.keys() == LINE_KEYS
+
+
+def encode_record(kind, payload):
+    """Кодирует запись журнала: заголовок, данные и контрольную сумму."""
+    if kind == "command" and is_plain_line(payload):  # Самая частая команда - в компактном двоичном виде
+        color = payload["color"].encode("utf-8")
+        code, data = RECORD_LINE, struct.pack("<HB", payload["width"], len(color)) + color + pack_points(
+            payload["points"])
+    elif kind == "command":
+        code, data = RECORD_COMMAND, json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    else:  # Плитки и состояние после отмены или повтора
+        tiles, state = payload
+        code, data = RECORD_TILES, pack_state(state) + pack_tiles(tiles)
+    header = RECORD_HEADER.pack(code, len(data))
+    return header + data + struct.pack("<I", zlib.crc32(header + data) & 0xffffffff)
+
+
+def read_journal(path):
+    """
+    Читает журнал. Возвращает номер поколения и список записей: ("command", словарь команды) или
+    ("tiles", (плитки, состояние)). Оборванная или испорченная запись и всё после неё отбрасываются.
+    """
+    with open(path, "rb") as stream:
+        data = stream.read()
+    if not data.startswith(JOURNAL_MAGIC) or len(data) < len(JOURNAL_MAGIC) + 4:
+        return None, []
+    (generation,) = struct.unpack_from("<I", data, len(JOURNAL_MAGIC))
+    offset = len(JOURNAL_MAGIC) + 4
+    records = []
+    while offset + RECORD_HEADER.size <= len(data):
+        code, length = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end + 4 > len(data):  # Запись оборвана
+            break
+        (crc,) = struct.unpack_from("<I", data, end)
+        if crc != zlib.crc32(data[offset:end]) & 0xffffffff:  # Запись испорчена
+            break
+        payload = data[offset + RECORD_HEADER.size:end]
+        if code == RECORD_LINE:
+            width, color_length = struct.unpack_from("<HB", payload)
+            color = payload[3:3 + color_length].decode("utf-8")
+            records.append(("command", {"op": "line", "points": unpack_points(payload[3 + color_length:]),
+                                        "color": color, "width": width}))
+        elif code == RECORD_COMMAND:
+            records.append(("command", json.loads(payload.decode("utf-8"))))
+        elif code == RECORD_TILES:
+            state, position = unpack_state(payload, 0)
+            records.append(("tiles", (unpack_tiles(payload, position)[0], state)))
+        else:  # Неизвестный код - дальше читать нельзя
+            break
+        offset = end + 4
+    return generation, records
+
+
+def write_tiles(stream, layers, progress=None):
+    """
+    Записывает в stream число плиток и сжатые плитки снимков слоев layers (DrawingEngine.layer_snapshots).
+    Функция progress, если задана, получает долю записанных плиток.
+    """
+    keys = [(index, key) for index, layer in enumerate(layers)
+            for key in sorted(list(layer.tiles) + list(layer.spilled))]  # Все существующие плитки снимков
+    stream.write(struct.pack("<I", len(keys)))
+    for number, (index, key) in enumerate(keys):
+        data = zlib.compress(layers[index].get_tile(key).tobytes(), 1)
+        stream.write(TILE_HEADER.pack(index, key[0], key[1], len(data)) + data)
+        if progress is not None:
+            progress((number + 1) / len(keys))
+
+
+def release_layers(layers):
+    """Освобождает прочитанные снимки слоев (TiledImage.release), чтобы они не удерживали слоты файла подкачки."""
+    for layer in layers:
+        layer.release()
+
+
+def write_checkpoint(path, layers, state, generation):
+    """
+    Записывает контрольную точку: состояние холста и сжатые плитки снимков слоев.
+    Файл пишется во временный, сбрасывается на диск и атомарно заменяет прежнюю контрольную точку.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as stream:
+        stream.write(CHECKPOINT_MAGIC + struct.pack("<I", generation) + pack_state(state))
+        write_tiles(stream, layers)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(temp_path, path)
+
+
+def read_checkpoint(path):
+    """Читает контрольную точку. Возвращает номер поколения, состояние холста и сжатые плитки."""
+    with open(path, "rb") as stream:
+        data = stream.read()
+    if not data.startswith(CHECKPOINT_MAGIC):
+        raise ValueError("Файл не является контрольной точкой: %s" % path)
+    (generation,) = struct.unpack_from("<I", data, len(CHECKPOINT_MAGIC))
+    state, offset = unpack_state(data, len(CHECKPOINT_MAGIC) + 4)
+    return generation, state, unpack_tiles(data, offset)[0]
+
+
+def has_recovery(directory):
+    """Проверяет, остались ли в каталоге данные незавершенного сеанса (журнал с записями или контрольная точка)."""
+    checkpoint_path = os.path.join(directory, CHECKPOINT_NAME)
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    if os.path.exists(checkpoint_path):
+        return True
+    return os.path.exists(journal_path) and bool(read_journal(journal_path)[1])
+
+
+def recover(directory, engine):
+    """
+    Восстанавливает рисунок в движке engine из каталога автосохранения: загружает последнюю контрольную
+    точку и выполняет записи журнала после неё. Возвращает номер поколения контрольной точки
+    и число выполненных записей журнала.
+    """
+    checkpoint_path = os.path.join(directory, CHECKPOINT_NAME)
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    generation = 0  # Без контрольной точки журнал применяется к чистому холсту
+    if os.path.exists(checkpoint_path):
+        generation, state, tiles = read_checkpoint(checkpoint_path)
+        engine.restore_state(state)
+        engine.clear()  # Плиток, которых нет в контрольной точке, нет и на рисунке
+        engine.restore_tiles(tiles)
+    journal_generation, records = read_journal(journal_path) if os.path.exists(journal_path) else (None, [])
+    if journal_generation != generation:  # Журнал от предыдущей контрольной точки уже учтен в текущей
+        records = []
+    for kind, payload in records:
+        if kind == "command":
+            engine.apply(payload)
+        else:
+            tiles, state = payload
+            engine.restore_state(state)
+            engine.restore_tiles(tiles)
+    return generation, len(records)
+
+
+def lock_file(stream):
+    """Берет исключительную блокировку открытого файла stream без ожидания. Возвращает False, если файл занят."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(stream.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def unlock_file(stream):
+    """Снимает блокировку файла stream и закрывает его."""
+    if fcntl is None:  # В Windows блокировку нужно снять до закрытия файла
+        stream.seek(0)
+        msvcrt.locking(stream.fileno(), msvcrt.LK_UNLCK, 1)
+    stream.close()
+
+
+def remove_session(directory):
+    """Удаляет файлы сеанса и его подкаталог (блокировка сеанса уже должна быть снята или принадлежать нам)."""
+    for name in (JOURNAL_NAME, CHECKPOINT_NAME, CHECKPOINT_NAME + ".tmp", LOCK_NAME):
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(directory)
+    except OSError:  # Каталог уже удален или в нем остались чужие файлы
+        pass
+
+
+def claim_session(directory):
+    """
+    Выбирает подкаталог сеанса в каталоге автосохранения directory и блокирует его за этим процессом.
+    Если есть брошенный сеанс (его владелец завершился, не удалив журнал), с данными для восстановления,
+    выбирается самый свежий из них; брошенные сеансы без данных удаляются. Иначе создается новый подкаталог.
+    Возвращает путь подкаталога и открытый файл блокировки, который передается в Journal.
+    """
+    os.makedirs(directory, exist_ok=True)
+    sessions = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(SESSION_PREFIX)]
+    sessions.sort(key=os.path.getmtime, reverse=True)  # Сначала самые свежие
+    for session in sessions:
+        try:
+            lock = open(os.path.join(session, LOCK_NAME), "a+b")
+        except OSError:
+            continue
+        if not lock_file(lock):  # Сеанс работающего экземпляра программы
+            lock.close()
+            continue
+        if has_recovery(session):
+            return session, lock
+        unlock_file(lock)
+        remove_session(session)  # Восстанавливать нечего
+    session = tempfile.mkdtemp(prefix=SESSION_PREFIX, dir=directory)
+    lock = open(os.path.join(session, LOCK_NAME), "a+b")
+    lock_file(lock)
+    return session, lock
+
+
+class Journal:
+    """
+    Журнал операций рисования с записью в фоновом потоке.
+
+    Главный поток только кладет записи в очередь; поток записи дописывает их в файл и вызывает fsync
+    не чаще раза в FSYNC_INTERVAL секунд (или сразу после flush). Когда журнал вырастает больше
+    CHECKPOINT_BYTES, выставляется needs_checkpoint: приложение передает снимки слоев в checkpoint.
+
+    Атрибуты:
+        directory (str): Каталог сеанса автосохранения (claim_session).
+        lock (file): Файл блокировки каталога сеанса (None, если каталог не заблокирован).
+        generation (int): Номер поколения: растет с каждой контрольной точкой.
+        journal_bytes (int): Размер журнала после последней контрольной точки.
+        needs_checkpoint (bool): Флаг, что журнал пора свернуть в контрольную точку.
+        error (Exception): Ошибка записи (None, если ошибок не было); после ошибки журнал не пишется.
+    """
+
+    FSYNC_INTERVAL = 0.5  # Максимальный интервал между сбросами журнала на диск, секунд
+    CHECKPOINT_BYTES = 8 * 1024 * 1024  # Размер журнала, после которого нужна контрольная точка
+
+    def __init__(self, directory, layers=None, state=None, lock=None):
+        """
+        Начинает новый журнал в каталоге directory. Если переданы снимки слоев layers и состояние state
+        (например, после восстановления), сразу записывается контрольная точка с ними;
+        иначе прежние данные каталога удаляются и журнал начинается с чистого холста.
+        Блокировку каталога lock (claim_session) журнал снимает при закрытии.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = lock
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        self.checkpoint_path = os.path.join(directory, CHECKPOINT_NAME)
+        self.generation = 0
+        if layers is not None and os.path.exists(self.checkpoint_path):  # Поколение продолжает прежнее
+            self.generation = read_checkpoint(self.checkpoint_path)[0]
+        self.journal_bytes = 0
+        self.needs_checkpoint = False
+        self.error = None
+        self.stream = None  # Файл журнала открывает поток записи
+        self.queue = queue.Queue()  # Очередь записей для потока записи
+        self.thread = threading.Thread(target=self.run, name="drawing-journal", daemon=True)
+        if layers is not None:
+            self.checkpoint(layers, state)
+        else:
+            self.queue.put(("start", None))
+        self.thread.start()
+
+    def append(self, command):
+        """Добавляет в журнал команду движка."""
+        self.queue.put(("command", command))
+
+    def append_tiles(self, tiles, state):
+        """Добавляет в журнал плитки и состояние холста (после отмены или повтора)."""
+        self.queue.put(("tiles", (tiles, state)))
+
+    def flush(self):
+        """Просит поток записи сбросить журнал на диск, не дожидаясь интервала."""
+        self.queue.put(("flush", None))
+
+    def checkpoint(self, layers, state):
+        """
+        Передает потоку записи снимки слоев для контрольной точки, после которой журнал начнется заново.
+        Поток записи освобождает снимки, когда они прочитаны.
+        """
+        self.needs_checkpoint = False
+        self.journal_bytes = 0
+        self.queue.put(("checkpoint", (layers, state)))
+
+    def close(self, discard=True):
+        """
+        Останавливает поток записи, дождавшись записи очереди, и снимает блокировку каталога.
+        При discard=True (обычное закрытие программы) удаляет журнал и контрольную точку, а заблокированный
+        каталог сеанса - целиком: восстанавливать нечего.
+        """
+        self.queue.put(("close", discard))
+        self.thread.join()
+        if self.lock is not None:
+            unlock_file(self.lock)
+            self.lock = None
+            if discard:
+                remove_session(self.directory)
+
+    def run(self):
+        """Цикл потока записи: пишет записи пачками и сбрасывает их на диск."""
+        last_sync = time.monotonic()  # Время последнего fsync
+        dirty = False  # Есть ли записи, еще не сброшенные на диск
+        while True:
+            try:
+                timeout = max(0.0, self.FSYNC_INTERVAL - (time.monotonic() - last_sync)) if dirty else None
+                kind, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, payload = "flush", None  # Истек интервал - пора сбросить записи на диск
+            if kind == "close":
+                self.finish(payload)
+                return
+            if self.error is not None:  # После ошибки записи журнал не ведется
+                if kind == "checkpoint":
+                    release_layers(payload[0])
+                continue
+            try:
+                if kind == "start":
+                    self.start_journal()
+                elif kind == "checkpoint":
+                    layers, state = payload
+                    try:
+                        write_checkpoint(self.checkpoint_path, layers, state, self.generation + 1)
+                    finally:
+                        release_layers(layers)
+                    self.generation += 1
+                    self.start_journal()  # Журнал начинается заново после контрольной точки
+                    dirty = False
+                elif kind == "flush":
+                    if dirty:
+                        self.sync()
+                        last_sync, dirty = time.monotonic(), False
+                else:
+                    record = encode_record(kind, payload)
+                    self.stream.write(record)
+                    self.journal_bytes += len(record)
+                    if self.journal_bytes > self.CHECKPOINT_BYTES:
+                        self.needs_checkpoint = True
+                    dirty = True
+            except OSError as error:
+                self.error = error
+
+    def start_journal(self):
+        """Начинает пустой журнал текущего поколения (в потоке записи)."""
+        if self.stream is not None:
+            self.stream.close()
+        if not self.generation and os.path.exists(self.checkpoint_path):  # Новый сеанс с чистого холста
+            os.remove(self.checkpoint_path)
+        self.stream = open(self.journal_path, "wb")
+        self.stream.write(JOURNAL_MAGIC + struct.pack("<I", self.generation))
+        self.sync()
+
+    def sync(self):
+        """Сбрасывает журнал на диск."""
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+
+    def finish(self, discard):
+        """Закрывает журнал (в потоке записи) и при discard удаляет файлы автосохранения."""
+        if self.stream is not None:
+            if self.error is None:
+                self.sync()
+            self.stream.close()
+        if discard:
+            for path in (self.journal_path, self.checkpoint_path):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,182 @@
+"""
+Профилирование рисовалки: время обработчиков событий и кадров отрисовки.
+
+Profiler.wrap оборачивает функцию так, что длительность каждого вызова попадает в гистограмму (Histogram)
+и в кольцевой буфер событий трассы. Гистограмма - массив счетчиков логарифмических корзин, поэтому запись
+замера стоит несколько целочисленных операций и не выделяет памяти, а процентили считаются только при показе.
+Трассу можно записать в формате Chrome Trace Event (dump_trace) и открыть в chrome://tracing, Perfetto
+или speedscope: вызовы показываются полосами по потокам, значения (gauge) - графиками.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Histogram:
+    """
+    Гистограмма неотрицательных целых значений (длительностей в микросекундах, длин очередей)
+    с SUBBUCKETS корзинами на каждое удвоение значения: процентиль определяется с точностью около 20%.
+
+    Атрибуты:
+        unit (str): Единица значений: "us" - длительности в микросекундах, "" - безразмерные значения.
+        counts (list): Счетчики корзин.
+        count (int): Число замеров.
+        total (int): Сумма значений.
+        max (int): Наибольшее значение.
+    """
+
+    SUBBUCKETS = 4  # Корзин на каждое удвоение значения
+    BUCKETS = 64 * SUBBUCKETS  # Корзин хватает на любые 64-битные значения
+
+    def __init__(self, unit="us"):
+        self.unit = unit
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        """Добавляет замер value."""
+        bits = value.bit_length()
+        if bits <= 2:  # Значения 0..3 - каждое в своей корзине
+            index = value
+        else:  # Старший бит задает удвоение, два следующих - корзину в нем
+            index = (bits - 2) * 4 + ((value >> (bits - 3)) & 3)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def bucket_start(index):
+        """Возвращает наименьшее значение, попадающее в корзину index."""
+        if index < 4:
+            return index
+        return (4 + index % 4) << (index // 4 - 1)
+
+    def snapshot(self):
+        """Возвращает копию счетчиков, относительно которой percentile считает замеры за прошедшее время."""
+        return list(self.counts)
+
+    def percentile(self, fraction, base=None):
+        """
+        Возвращает значение, меньше которого доля fraction замеров (середину корзины, но не больше max),
+        или None, если замеров нет.
+        Если передан снимок base (snapshot), учитываются только замеры, сделанные после него.
+        """
+        counts = self.counts if base is None else [count - old for count, old in zip(self.counts, base)]
+        target = sum(counts) * fraction
+        if not target:
+            return None
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                return min((self.bucket_start(index) + self.bucket_start(index + 1) - 1) / 2, self.max)
+        return None
+
+    def summary(self):
+        """Возвращает единицу значений, число замеров, среднее, p50, p99 и максимум."""
+        mean = round(self.total / self.count, 1) if self.count else None
+        return {"unit": self.unit, "count": self.count, "mean": mean,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99), "max": self.max}
+
+
+class Profiler:
+    """
+    Сборщик гистограмм длительностей и трассы вызовов.
+
+    Атрибуты:
+        histograms (dict): Гистограммы (Histogram) по именам.
+        gauges (dict): Последние значения величин (число элементов холста, память изображения и т. п.).
+        events (collections.deque): Последние trace_limit событий трассы (None, если трасса не пишется):
+            ("X", имя, начало, длительность, поток) или ("C", имя, время, значение, поток), время в наносекундах.
+        start_ns (int): Время создания профилировщика (начало трассы).
+    """
+
+    def __init__(self, trace_limit=500000):
+        """Создает профилировщик; trace_limit - сколько последних событий трассы хранить (0 - не хранить)."""
+        self.histograms = {}
+        self.gauges = {}
+        self.events = collections.deque(maxlen=trace_limit) if trace_limit else None
+        self.start_ns = time.perf_counter_ns()
+
+    def histogram(self, name, unit="us"):
+        """Возвращает гистограмму name, создавая её с единицей unit при первом обращении."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(unit)
+        return histogram
+
+    def record(self, name, start_ns, end_ns):
+        """Записывает вызов name, длившийся от start_ns до end_ns (time.perf_counter_ns)."""
+        self.histogram(name).add((end_ns - start_ns) // 1000)
+        if self.events is not None:
+            self.events.append(("X", name, start_ns, end_ns - start_ns, threading.get_ident()))
+
+    def gauge(self, name, value):
+        """Запоминает текущее значение величины name и добавляет его в трассу."""
+        self.gauges[name] = value
+        if self.events is not None:
+            self.events.append(("C", name, time.perf_counter_ns(), value, threading.get_ident()))
+
+    def wrap(self, name, func):
+        """Возвращает функцию, которая вызывает func и записывает длительность вызова под именем name."""
+        histogram = self.histogram(name)  # Гистограмма и буфер берутся заранее, чтобы не искать их при вызове
+        events = self.events
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                histogram.add((end - start) // 1000)
+                if events is not None:
+                    events.append(("X", name, start, end - start, threading.get_ident()))
+        return timed
+
+    def summary(self):
+        """Возвращает сводку гистограмм, в которых есть замеры: имя -> Histogram.summary()."""
+        return {name: histogram.summary() for name, histogram in sorted(self.histograms.items()) if histogram.count}
+
+    def format_summary(self):
+        """Возвращает сводку гистограмм текстовой таблицей (длительности - в миллисекундах)."""
+        lines = ["%-22s %8s %9s %9s %9s %9s" % ("", "замеров", "среднее", "p50", "p99", "max")]
+        for name, stats in self.summary().items():
+            scale = 1000 if stats["unit"] == "us" else 1  # Микросекунды показываются миллисекундами
+            lines.append("%-22s %8d %9.3f %9.3f %9.3f %9.3f" % (name, stats["count"], stats["mean"] / scale,
+                                                                stats["p50"] / scale, stats["p99"] / scale,
+                                                                stats["max"] / scale))
+        return "\n".join(lines)
+
+    def trace_events(self):
+        """Возвращает события трассы в формате Chrome Trace Event (время в микросекундах от начала трассы)."""
+        pid = os.getpid()
+        main = threading.main_thread().ident
+        threads = {main}
+        result = []
+        for phase, name, start, value, thread in list(self.events or ()):
+            threads.add(thread)
+            event = {"name": name, "ph": phase, "ts": (start - self.start_ns) / 1000, "pid": pid, "tid": thread}
+            if phase == "X":
+                event["dur"] = value / 1000
+            else:
+                event["args"] = {name: value}
+            result.append(event)
+        for thread in threads:  # Названия потоков в просмотрщике
+            result.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread,
+                           "args": {"name": "Tk" if thread == main else "фоновый поток"}})
+        return result
+
+    def dump_trace(self, path):
+        """Записывает трассу и сводку гистограмм в файл path (JSON, формат Chrome Trace Event)."""
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms",
+                       "otherData": {"histograms": self.summary(), "gauges": self.gauges}},
+                      stream, ensure_ascii=False)
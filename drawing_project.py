@@ -0,0 +1,229 @@
+"""
+Файл проекта рисовалки (.drw): редактируемый рисунок вместо плоского PNG.
+
+Проект хранит команды рисования, из которых получен рисунок, и растровый кэш - сжатые плитки слоев,
+чтобы при открытии не перерисовывать все штрихи. Штрихи хранятся упакованными массивами
+(координаты int32, толщины и индексы цветов в палитре), остальные команды (текст, штрихи с нажимом и т. п.) - в JSON.
+Файл отображается в память: массивы координат не читаются при открытии, а команда распаковывается
+только при обращении к ней (ProjectCommands), поэтому проект с миллионами точек открывается быстро.
+
+Формат (все числа little-endian, массивы выровнены на 4 байта):
+    MAGIC, длина заголовка (4 байта), заголовок JSON (состояние холста, палитра, JSON-команды, размеры массивов),
+    виды команд (uint8) и их номера среди штрихов или JSON-команд (uint32),
+    начала штрихов в массиве координат (uint32, штрихов + 1), толщины (uint16), индексы цветов (uint16),
+    координаты (int32), затем растровый кэш: число плиток и плитки (слой, tx, ty, длина, сжатые байты).
+Команды воспроизводятся на чистом холсте начального размера (start_size) с фоном из состояния холста;
+заливка хранит фон, на котором искала область, поэтому от смен фона не зависит.
+"""
+import array
+import collections.abc
+import json
+import mmap
+import os
+import struct
+import sys
+
+from drawing_journal import TILE_HEADER, is_plain_line, pack_points, release_layers, unpack_points, write_tiles
+
+PROJECT_MAGIC = b"DRWP\x03"  # Сигнатура и версия файла проекта
+PROJECT_EXTENSION = ".drw"  # Расширение файла проекта
+
+KIND_LINE = 1  # Команда "line" (без параметров кисти) из упакованных массивов штрихов
+KIND_JSON = 2  # Любая другая команда из списка JSON-команд заголовка
+DRAWING_OPS = ("line", "erase", "text", "fill")  # Команды, которые рисуют на слоях
+
+
+def compact_commands(commands):
+    """
+    Оставляет только команды, нужные для текущего рисунка: нарисованное до последней очистки не видно
+    (команды слоев и размера остаются - очистка их не отменяет), а смены фона заменяет итоговое состояние
+    холста (заливка ищет область на фоне, записанном в её команде). Возвращает список команд и флаг,
+    была ли в командах очистка (тогда рисунку не нужна растровая основа).
+    """
+    kept = []
+    cleared = False
+    for command in commands:
+        if command["op"] == "clear":  # Всё нарисованное раньше стерто
+            kept = [item for item in kept if item["op"] not in DRAWING_OPS]
+            cleared = True
+        elif command["op"] != "background":  # Цвет фона хранится в состоянии холста
+            kept.append(command)
+    return kept, cleared
+
+
+def typed_array(typecode, data):
+    """Создает array.array из байтов little-endian."""
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def array_bytes(typecode, values):
+    """Возвращает байты little-endian массива values, дополненные нулями до кратной 4 длины."""
+    values = array.array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    data = values.tobytes()
+    return data + b"\0" * (-len(data) % 4)
+
+
+def save_project(path, layers, state, commands, start_size, raster_base=False, progress=None):
+    """
+    Сохраняет проект в файл path (аргументы - как у write_project). Файл пишется во временный и затем
+    заменяет прежний.
+    """
+    write_project(path + ".tmp", layers, state, commands, start_size, raster_base, progress)
+    os.replace(path + ".tmp", path)
+
+
+def write_project(path, layers, state, commands, start_size, raster_base=False, progress=None, base=()):
+    """
+    Записывает проект в файл path: команды base и commands (лишние отбрасывает compact_commands), состояние
+    холста state и растровый кэш из снимков слоев layers (DrawingEngine.layer_snapshots, можно вызывать
+    в фоновом потоке). Аргумент start_size - размер холста перед первой командой.
+    Аргумент raster_base - начинаются ли команды не с чистого холста, а с рисунка без команд
+    (например, восстановленного после сбоя). Снимки layers освобождаются (TiledImage.release), когда запись
+    закончена. Команды основы base (открытого проекта) сжимаются отдельно и записываются первыми, чтобы
+    после сохранения основу можно было читать из нового файла (Project.base_commands), не трогая команды,
+    которые еще можно отменить. Возвращает число команд основы в файле.
+    """
+    try:
+        base, base_cleared = compact_commands(base)
+        commands, cleared = compact_commands(commands)
+        if cleared and base:  # Очистка в командах стирает и основу, которая осталась несжатой
+            commands.insert(0, {"op": "clear"})
+        commands, cleared = base + commands, cleared or base_cleared
+        kinds, indexes = array.array("B"), array.array("I")  # Вид и номер каждой команды
+        offsets, widths, colors = array.array("I", [0]), array.array("H"), array.array("H")
+        palette, palette_index, others = [], {}, []
+        points = []  # Координаты штрихов, упакованные по частям
+        point_count = 0
+        for command in commands:
+            if is_plain_line(command):
+                kinds.append(KIND_LINE)
+                indexes.append(len(widths))
+                if command["color"] not in palette_index:  # Новый цвет в палитре
+                    palette_index[command["color"]] = len(palette)
+                    palette.append(command["color"])
+                colors.append(palette_index[command["color"]])
+                widths.append(command["width"])
+                points.append(pack_points(command["points"]))
+                point_count += len(command["points"])
+                offsets.append(point_count)
+            else:
+                kinds.append(KIND_JSON)
+                indexes.append(len(others))
+                others.append(command)
+        header = json.dumps({"state": state, "start_size": start_size, "raster_base": raster_base and not cleared,
+                             "palette": palette,
+                             "commands": others, "count": len(kinds), "strokes": len(widths),
+                             "points": point_count}, ensure_ascii=False).encode("utf-8")
+        header += b" " * (-len(header) % 4)  # Массивы выровнены на 4 байта
+
+        with open(path, "wb") as stream:
+            stream.write(PROJECT_MAGIC + b"\0\0\0" + struct.pack("<I", len(header)) + header)
+            for typecode, values in (("B", kinds), ("I", indexes), ("I", offsets), ("H", widths), ("H", colors)):
+                stream.write(array_bytes(typecode, values))
+            for data in points:
+                stream.write(data)
+            write_tiles(stream, layers, progress)  # Растровый кэш - все плитки слоев
+        return len(base)
+    finally:
+        release_layers(layers)
+
+
+class ProjectCommands(collections.abc.Sequence):
+    """
+    Команды открытого проекта в виде последовательности только для чтения.
+    Команда распаковывается из отображенного в память файла при обращении к ней.
+    """
+
+    def __init__(self, project, count=None):
+        self.project = project  # Открытый проект, в файле которого лежат массивы
+        self.count = len(project.kinds) if count is None else count  # Число первых команд файла
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("project command index out of range")
+        project = self.project
+        number = project.indexes[index]
+        if project.kinds[index] != KIND_LINE:
+            return dict(project.json_commands[number])
+        start, end = project.offsets[number], project.offsets[number + 1]
+        return {"op": "line", "points": unpack_points(project.data[project.points_offset + start * 4:
+                                                                   project.points_offset + end * 4]),
+                "color": project.palette[project.colors[number]], "width": project.widths[number]}
+
+
+class Project:
+    """
+    Открытый файл проекта. Файл отображается в память и остается открытым, пока нужны команды.
+
+    Атрибуты:
+        path (str): Путь файла проекта.
+        state (dict): Состояние холста (DrawingEngine.capture_state).
+        start_size (tuple): Размер холста перед первой командой.
+        raster_base (bool): Начинаются ли команды с рисунка без команд (тогда повтор команд не даст растровый кэш).
+        commands (ProjectCommands): Команды рисунка, распаковываемые по обращению.
+        json_commands (list): Команды, хранящиеся в заголовке в JSON (не штрихи).
+        tiles (dict): Растровый кэш: (слой, tx, ty) -> сжатые байты плитки.
+        points (int): Число координат во всех штрихах.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)  # Файл в памяти
+        if self.data[:len(PROJECT_MAGIC)] != PROJECT_MAGIC:
+            raise ValueError("Файл не является проектом рисовалки: %s" % path)
+        offset = len(PROJECT_MAGIC) + 3
+        (length,) = struct.unpack_from("<I", self.data, offset)
+        header = json.loads(self.data[offset + 4:offset + 4 + length].decode("utf-8"))
+        offset += 4 + length
+        self.state = header["state"]
+        self.state["size"] = tuple(self.state["size"])  # JSON превращает кортежи в списки
+        self.start_size = tuple(header["start_size"])
+        self.raster_base = header["raster_base"]
+        self.palette = header["palette"]
+        self.json_commands = header["commands"]  # Команды, хранящиеся в JSON
+        self.points = header["points"]
+        arrays = []
+        for typecode, count in (("B", header["count"]), ("I", header["count"]), ("I", header["strokes"] + 1),
+                                ("H", header["strokes"]), ("H", header["strokes"])):
+            size = count * array.array(typecode).itemsize
+            arrays.append(typed_array(typecode, self.data[offset:offset + size]))
+            offset += size + (-size % 4)
+        self.kinds, self.indexes, self.offsets, self.widths, self.colors = arrays
+        self.points_offset = offset  # Координаты читаются только при обращении к команде
+        offset += self.points * 4
+        (count,) = struct.unpack_from("<I", self.data, offset)
+        offset += 4
+        self.tiles = {}
+        for _ in range(count):
+            index, tx, ty, size = TILE_HEADER.unpack_from(self.data, offset)
+            offset += TILE_HEADER.size
+            self.tiles[(index, tx, ty)] = self.data[offset:offset + size]
+            offset += size
+        self.commands = ProjectCommands(self)
+
+    def base_commands(self, count):
+        """Возвращает первые count команд файла (основу, записанную write_project) без их распаковки."""
+        return ProjectCommands(self, count)
+
+    def close(self):
+        """Закрывает отображение файла; команды проекта после этого читать нельзя."""
+        self.data.close()
+
+
+def load_project(path):
+    """Открывает файл проекта. Возвращает Project; ValueError, если файл не является проектом."""
+    return Project(path)
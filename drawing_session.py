@@ -0,0 +1,778 @@
+"""
+Общий холст для нескольких участников: локальный сервер сеанса на asyncio и клиенты.
+
+Сервер хранит журнал операций сеанса - единственный порядок команд всех участников. Участник отправляет свои
+команды пачками (одно сообщение за BATCH_INTERVAL); сервер пересылает пачку с её номером в журнале всем
+участникам без перекодирования, в том числе отправителю. Участник рисует у себя сразу, но считает свои команды
+предварительными, пока не получит их эхо: чужие операции он выполняет раньше своих неподтвержденных
+(SharedCanvas), поэтому рисунки всех участников получаются из одного порядка операций.
+Рисующие команды передаются со своим слоем ("layer"), отмена и повтор - заплатками: маской пикселей, которые
+изменило действие, их значениями и состоянием холста. Чужое рисование в тех же плитках отмена не затирает.
+Выбор активного слоя у каждого участника свой.
+
+Команды кодируются дельтами (BatchCodec): из полей команды передаются только изменившиеся с предыдущей
+команды участника, а координаты - разностями с предыдущей точкой (zigzag varint, обычно по байту на координату).
+Состояние кодировщика продолжается из пачки в пачку. Сервер декодирует каждую пачку, чтобы знать состояние
+потока каждого участника, и применяет журнал к своему движку в фоновом потоке: новый участник получает
+снимок плиток и состояния потоков, а не всю историю, поэтому подключение не замедляется с ростом журнала.
+Выполненные в движке операции из журнала удаляются.
+Каждому участнику сервер пишет из своей очереди: медленный участник не задерживает остальных,
+а переполнивший очередь отключается (при повторном подключении он получит снимок).
+
+Сообщение: заголовок MESSAGE_HEADER (тип, длина данных), затем данные:
+    MSG_HELLO (участник -> сервер): JSON {"name": имя}.
+    MSG_WELCOME (сервер -> участник): длина JSON (4 байта), JSON {"client": номер, "seq": номер последней
+        операции, "streams": {номер участника: состояние его потока}}, состояние холста и плитки слоев
+        (pack_state, pack_tiles).
+    MSG_OPS: пачка команд (BatchCodec.encode); от сервера - с номером отправителя и номером операции ("<II").
+    MSG_PATCH: состояние холста и заплатки отмены или повтора (encode_patches); от сервера - тоже с номерами.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import queue
+import struct
+import threading
+
+from PIL import ImageChops
+
+from drawing_engine import DrawingEngine
+from drawing_journal import pack_state, pack_tiles, release_layers, unpack_state, unpack_tiles
+
+MESSAGE_HEADER = struct.Struct("<BI")  # Тип сообщения и длина данных
+SENDER_HEADER = struct.Struct("<II")  # Номер отправителя и номер операции в журнале сервера
+MSG_HELLO = 1  # Участник представляется серверу
+MSG_WELCOME = 2  # Сервер передает участнику снимок холста
+MSG_OPS = 3  # Пачка команд рисования
+MSG_PATCH = 4  # Заплатки и состояние холста отмены или повтора
+MAX_MESSAGE = 256 * 1024 * 1024  # Наибольшая длина данных сообщения
+
+SHARED_OPS = ("line", "erase", "text", "fill", "clear", "background", "resize", "add_layer",
+              "layer_visibility")  # Команды, которые передаются участникам (выбор слоя - у каждого свой)
+LAYER_OPS = ("line", "erase", "text", "fill")  # Команды, которые рисуют на слое и передаются с его номером
+DEFAULT_PORT = 8765  # Порт сервера по умолчанию
+
+
+def write_varint(out, value):
+    """Дописывает в bytearray out неотрицательное целое value по 7 бит в байте (varint)."""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    """Читает varint из data со смещения offset; возвращает значение и смещение после него."""
+    result = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+class BatchCodec:
+    """
+    Дельта-кодирование пачек команд одного участника. Кодировщик у отправителя и декодировщики у сервера
+    и получателей хранят одинаковое состояние потока: поля последней команды и её последнюю точку.
+
+    Команда в пачке: длина и JSON изменившихся полей (без "points" и "pressures"; удаленные поля - в списке "-"),
+    число координат + 1 (0 - поля "points" нет) и разности координат с предыдущей точкой (zigzag varint),
+    число значений нажима + 1 (0 - поля "pressures" нет) и нажим в сотых долях. Координаты - целые.
+
+    Атрибуты:
+        header (dict): Поля последней команды, кроме точек и нажима.
+        point (tuple): Последняя точка последней команды с точками.
+    """
+
+    def __init__(self, header=None, point=(0, 0)):
+        self.header = dict(header or {})
+        self.point = tuple(point)
+
+    def state(self):
+        """Возвращает состояние потока для передачи новому участнику (JSON)."""
+        return [self.header, list(self.point)]
+
+    def encode(self, commands):
+        """Кодирует пачку команд в байты и продвигает состояние потока."""
+        out = bytearray()
+        write_varint(out, len(commands))
+        x, y = self.point
+        for command in commands:
+            fields = {key: value for key, value in command.items() if key not in ("points", "pressures")}
+            diff = {key: value for key, value in fields.items() if key not in self.header or self.header[key] != value}
+            removed = [key for key in self.header if key not in fields]
+            if removed:
+                diff["-"] = removed
+            data = json.dumps(diff, ensure_ascii=False, separators=(",", ":")).encode("utf-8") if diff else b""
+            write_varint(out, len(data))
+            out += data
+            self.header = fields
+            points = command.get("points")
+            write_varint(out, 0 if points is None else len(points) + 1)
+            for i in range(0, len(points or ()), 2):
+                dx, dy = int(points[i]) - x, int(points[i + 1]) - y
+                write_varint(out, dx * 2 if dx >= 0 else -dx * 2 - 1)  # zigzag: знак в младшем бите
+                write_varint(out, dy * 2 if dy >= 0 else -dy * 2 - 1)
+                x, y = x + dx, y + dy
+            pressures = command.get("pressures")
+            write_varint(out, 0 if pressures is None else len(pressures) + 1)
+            for pressure in pressures or ():
+                write_varint(out, round(pressure * 100))
+        self.point = (x, y)
+        return bytes(out)
+
+    def decode(self, data):
+        """Декодирует пачку команд и продвигает состояние потока. ValueError, если данные повреждены."""
+        try:
+            count, offset = read_varint(data, 0)
+            commands = []
+            x, y = self.point
+            for _ in range(count):
+                length, offset = read_varint(data, offset)
+                if length:
+                    diff = json.loads(bytes(data[offset:offset + length]).decode("utf-8"))
+                    offset += length
+                    removed = diff.pop("-", ())
+                    header = {key: value for key, value in self.header.items() if key not in removed}
+                    header.update(diff)
+                    self.header = header
+                command = dict(self.header)
+                count_points, offset = read_varint(data, offset)
+                if count_points:
+                    points = []
+                    for _ in range((count_points - 1) // 2):
+                        dx, offset = read_varint(data, offset)
+                        dy, offset = read_varint(data, offset)
+                        x += -(dx >> 1) - 1 if dx & 1 else dx >> 1
+                        y += -(dy >> 1) - 1 if dy & 1 else dy >> 1
+                        points += (x, y)
+                    command["points"] = points
+                count_pressures, offset = read_varint(data, offset)
+                if count_pressures:
+                    pressures = []
+                    for _ in range(count_pressures - 1):
+                        value, offset = read_varint(data, offset)
+                        pressures.append(value / 100)
+                    command["pressures"] = pressures
+                commands.append(command)
+        except (IndexError, UnicodeDecodeError, json.JSONDecodeError, AttributeError, TypeError) as error:
+            raise ValueError("Поврежденная пачка команд: %s" % error)
+        self.point = (x, y)
+        return commands
+
+
+def pack_message(kind, payload):
+    """Возвращает сообщение вида kind с данными payload."""
+    return MESSAGE_HEADER.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader):
+    """Читает сообщение из asyncio.StreamReader; возвращает его вид и данные."""
+    kind, length = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ValueError("Слишком длинное сообщение: %d байт" % length)
+    return kind, await reader.readexactly(length)
+
+
+def encode_tiles(state, tiles):
+    """Кодирует состояние холста и плитки (слой, tx, ty) -> изображение, сжатые байты или None."""
+    return pack_state(state) + pack_tiles(tiles)
+
+
+def decode_tiles(data):
+    """Декодирует состояние холста и плитки, закодированные encode_tiles."""
+    state, offset = unpack_state(data, 0)
+    return state, unpack_tiles(data, offset)[0]
+
+
+def encode_patches(state, patches):
+    """
+    Кодирует состояние холста и заплатки (слой, tx, ty) -> (маска, пиксели, ожидаемые пиксели)
+    (DrawingEngine.patch_tiles): маски, пиксели и ожидаемые пиксели - три набора плиток.
+    """
+    return pack_state(state) + b"".join(pack_tiles({key: patch[part] for key, patch in patches.items()})
+                                        for part in range(3))
+
+
+def decode_patches(data):
+    """Декодирует состояние холста и заплатки, закодированные encode_patches. ValueError, если они повреждены."""
+    state, offset = unpack_state(data, 0)
+    parts = []
+    for _ in range(3):
+        tiles, offset = unpack_tiles(data, offset)
+        parts.append(tiles)
+    masks, pixels, expected = parts
+    if masks.keys() != pixels.keys() or masks.keys() != expected.keys() or None in masks.values():
+        raise ValueError("Поврежденные заплатки")
+    return state, {key: (mask, pixels[key], expected[key]) for key, mask in masks.items()}
+
+
+def apply_shared(engine, command, stroke=None):
+    """
+    Выполняет в движке engine команду другого участника: рисующая команда выполняется на своем слое ("layer"),
+    а полупрозрачный штрих продолжается в буфере участника stroke (DrawingEngine.stroke). Активный слой
+    и буфер штриха самого движка не меняются. Возвращает изменённую область и новый буфер штриха участника.
+    """
+    command = dict(command)
+    layer = command.pop("layer", engine.active)
+    active, own_stroke = engine.active, engine.stroke
+    engine.active = max(0, min(int(layer), len(engine.layers) - 1))  # Слой мог быть удален отменой
+    engine.stroke = stroke
+    try:
+        return engine.apply(command), engine.stroke
+    finally:
+        engine.active = min(active, len(engine.layers) - 1)
+        engine.stroke = own_stroke
+
+
+def apply_shared_patches(engine, state, patches):
+    """
+    Накладывает в движке заплатки и восстанавливает состояние холста отмены или повтора другого участника.
+    Возвращает обратные заплатки.
+    """
+    own_stroke = engine.stroke
+    engine.restore_state(dict(state, active=min(engine.active, len(state["layers"]) - 1)))  # Свой слой остается
+    try:
+        return engine.patch_tiles(patches)
+    finally:
+        engine.stroke = own_stroke
+
+
+def copy_stroke(stroke):
+    """Возвращает копию буфера штриха (DrawingEngine.stroke), которую не изменит продолжение штриха."""
+    if stroke is None:
+        return None
+    return stroke[0], {key: list(entry) for key, entry in stroke[1].items()}
+
+
+class SharedCanvas:
+    """
+    Рисунок участника сеанса в порядке журнала сервера.
+
+    Свои команды участник выполняет сразу, но до их эха от сервера они предварительные: для каждой хранятся
+    прежние плитки, состояние холста и буфер штриха. Перед чужими операциями предварительные откатываются,
+    чужие выполняются, а свои - заново поверх них; эхо своей операции закрепляет её на месте в журнале.
+    Поэтому рисунок у всех участников получается из одного порядка операций, как у сервера.
+
+    Действие для истории отмены записывается заплатками (DrawingEngine.patch_tiles): маской пикселей,
+    которые изменили свои команды, их значениями до и после действия. Чужие операции в шаг не попадают,
+    а отмена и повтор отправляются участникам заплатками, как обычные операции журнала, и не трогают пиксели,
+    которые после действия изменил кто-то еще.
+
+    Атрибуты:
+        engine (DrawingEngine): Рисунок участника.
+        client (int): Номер участника.
+        pending (collections.deque): Свои неподтвержденные операции, от старых к новым:
+            (вид, данные, слой, плитки до, состояние до, буфер штриха до).
+        strokes (dict): Буферы полупрозрачных штрихов других участников: номер участника -> буфер.
+        step (dict): Заплатки записываемого действия: (слой, tx, ty) -> [маска, пиксели до, пиксели после]
+            (None, если запись не идет).
+    """
+
+    def __init__(self, engine, client):
+        self.engine = engine
+        self.client = client
+        self.pending = collections.deque()
+        self.strokes = {}
+        self.step = None
+
+    def begin_step(self):
+        """Начинает запись действия для истории отмены."""
+        self.step = {}
+
+    def end_step(self):
+        """Заканчивает запись и возвращает заплатки отмены действия: (слой, tx, ty) -> (маска, до, после)."""
+        step, self.step = self.step or {}, None
+        return {key: tuple(patch) for key, patch in step.items()}
+
+    def execute(self, command):
+        """Выполняет свою команду; возвращает изменённую область. Команды не из SHARED_OPS не отправляются."""
+        if command.get("op") not in SHARED_OPS:
+            return self.engine.apply(command)
+        return self.run("ops", command, self.engine.active, True)
+
+    def patch(self, state, patches):
+        """Выполняет свою отмену или повтор: состояние холста и заплатки. Возвращает обратные заплатки."""
+        return self.run("patch", (state, patches), self.engine.active, True)
+
+    def run(self, kind, payload, layer, new=False):
+        """
+        Выполняет свою операцию и добавляет её в неподтвержденные. Новая (new=True) операция выполняется
+        как есть и записывается в действие, а повторная после отката - на своем слое, не меняя активный.
+        """
+        engine = self.engine
+        state, stroke = engine.capture_state(), copy_stroke(engine.stroke)
+        engine.begin_changes()
+        try:
+            result = self.perform(kind, payload, None if new else layer)
+        finally:
+            tiles = engine.end_changes()
+        self.pending.append((kind, payload, layer, tiles, state, stroke))
+        if new:
+            self.record(tiles)
+        return result
+
+    def perform(self, kind, payload, layer=None):
+        """Выполняет свою операцию (на слое layer, если он указан); возвращает результат движка."""
+        engine = self.engine
+        if kind == "patch":
+            state, patches = payload
+            engine.restore_state(dict(state, active=min(engine.active, len(state["layers"]) - 1)))
+            return engine.patch_tiles(patches)
+        if layer is None:
+            return engine.apply(payload)
+        active = engine.active
+        engine.active = max(0, min(layer, len(engine.layers) - 1))
+        try:
+            return engine.apply(payload)
+        finally:
+            engine.active = min(active, len(engine.layers) - 1)
+
+    def record(self, tiles):
+        """Добавляет в записываемое действие пиксели, которые изменила своя операция (tiles - плитки до неё)."""
+        if self.step is None:
+            return
+        for key, before in tiles.items():
+            image = self.engine.layers[key[0]].image
+            mask = image.changed_mask(key[1:], before)
+            if mask is None:
+                continue
+            pixels, after = image.tile_image(before), image.tile_image(image.get_tile(key[1:]))
+            patch = self.step.get(key)
+            if patch is None:  # Первое изменение плитки в действии
+                self.step[key] = [mask, pixels.copy() if pixels is before else pixels, after.copy()]
+            else:  # Значения до нужны только для пикселей, которые действие еще не меняло
+                patch[1].paste(pixels, (0, 0), ImageChops.subtract(mask, patch[0]))
+                patch[2].paste(after, (0, 0), mask)
+                patch[0] = ImageChops.lighter(patch[0], mask)
+
+    def rollback(self):
+        """Откатывает свои неподтвержденные операции; возвращает их (вид, данные, слой) и изменённые области."""
+        engine = self.engine
+        operations, boxes = [], []
+        while self.pending:
+            kind, payload, layer, tiles, state, stroke = self.pending.pop()
+            engine.restore_state(dict(state, active=min(engine.active, len(state["layers"]) - 1)))
+            engine.restore_tiles(tiles)
+            engine.stroke = stroke
+            operations.append((kind, payload, layer))
+            boxes += [engine.image.tile_box((tx, ty)) for _, tx, ty in tiles]
+        operations.reverse()
+        return operations, boxes
+
+    def receive(self, operations):
+        """
+        Выполняет операции журнала operations: (вид, отправитель, данные), где данные - команды ("ops")
+        или (состояние, заплатки) ("patch"). Эхо своих операций подтверждает их. Возвращает изменённые области.
+        """
+        if all(sender == self.client for _, sender, _ in operations):  # Только эхо: рисунок уже верный
+            for kind, _, payload in operations:
+                for _ in range(len(payload) if kind == "ops" else 1):
+                    self.pending.popleft()
+            return []
+        own, boxes = self.rollback()
+        own = collections.deque(own)
+        for kind, sender, payload in operations:
+            if sender == self.client:  # Своя операция встает на место в журнале и больше не откатывается
+                for _ in range(len(payload) if kind == "ops" else 1):
+                    box = self.perform(*own.popleft())
+                    if kind == "ops" and box is not None:
+                        boxes.append(box)
+                if kind == "patch":
+                    boxes += [self.engine.image.tile_box((tx, ty)) for _, tx, ty in payload[1]]
+            elif kind == "patch":
+                self.strokes.pop(sender, None)
+                apply_shared_patches(self.engine, *payload)
+                boxes += [self.engine.image.tile_box((tx, ty)) for _, tx, ty in payload[1]]
+            else:
+                for command in payload:
+                    if command.get("op") not in SHARED_OPS:
+                        continue
+                    try:
+                        box, self.strokes[sender] = apply_shared(self.engine, command, self.strokes.get(sender))
+                    except (ValueError, TypeError, KeyError, IndexError):
+                        continue  # Неверная команда не мешает остальным
+                    if box is not None:
+                        boxes.append(box)
+        for kind, payload, layer in own:  # Неподтвержденные снова выполняются после чужих операций
+            box = self.run(kind, payload, layer)
+            if kind == "patch":
+                boxes += [self.engine.image.tile_box((tx, ty)) for _, tx, ty in payload[1]]
+            elif box is not None:
+                boxes.append(box)
+        return boxes
+
+
+class SessionServer:
+    """
+    Сервер сеанса: принимает участников, ведет журнал операций и пересылает операции участникам.
+
+    Атрибуты:
+        engine (DrawingEngine): Рисунок по журналу до операции applied (дополняется в фоновом потоке).
+        log (list): Операции журнала, еще не выполненные в engine: (вид сообщения, отправитель, данные);
+            номер операции - log_start + индекс + 1.
+        log_start (int): Число операций, удаленных из начала журнала (они уже в engine).
+        log_lock (threading.Lock): Защищает начало журнала и applied: поток движка читает журнал, цикл его укорачивает.
+        applied (int): Число операций журнала, выполненных в engine.
+        clients (dict): Подключенные участники: номер -> (очередь сообщений, asyncio.StreamWriter).
+        handlers (set): Задачи asyncio, обслуживающие участников.
+        codecs (dict): Декодировщики потоков участников в состоянии после последней операции журнала.
+        bytes_received (int): Получено байт данных операций.
+        bytes_sent (int): Отправлено байт участникам.
+    """
+
+    SEND_QUEUE_LIMIT = 4096  # Сообщений в очереди участника, после которых он отключается как отставший
+    CATCH_UP_LAG = 256  # Операций, не выполненных в движке, после которых движок дополняется в фоне
+
+    def __init__(self, size=(850, 500), background="white"):
+        """Создает сервер с пустым холстом размера size и цвета background."""
+        self.engine = DrawingEngine(size, background)
+        self.log = []
+        self.log_start = 0
+        self.log_lock = threading.Lock()
+        self.applied = 0
+        self.clients = {}
+        self.handlers = set()
+        self.codecs = {}
+        self.engine_codecs = {}  # Декодировщики потоков для движка (он отстает от журнала)
+        self.strokes = {}  # Буферы полупрозрачных штрихов участников в движке
+        self.next_client = 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # Поток движка
+        self.catch_up_future = None  # Фоновое дополнение движка
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """Начинает принимать участников; возвращает фактический порт (port=0 - любой свободный)."""
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """Отключает участников, дожидается окончания их обслуживания и останавливает сервер."""
+        self.server.close()
+        for _, writer in list(self.clients.values()):
+            writer.close()
+        handlers = list(self.handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def handle(self, reader, writer):
+        """Обслуживает одного участника: снимок холста при подключении, затем прием его операций."""
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            await self.serve_client(reader, writer)
+        except asyncio.CancelledError:
+            pass  # Сервер закрывается (close): задача завершается без ошибки, которую asyncio напечатал бы
+        finally:
+            self.handlers.discard(task)
+
+    async def serve_client(self, reader, writer):
+        """Приветствие, снимок холста и прием операций участника (для handle)."""
+        try:
+            kind, payload = await read_message(reader)
+            if kind != MSG_HELLO:
+                raise ValueError("Ожидалось приветствие участника")
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        client = self.next_client
+        self.next_client += 1
+        end = self.log_start + len(self.log)  # Снимок будет на этой операции, всё после неё придет через очередь
+        streams = {str(sender): codec.state() for sender, codec in self.codecs.items()}
+        messages = asyncio.Queue()
+        self.clients[client] = (messages, writer)
+        self.codecs[client] = BatchCodec()
+        send_task = None
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(self.executor, self.snapshot, end)
+            self.trim_log()
+            info = json.dumps({"client": client, "seq": end, "streams": streams}, ensure_ascii=False).encode("utf-8")
+            welcome = pack_message(MSG_WELCOME, struct.pack("<I", len(info)) + info + snapshot)
+            writer.write(welcome)
+            self.bytes_sent += len(welcome)
+            send_task = asyncio.ensure_future(self.send_loop(messages, writer))
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == MSG_OPS:
+                    self.codecs[client].decode(payload)  # Проверяем пачку и продвигаем состояние потока
+                elif kind == MSG_PATCH:
+                    decode_patches(payload)
+                else:
+                    raise ValueError("Неизвестное сообщение: %d" % kind)
+                self.bytes_received += len(payload)
+                self.publish(client, kind, payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError, struct.error):
+            pass  # Участник отключился или прислал поврежденные данные
+        finally:
+            self.clients.pop(client, None)
+            self.codecs.pop(client, None)
+            writer.close()
+            if send_task is not None:
+                send_task.cancel()
+                await asyncio.gather(send_task, return_exceptions=True)
+
+    async def send_loop(self, messages, writer):
+        """Пишет участнику сообщения из его очереди; накопившиеся сообщения уходят одной записью."""
+        while True:
+            data = [await messages.get()]
+            while not messages.empty():
+                data.append(messages.get_nowait())
+            data = b"".join(data)
+            writer.write(data)
+            self.bytes_sent += len(data)
+            await writer.drain()
+
+    def publish(self, sender, kind, payload):
+        """
+        Добавляет операцию в журнал и ставит её в очереди всех участников. Отправитель тоже получает её (эхо):
+        по нему он узнает место своей операции в журнале.
+        """
+        self.log.append((kind, sender, payload))
+        end = self.log_start + len(self.log)  # Номер операции
+        message = pack_message(kind, SENDER_HEADER.pack(sender, end) + payload)
+        for client, (messages, writer) in list(self.clients.items()):
+            if messages.qsize() >= self.SEND_QUEUE_LIMIT:  # Участник не успевает читать - отключаем его
+                self.clients.pop(client)
+                writer.close()
+            else:
+                messages.put_nowait(message)
+        if end - self.applied >= self.CATCH_UP_LAG and self.catch_up_future is None:
+            self.catch_up_future = asyncio.get_running_loop().run_in_executor(self.executor, self.catch_up, end)
+            self.catch_up_future.add_done_callback(self.caught_up)
+
+    def caught_up(self, future):
+        """Отмечает окончание фонового дополнения движка и удаляет выполненные операции из журнала."""
+        self.catch_up_future = None
+        self.trim_log()
+
+    def trim_log(self):
+        """Удаляет из журнала операции, уже выполненные в движке: новые участники получают их в снимке."""
+        with self.log_lock:
+            applied = self.applied  # Поток движка меняет applied только под блокировкой
+            if applied > self.log_start:
+                del self.log[:applied - self.log_start]
+                self.log_start = applied
+
+    def catch_up(self, end):
+        """Выполняет в движке операции журнала до end (в потоке движка)."""
+        with self.log_lock:
+            operations = self.log[self.applied - self.log_start:end - self.log_start]
+        for kind, sender, payload in operations:
+            if kind == MSG_PATCH:
+                self.strokes.pop(sender, None)  # Буфер штриха участника устарел, как после любой другой команды
+                apply_shared_patches(self.engine, *decode_patches(payload))
+                continue
+            codec = self.engine_codecs.setdefault(sender, BatchCodec())
+            for command in codec.decode(payload):
+                if command.get("op") not in SHARED_OPS:  # Остальные команды участникам не передаются
+                    continue
+                try:
+                    self.strokes[sender] = apply_shared(self.engine, command, self.strokes.get(sender))[1]
+                except (ValueError, TypeError, KeyError, IndexError):
+                    pass  # Неверная команда не мешает остальным
+        with self.log_lock:
+            self.applied = max(self.applied, end)
+
+    def snapshot(self, end):
+        """Возвращает состояние холста и плитки слоев после операции end (в потоке движка)."""
+        self.catch_up(end)
+        tiles = {}
+        layers = self.engine.layer_snapshots()
+        for index, layer in enumerate(layers):
+            for key in list(layer.tiles) + list(layer.spilled):
+                tiles[(index,) + key] = layer.get_tile(key)
+        try:
+            return encode_tiles(self.engine.capture_state(), tiles)
+        finally:
+            release_layers(layers)
+
+
+async def serve(host="127.0.0.1", port=DEFAULT_PORT, size=(850, 500), background="white"):
+    """Запускает сервер сеанса и обслуживает участников до отмены; печатает адрес сервера."""
+    server = SessionServer(size, background)
+    port = await server.start(host, port)
+    print("Сервер сеанса: %s:%d" % (host, port), flush=True)
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+
+class SessionConnection:
+    """
+    Соединение участника с сервером сеанса в цикле asyncio.
+
+    Атрибуты:
+        client (int): Номер участника.
+        seq (int): Номер последней операции журнала, учтенной в снимке или полученной.
+        state (dict): Состояние холста снимка при подключении.
+        tiles (dict): Плитки слоев снимка: (слой, tx, ty) -> сжатые байты.
+        encoder (BatchCodec): Кодировщик своих команд.
+        decoders (dict): Декодировщики потоков участников (и своего - для эха).
+    """
+
+    def __init__(self, reader, writer, info, state, tiles):
+        self.reader = reader
+        self.writer = writer
+        self.client = info["client"]
+        self.seq = info["seq"]
+        self.state = state
+        self.tiles = tiles
+        self.encoder = BatchCodec()
+        self.decoders = {int(sender): BatchCodec(*stream) for sender, stream in info["streams"].items()}
+
+    @classmethod
+    async def connect(cls, host, port, name=""):
+        """Подключается к серверу и получает снимок холста. ValueError, если сервер ответил не снимком."""
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(pack_message(MSG_HELLO, json.dumps({"name": name}, ensure_ascii=False).encode("utf-8")))
+        kind, payload = await read_message(reader)
+        if kind != MSG_WELCOME:
+            writer.close()
+            raise ValueError("Сервер не прислал снимок холста")
+        (length,) = struct.unpack_from("<I", payload)
+        info = json.loads(payload[4:4 + length].decode("utf-8"))
+        state, tiles = decode_tiles(payload[4 + length:])
+        return cls(reader, writer, info, state, tiles)
+
+    def send(self, commands):
+        """Отправляет пачку своих команд."""
+        self.writer.write(pack_message(MSG_OPS, self.encoder.encode(commands)))
+
+    def send_patch(self, state, patches):
+        """Отправляет заплатки и состояние холста своей отмены или повтора."""
+        self.writer.write(pack_message(MSG_PATCH, encode_patches(state, patches)))
+
+    async def receive(self):
+        """
+        Ждет следующую операцию журнала (свои операции тоже приходят - эхом). Возвращает
+        ("ops", отправитель, номер, команды) или ("patch", отправитель, номер, состояние, заплатки).
+        """
+        kind, payload = await read_message(self.reader)
+        sender, self.seq = SENDER_HEADER.unpack_from(payload)
+        if kind == MSG_OPS:
+            decoder = self.decoders.setdefault(sender, BatchCodec())
+            return "ops", sender, self.seq, decoder.decode(payload[SENDER_HEADER.size:])
+        if kind == MSG_PATCH:
+            return ("patch", sender, self.seq) + decode_patches(payload[SENDER_HEADER.size:])
+        raise ValueError("Неизвестное сообщение: %d" % kind)
+
+    def close(self):
+        """Закрывает соединение."""
+        self.writer.close()
+
+
+class SessionClient:
+    """
+    Участник сеанса для приложения Tk: соединение работает в фоновом потоке со своим циклом asyncio.
+
+    Поток Tk передает свои команды через send и send_patch; команды, пришедшие за BATCH_INTERVAL после
+    предыдущей отправки, уходят одной пачкой. Полученное поток Tk забирает из очереди incoming:
+        ("welcome", номер участника, состояние холста, плитки)
+        ("ops", отправитель, номер операции, команды)
+        ("patch", отправитель, номер операции, состояние холста, заплатки)
+        ("closed", ошибка или None) - соединение закрыто.
+    """
+
+    BATCH_INTERVAL = 0.015  # Наименьший интервал между пачками команд, секунд
+
+    def __init__(self, host, port, name=""):
+        """Начинает подключение к серверу host:port в фоновом потоке."""
+        self.incoming = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.pending = []  # Команды и заплатки, ожидающие отправки (только в потоке цикла)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.thread = threading.Thread(target=self.run, args=(host, port, name), daemon=True)
+        self.thread.start()
+
+    def run(self, host, port, name):
+        """Цикл asyncio фонового потока."""
+        asyncio.set_event_loop(self.loop)
+        self.task = self.loop.create_task(self.main(host, port, name))
+        error = None
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        except (OSError, ValueError, asyncio.IncompleteReadError, struct.error) as exception:
+            error = exception
+        finally:
+            self.loop.close()
+        self.incoming.put(("closed", error))
+
+    async def main(self, host, port, name):
+        """Подключается, передает снимок холста и затем получает операции журнала."""
+        connection = await SessionConnection.connect(host, port, name)
+        self.incoming.put(("welcome", connection.client, connection.state, connection.tiles))
+        send_task = asyncio.ensure_future(self.send_loop(connection))
+        try:
+            while True:
+                self.incoming.put(await connection.receive())
+        finally:
+            send_task.cancel()
+            connection.close()
+
+    async def send_loop(self, connection):
+        """Отправляет накопленные команды пачками не чаще раза в BATCH_INTERVAL."""
+        loop = asyncio.get_running_loop()
+        last_send = 0.0
+        while True:
+            await self.wakeup.wait()
+            delay = last_send + self.BATCH_INTERVAL - loop.time()
+            if delay > 0:  # Недавно отправляли - собираем пачку
+                await asyncio.sleep(delay)
+            self.wakeup.clear()
+            items, self.pending = self.pending, []
+            batch = []
+            for item in items:
+                if isinstance(item, dict):
+                    batch.append(item)
+                    continue
+                if batch:  # Заплатки отмены идут после команд, сделанных до неё
+                    connection.send(batch)
+                    batch = []
+                connection.send_patch(*item)
+            if batch:
+                connection.send(batch)
+            last_send = loop.time()
+            await connection.writer.drain()
+
+    def enqueue(self, item):
+        """Ставит команду или заплатки в очередь отправки (в потоке цикла)."""
+        self.pending.append(item)
+        self.wakeup.set()
+
+    def send(self, command, layer):
+        """Отправляет свою команду command, выполненную на слое layer (команды не из SHARED_OPS не отправляются)."""
+        if command["op"] not in SHARED_OPS:
+            return
+        if command["op"] in LAYER_OPS:
+            command = dict(command, layer=layer)
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, command)
+        except RuntimeError:  # Соединение уже закрыто
+            pass
+
+    def send_patch(self, state, patches):
+        """Отправляет заплатки и состояние холста своей отмены или повтора."""
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, (state, patches))
+        except RuntimeError:
+            pass
+
+    def close(self):
+        """Закрывает соединение."""
+        try:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        except (RuntimeError, AttributeError):
+            pass